@@ -39,11 +39,15 @@ bl_info = {
 
 import bpy
 from bpy.types import AddonPreferences
-from bpy.props import StringProperty, BoolProperty
+from bpy.props import StringProperty, BoolProperty, FloatProperty, CollectionProperty
 
 # Local imports
-from .exporters import ExportBlenderObjects, ExportBlenderCollection, ExportBlenderNodes
-from .utilities import get_default_path
+from .exporters import ExportBlenderObjects, ExportBlenderCollection, ExportBlenderNodes, ExportBlenderNodeGroups, ExportQueuedBlends, ExportChangedBlends, SwapBlendProxies, ExtractBlendAssets, ShowBlendTransfers
+from .transfers import transfer_queue
+from .functions import invalidate_dependency_cache, export_changed_on_save, export_queued_on_save
+from .export_queue import get_queued_exports, clear_queue
+from .slim import ExportProfile, STRIP_CATEGORIES, ensure_default_profiles
+from .tracking import tag_changed_exports, clear_tracking
 
 
 # Preferences
@@ -54,8 +58,7 @@ class export_blend_preferences(AddonPreferences):
     filepath: StringProperty(
         name = 'File Path',
         description = 'Where the export will be saved by default. Use // at the beginning to make it relative to the current blend file',
-        subtype="DIR_PATH",
-        default =  get_default_path()
+        default = "//assets/"
     )
     mark_asset: BoolProperty(
         name="Mark as Asset",
@@ -67,54 +70,55 @@ class export_blend_preferences(AddonPreferences):
         description="Replace selection with a link to the exported object",
         default=False
     )
-
-    # Object Defaults
-    export_as_collection: BoolProperty(
-        name="Export as Collection",
-        description="Bundle selected objects in a collection before exporting",
-        default=False
+    preview_timeout: FloatProperty(
+        name="Preview Timeout",
+        description="Longest time in seconds to wait for asset previews to render before exporting without them",
+        default=10.0,
+        min=0.0
     )
-
-    # Node Defaults
-    export_as_group: BoolProperty(
-        name="Export as Node Group",
-        description="Bundle selected objects in a node group before exporting",
-        default=False
+    preview_cache_size: FloatProperty(
+        name="Preview Cache (MB)",
+        description="Disk space for keeping rendered asset previews, so unchanged assets don't have to be rendered again. 0 turns the cache off",
+        default=256.0,
+        min=0.0
     )
-
-    def draw(self, context):
-        layout = self.layout
-        layout.prop(self, 'filepath')
-        general_prefs = layout.column(heading='General Defaults:')
-        if bpy.app.version > (2, 93, 0):
-          general_prefs.prop(self, 'mark_asset')
-        general_prefs.prop(self, 'backlink')
-        obj_prefs = layout.column(heading='Object Defaults:')
-        obj_prefs.prop(self, 'export_as_collection')
-        node_prefs = layout.column(heading='Node Defaults:')
-        node_prefs.prop(self, 'export_as_group')
-
-
-# Preferences
-class export_blend_preferences(AddonPreferences):
-    bl_idname = __name__
-
-    # General Defaults
-    filepath: StringProperty(
-        name = 'File Path',
-        description = 'Where the export will be saved by default. Use // at the beginning to make it relative to the current blend file',
-        default = "//assets/"
+    track_changes: BoolProperty(
+        name="Track Changes",
+        description="Keep track of which exported files are out of date as you keep working, so they can be re-exported from File > Export",
+        default=False
     )
-    mark_asset: BoolProperty(
-        name="Mark as Asset",
-        description="Mark selected objects as assets for visibility in the Asset Browser",
+    export_changed_on_save: BoolProperty(
+        name="Re-export on Save",
+        description="Re-export changed files whenever this file is saved",
         default=False
     )
-    backlink: BoolProperty(
-        name="Backlink",
-        description="Replace selection with a link to the exported object",
+    export_queue_on_save: BoolProperty(
+        name="Export Queue on Save",
+        description="Write everything queued for export whenever this file is saved",
         default=False
     )
+    stage_directory: StringProperty(
+        name="Local Staging Folder",
+        description="Write exports to this local folder first and move them to their destination in the background, for asset libraries on slow or network drives. Leave empty to write directly",
+        subtype='DIR_PATH',
+        default=""
+    )
+    log_filepath: StringProperty(
+        name="Export Log",
+        description="Append timings and memory use for every export to this file, one JSON object per line. Leave empty to turn logging off",
+        subtype='FILE_PATH',
+        default=""
+    )
+
+    profiles: CollectionProperty(
+        type=ExportProfile,
+        name="Export Profiles",
+        description="Named sets of data to leave out of exported files"
+    )
+    default_profiles_added: BoolProperty(
+        default=False,
+        options={'HIDDEN'}
+    )
 
     # Object Defaults
     export_as_collection: BoolProperty(
@@ -137,23 +141,79 @@ class export_blend_preferences(AddonPreferences):
         if bpy.app.version > (2, 93, 0):
           general_prefs.prop(self, 'mark_asset')
         general_prefs.prop(self, 'backlink')
+        if bpy.app.version > (2, 93, 0):
+          general_prefs.prop(self, 'preview_timeout')
+          general_prefs.prop(self, 'preview_cache_size')
+        general_prefs.prop(self, 'track_changes')
+        if self.track_changes:
+          general_prefs.prop(self, 'export_changed_on_save')
+        general_prefs.prop(self, 'export_queue_on_save')
+        general_prefs.prop(self, 'stage_directory')
+        general_prefs.prop(self, 'log_filepath')
         obj_prefs = layout.column(heading='Object Defaults:')
         obj_prefs.prop(self, 'export_as_collection')
         node_prefs = layout.column(heading='Node Defaults:')
         node_prefs.prop(self, 'export_as_group')
+        profile_prefs = layout.column(heading='Export Profiles:')
+        for index, profile in enumerate(self.profiles):
+          box = profile_prefs.box()
+          row = box.row()
+          row.prop(profile, 'name', text="")
+          row.operator(EditBlendProfiles.bl_idname, text="", icon='X').remove = index
+          col = box.column(align=True)
+          for category, name, description in STRIP_CATEGORIES:
+            col.prop(profile, category)
+        profile_prefs.operator(EditBlendProfiles.bl_idname, text="Add Profile", icon='ADD')
+
+
+class EditBlendProfiles(bpy.types.Operator):
+    """Add an export profile, or remove one"""
+    bl_idname = "preferences.blend_export_profile"
+    bl_label = "Edit Export Profiles"
+    bl_options = {'INTERNAL'}
+
+    remove: bpy.props.IntProperty(
+        default=-1
+    )
+
+    def execute(self, context):
+        profiles = context.preferences.addons[__name__].preferences.profiles
+        if self.remove >= 0:
+            profiles.remove(self.remove)
+        else:
+            profile = profiles.add()
+            profile.name = "profile %d" % len(profiles)
+        context.preferences.is_dirty = True
+        return {'FINISHED'}
 
 
 # UI
 def menu_func_export(self, context):
     if self.bl_label == "Export":
         self.layout.operator(ExportBlenderObjects.bl_idname, text="Blender (.blend)")
+        self.layout.operator(ExportBlenderNodeGroups.bl_idname, text="Node Groups (.blend)")
+        if context.preferences.addons[__name__].preferences.track_changes:
+            self.layout.operator(ExportChangedBlends.bl_idname, text="Changed .blend Files")
+        queued = len(get_queued_exports())
+        if queued:
+            self.layout.operator(ExportQueuedBlends.bl_idname, text="Queued .blend Files (%d)" % queued)
+            self.layout.operator(ExportQueuedBlends.bl_idname, text="Discard Export Queue").discard = True
+        self.layout.operator(ExtractBlendAssets.bl_idname, text="Extract from .blend Files")
+        transfers = transfer_queue.get_transfers()
+        if transfers:
+            waiting = sum(1 for transfer in transfers if transfer.status not in {'FINISHED', 'FAILED'})
+            failed = sum(1 for transfer in transfers if transfer.status == 'FAILED')
+            self.layout.operator(ShowBlendTransfers.bl_idname,
+                                 text="Library Transfers (%d waiting, %d failed)" % (waiting, failed))
     elif self.bl_label == "Collection":
-        if len(context.selected_ids) == 1 and isinstance(context.selected_ids[0], bpy.types.Collection):
+        if context.selected_ids and all(isinstance(id, bpy.types.Collection) for id in context.selected_ids):
             self.layout.operator_context = "INVOKE_DEFAULT"
             self.layout.operator(ExportBlenderCollection.bl_idname, text="Export to .blend")
     elif self.bl_label == "Object":
         self.layout.operator_context = "INVOKE_DEFAULT"
         self.layout.operator(ExportBlenderObjects.bl_idname, text="Export to .blend")
+        if bpy.data.libraries:
+            self.layout.operator(SwapBlendProxies.bl_idname)
 
 
 def menu_func_export_nodes(self, context):
@@ -165,26 +225,84 @@ def menu_func_export_nodes(self, context):
     #    op.is_compositor = True
 
 
+# Any of these can change how datablocks depend on each other
+def dependency_cache_handlers():
+    return (
+        bpy.app.handlers.depsgraph_update_post,
+        bpy.app.handlers.undo_post,
+        bpy.app.handlers.redo_post,
+        bpy.app.handlers.load_post,
+    )
+
+
+# Notice changes to exported data as they happen, forget queued exports when another file is
+# opened, and export changed or queued files before saving if asked to
+def tracking_handlers():
+    return (
+        (bpy.app.handlers.depsgraph_update_post, tag_changed_exports),
+        (bpy.app.handlers.load_post, clear_tracking),
+        (bpy.app.handlers.save_pre, export_changed_on_save),
+        (bpy.app.handlers.load_post, clear_queue),
+        (bpy.app.handlers.save_pre, export_queued_on_save),
+    )
+
+
+def add_default_profiles():
+    # The add-on's preferences don't exist yet while it registers, so the defaults go in just after
+    addon = bpy.context.preferences.addons.get(__name__)
+    if addon is not None:
+        ensure_default_profiles(addon.preferences)
+
+
 def register():
+    bpy.utils.register_class(ExportProfile)
     bpy.utils.register_class(export_blend_preferences)
+    bpy.utils.register_class(EditBlendProfiles)
     bpy.utils.register_class(ExportBlenderObjects)
     bpy.utils.register_class(ExportBlenderCollection)
     bpy.utils.register_class(ExportBlenderNodes)
+    bpy.utils.register_class(ExportBlenderNodeGroups)
+    bpy.utils.register_class(ExportQueuedBlends)
+    bpy.utils.register_class(ExportChangedBlends)
+    bpy.utils.register_class(SwapBlendProxies)
+    bpy.utils.register_class(ExtractBlendAssets)
+    bpy.utils.register_class(ShowBlendTransfers)
     bpy.types.TOPBAR_MT_file_export.append(menu_func_export)
     bpy.types.OUTLINER_MT_object.append(menu_func_export)
     bpy.types.OUTLINER_MT_collection.append(menu_func_export)
     bpy.types.NODE_MT_node.append(menu_func_export_nodes)
+    for handlers in dependency_cache_handlers():
+        handlers.append(invalidate_dependency_cache)
+    for handlers, handler in tracking_handlers():
+        handlers.append(handler)
+    bpy.app.timers.register(add_default_profiles, first_interval=0.1)
 
 
 def unregister():
+    if bpy.app.timers.is_registered(add_default_profiles):
+        bpy.app.timers.unregister(add_default_profiles)
+    bpy.utils.unregister_class(EditBlendProfiles)
     bpy.utils.unregister_class(export_blend_preferences)
+    bpy.utils.unregister_class(ExportProfile)
     bpy.utils.unregister_class(ExportBlenderObjects)
     bpy.utils.unregister_class(ExportBlenderCollection)
     bpy.utils.unregister_class(ExportBlenderNodes)
+    bpy.utils.unregister_class(ExportBlenderNodeGroups)
+    bpy.utils.unregister_class(ExportQueuedBlends)
+    bpy.utils.unregister_class(ExportChangedBlends)
+    bpy.utils.unregister_class(SwapBlendProxies)
+    bpy.utils.unregister_class(ExtractBlendAssets)
+    bpy.utils.unregister_class(ShowBlendTransfers)
     bpy.types.TOPBAR_MT_file_export.remove(menu_func_export)
     bpy.types.OUTLINER_MT_object.remove(menu_func_export)
     bpy.types.OUTLINER_MT_collection.remove(menu_func_export)
     bpy.types.NODE_MT_node.remove(menu_func_export_nodes)
+    for handlers in dependency_cache_handlers():
+        if invalidate_dependency_cache in handlers:
+            handlers.remove(invalidate_dependency_cache)
+    for handlers, handler in tracking_handlers():
+        if handler in handlers:
+            handlers.remove(handler)
 
 
 if __name__ == "__main__":
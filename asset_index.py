@@ -0,0 +1,277 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+Index of the assets in an exported library, kept in a sidecar folder at the library root so
+the library can be browsed without opening any .blend files. This module doesn't use bpy,
+so tools outside Blender can load it straight from its file:
+
+    index = load_asset_index("/path/to/library")
+    for asset in index.assets(id_type='OBJECT', tag="furniture"):
+        print(asset["name"], asset["filepath"])
+
+'''
+
+
+import base64
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+
+# Folder at the library root holding the index. There's one small JSON file per folder of
+# exported files, so an export only rewrites the part of the index for the folder it wrote
+# to, and previews are PNG files next to them, named by their contents.
+INDEX_DIR_NAME = ".export_blend_assets"
+SHARDS_DIR_NAME = "index"
+PREVIEWS_DIR_NAME = "previews"
+
+# The single file earlier versions kept the whole index in
+LEGACY_INDEX_NAME = ".export_blend_assets.json"
+
+# Bumped whenever the layout of the index changes
+INDEX_VERSION = 2
+
+
+def get_library_root(filepath, library_path=None):
+    # The index lives at the root of the asset library if the file is inside it,
+    # otherwise next to the file
+    directory = os.path.dirname(os.path.abspath(filepath))
+    if library_path:
+        root = os.path.abspath(library_path)
+        if os.path.commonpath([root, directory]) == root:
+            return root
+    return directory
+
+
+def get_file_key(root, filepath):
+    return os.path.relpath(os.path.abspath(filepath), root).replace(os.sep, "/")
+
+
+def get_shard_path(root, directory_key):
+    digest = hashlib.sha1(directory_key.encode()).hexdigest()[:16]
+    return os.path.join(root, INDEX_DIR_NAME, SHARDS_DIR_NAME, digest + ".json")
+
+
+def read_shard(root, directory_key):
+    try:
+        with open(get_shard_path(root, directory_key)) as shard_file:
+            shard = json.load(shard_file)
+    except (OSError, ValueError):
+        shard = {}
+    if shard.get("version") != INDEX_VERSION or shard.get("directory") != directory_key:
+        # Written by a different version of the add-on, so start over
+        return {"version": INDEX_VERSION, "directory": directory_key, "files": {}}
+    return shard
+
+
+def write_shard(root, shard):
+    # Write to a temporary file first so readers never see a half-written shard
+    filepath = get_shard_path(root, shard["directory"])
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    temp_filepath = filepath + ".tmp"
+    with open(temp_filepath, "w") as shard_file:
+        json.dump(shard, shard_file, separators=(",", ":"), sort_keys=True)
+    os.replace(temp_filepath, filepath)
+    # Anything in the old single file is out of date from here on
+    try:
+        os.remove(os.path.join(root, LEGACY_INDEX_NAME))
+    except OSError:
+        pass
+
+
+def read_shards(root):
+    # Every shard in the index, as {file key: file entry}
+    files = {}
+    shards_dir = os.path.join(root, INDEX_DIR_NAME, SHARDS_DIR_NAME)
+    try:
+        filenames = os.listdir(shards_dir)
+    except OSError:
+        return files
+    for filename in filenames:
+        if not filename.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(shards_dir, filename)) as shard_file:
+                shard = json.load(shard_file)
+        except (OSError, ValueError):
+            continue
+        if shard.get("version") != INDEX_VERSION:
+            continue
+        for name, file_entry in shard["files"].items():
+            files[posix_join(shard["directory"], name)] = file_entry
+    return files
+
+
+def posix_join(directory_key, name):
+    return directory_key + "/" + name if directory_key not in ("", ".") else name
+
+
+def write_png(filepath, width, height, pixels):
+    # 8 bit RGBA, rows given bottom first the way Blender keeps previews
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    stride = width * 4
+    rows = b"".join(b"\x00" + pixels[y * stride:(y + 1) * stride] for y in reversed(range(height)))
+    data = b"\x89PNG\r\n\x1a\n"
+    data += chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+    data += chunk(b"IDAT", zlib.compress(rows))
+    data += chunk(b"IEND", b"")
+    temp_filepath = filepath + ".tmp"
+    with open(temp_filepath, "wb") as png_file:
+        png_file.write(data)
+    os.replace(temp_filepath, filepath)
+
+
+def read_png(filepath):
+    # Only reads back what write_png writes: (width, height, RGBA bytes, bottom row first)
+    with open(filepath, "rb") as png_file:
+        data = png_file.read()
+    width, height = struct.unpack(">II", data[16:24])
+    chunks = []
+    offset = 8
+    while offset < len(data):
+        length, = struct.unpack(">I", data[offset:offset + 4])
+        kind = data[offset + 4:offset + 8]
+        if kind == b"IDAT":
+            chunks.append(data[offset + 8:offset + 8 + length])
+        offset += length + 12
+    rows = zlib.decompress(b"".join(chunks))
+    stride = width * 4 + 1
+    return width, height, b"".join(rows[y * stride + 1:(y + 1) * stride] for y in reversed(range(height)))
+
+
+def store_preview(root, preview):
+    # Write a thumbnail from get_preview_thumbnail to the index's previews folder and return its
+    # path relative to the index folder. Identical previews are only stored once.
+    width, height = preview["size"]
+    pixels = base64.b64decode(preview["pixels"])
+    digest = hashlib.sha1(struct.pack("<II", width, height) + pixels).hexdigest()
+    relative_path = "%s/%s/%s.png" % (PREVIEWS_DIR_NAME, digest[:2], digest)
+    filepath = os.path.join(root, INDEX_DIR_NAME, *relative_path.split("/"))
+    if not os.path.exists(filepath):
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        write_png(filepath, width, height, pixels)
+    return relative_path
+
+
+def update_index(assets_by_filepath, library_path=None):
+    # Replace the entries for just the given files. Files without assets are dropped from the index.
+    shards = {}
+    for filepath, assets in assets_by_filepath.items():
+        root = get_library_root(filepath, library_path)
+        directory_key, name = os.path.split(get_file_key(root, filepath))
+        shard_key = (root, directory_key)
+        if shard_key not in shards:
+            shards[shard_key] = [read_shard(root, directory_key), False]
+        shard = shards[shard_key]
+        if assets:
+            stat = os.stat(filepath)
+            entries = []
+            for asset in assets:
+                asset = dict(asset)
+                if asset.get("preview"):
+                    asset["preview"] = store_preview(root, asset["preview"])
+                entries.append(asset)
+            shard[0]["files"][name] = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "assets": entries,
+            }
+            shard[1] = True
+        elif shard[0]["files"].pop(name, None) is not None:
+            shard[1] = True
+
+    for (root, directory_key), (shard, changed) in shards.items():
+        if changed:
+            write_shard(root, shard)
+
+
+def refresh_index(filepaths, library_path=None):
+    # Update the size and modification time of files already in the index, keeping their assets
+    for filepath in filepaths:
+        root = get_library_root(filepath, library_path)
+        directory_key, name = os.path.split(get_file_key(root, filepath))
+        shard = read_shard(root, directory_key)
+        file_entry = shard["files"].get(name)
+        if file_entry is None:
+            continue
+        stat = os.stat(filepath)
+        file_entry["size"] = stat.st_size
+        file_entry["mtime"] = stat.st_mtime
+        write_shard(root, shard)
+
+
+class AssetIndex:
+    # Read-only view of a library's index
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.index_dir = os.path.join(self.root, INDEX_DIR_NAME)
+        self.files_by_key = read_shards(self.root)
+
+    def files(self):
+        return [os.path.join(self.root, key) for key in sorted(self.files_by_key)]
+
+    def assets(self, name=None, id_type=None, catalog=None, tag=None):
+        # Every asset matching all of the given filters, each with the absolute path of its file
+        # and of its preview (None if it has none)
+        for key, file_entry in sorted(self.files_by_key.items()):
+            for asset in file_entry["assets"]:
+                if name is not None and asset["name"] != name:
+                    continue
+                if id_type is not None and asset["type"] != id_type:
+                    continue
+                if catalog is not None and catalog not in (asset["catalog_id"], asset["catalog"]):
+                    continue
+                if tag is not None and tag not in asset["tags"]:
+                    continue
+                preview = asset.get("preview")
+                if preview:
+                    preview = os.path.join(self.index_dir, *preview.split("/"))
+                yield dict(asset, filepath=os.path.join(self.root, key), preview=preview)
+
+    def find(self, name, id_type=None):
+        return next(self.assets(name=name, id_type=id_type), None)
+
+    def is_stale(self, asset):
+        # True if the file changed since it was indexed, e.g. saved by hand in Blender
+        file_entry = self.files_by_key.get(os.path.relpath(asset["filepath"], self.root).replace(os.sep, "/"))
+        try:
+            return file_entry is None or os.path.getmtime(asset["filepath"]) != file_entry["mtime"]
+        except OSError:
+            return True
+
+
+def get_preview_pixels(asset):
+    # (width, height, RGBA bytes, 8 bits per channel, bottom row first), or None if there's no preview
+    if not asset.get("preview"):
+        return None
+    try:
+        return read_png(asset["preview"])
+    except (OSError, ValueError, struct.error, zlib.error):
+        return None
+
+
+def load_asset_index(root):
+    return AssetIndex(root)
@@ -0,0 +1,326 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+Export benchmarks. Generates a synthetic scene, then times every export mode on it,
+each case in a fresh background Blender so timings and memory don't leak between them:
+
+    blender -b --factory-startup --python benchmarks/run.py -- --scale small --output results.json
+
+Add --baseline baseline.json to flag anything that got slower, hungrier or bigger.
+See benchmarks/README.md for the rest of the options.
+
+'''
+
+
+import bpy
+import argparse
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.dirname(ADDON_DIR))
+
+import scenes
+
+# Sizes are shown the same way the add-on reports them
+format_size = importlib.import_module(os.path.basename(ADDON_DIR) + ".utilities").format_size
+
+# Case processes print their result on stdout with this prefix
+RESULT_PREFIX = "EXPORT_BLEND_BENCHMARK "
+
+# Measurements compared against the baseline
+METRICS = ("time", "peak_memory", "size")
+
+
+def import_addon():
+    return importlib.import_module(os.path.basename(ADDON_DIR))
+
+
+# Cases
+
+def object_settings(output_dir, **options):
+    # The same settings ExportBlenderObjects would pass, with previews not waited on,
+    # since they never render in background mode
+    export_settings = {
+        "is_collection": False,
+        "filepath": os.path.join(output_dir, "export.blend"),
+        "export_selected": True,
+        "export_as_collection": False,
+        "collection_name": "export_collection",
+        "backlink": False,
+        "directory": output_dir,
+        "filename_template": "{collection}/{name}.blend",
+        "preview_timeout": 0.0,
+        "incremental": False,
+        "share_dependencies": False,
+        "mark_asset": False,
+    }
+    export_settings.update(options)
+    return export_settings
+
+
+def collection_settings(output_dir, **options):
+    collections = [collection for collection in bpy.data.collections if collection.name.startswith("bench_collection_")]
+    export_settings = object_settings(
+        output_dir,
+        is_collection=True,
+        export_as_collection=True,
+        collection_name=collections[0].name,
+        collections=collections,
+    )
+    export_settings.update(options)
+    return export_settings
+
+
+def node_settings(output_dir, **options):
+    export_settings = {
+        "filepath": os.path.join(output_dir, "export.blend"),
+        "export_selected": True,
+        "export_as_group": False,
+        "group_name": "export_group",
+        "backlink": False,
+    }
+    export_settings.update(options)
+    return export_settings
+
+
+def get_context():
+    # The export functions only need a few things from the context, which a background Blender
+    # can't always give, so hand them over directly
+    scene = bpy.context.scene
+    node_tree = bpy.data.materials[scenes.NODE_MATERIAL_NAME].node_tree
+    return SimpleNamespace(
+        scene=scene,
+        selected_objects=[ob for ob in scene.objects if ob.select_get()],
+        active_node=node_tree.nodes.active,
+    )
+
+
+def run_objects(addon, output_dir, **options):
+    addon.functions.export_blend_objects(get_context(), object_settings(output_dir, **options))
+
+
+def run_batch(addon, output_dir, **options):
+    addon.functions.export_blend_batch(get_context(), object_settings(output_dir, **options))
+
+
+def run_batch_unchanged(addon, output_dir):
+    # Only the second export is timed, where every file can be skipped
+    export_settings = object_settings(output_dir, incremental=True)
+    addon.functions.export_blend_batch(get_context(), dict(export_settings))
+    addon.functions.invalidate_dependency_cache()
+    start = time.perf_counter()
+    addon.functions.export_blend_batch(get_context(), dict(export_settings))
+    return time.perf_counter() - start
+
+
+def run_batch_parallel(addon, output_dir):
+    addon.workers.export_blend_batch_parallel(get_context(), object_settings(output_dir))
+
+
+def run_collection(addon, output_dir, **options):
+    addon.functions.export_blend_objects(get_context(), collection_settings(output_dir, **options))
+
+
+def run_collection_batch(addon, output_dir, **options):
+    addon.functions.export_blend_batch(get_context(), collection_settings(output_dir, **options))
+
+
+def run_nodes(addon, output_dir, **options):
+    addon.functions.export_blend_nodes(get_context(), node_settings(output_dir, **options))
+
+
+CASES = {
+    "objects_selected": lambda addon, output_dir: run_objects(addon, output_dir),
+    "objects_as_collection": lambda addon, output_dir: run_objects(addon, output_dir, export_as_collection=True),
+    "objects_as_asset": lambda addon, output_dir: run_objects(addon, output_dir, mark_asset=True),
+    "objects_all": lambda addon, output_dir: run_objects(addon, output_dir, export_selected=False),
+    "objects_backlink": lambda addon, output_dir: run_objects(addon, output_dir, backlink=True),
+    "objects_batch": lambda addon, output_dir: run_batch(addon, output_dir),
+    "objects_batch_shared": lambda addon, output_dir: run_batch(addon, output_dir, share_dependencies=True),
+    "objects_batch_backlink": lambda addon, output_dir: run_batch(addon, output_dir, backlink=True),
+    "objects_batch_unchanged": run_batch_unchanged,
+    "objects_batch_parallel": run_batch_parallel,
+    "collection": lambda addon, output_dir: run_collection(addon, output_dir),
+    "collection_backlink": lambda addon, output_dir: run_collection(addon, output_dir, backlink=True),
+    "collection_batch": lambda addon, output_dir: run_collection_batch(addon, output_dir),
+    "nodes_tree": lambda addon, output_dir: run_nodes(addon, output_dir, export_selected=False),
+    "nodes_selected": lambda addon, output_dir: run_nodes(addon, output_dir),
+    "nodes_group": lambda addon, output_dir: run_nodes(addon, output_dir, export_as_group=True),
+    "nodes_group_backlink": lambda addon, output_dir: run_nodes(addon, output_dir, export_as_group=True, backlink=True),
+}
+
+
+def get_output_size(output_dir):
+    size = 0
+    for directory, dirnames, filenames in os.walk(output_dir):
+        for filename in filenames:
+            if filename.endswith(".blend"):
+                size += os.path.getsize(os.path.join(directory, filename))
+    return size
+
+
+def run_case(name, output_dir):
+    # Runs in its own Blender, with the generated scene already open
+    addon = import_addon()
+    start_memory = addon.functions.get_peak_memory()
+    start = time.perf_counter()
+    timed = CASES[name](addon, output_dir)
+    elapsed = time.perf_counter() - start if timed is None else timed
+    peak_memory = addon.functions.get_peak_memory()
+    return {
+        "time": elapsed,
+        "peak_memory": peak_memory,
+        "memory_increase": peak_memory - start_memory if peak_memory is not None else None,
+        "size": get_output_size(output_dir),
+    }
+
+
+# Driver
+
+def run_case_process(source_path, name, output_dir):
+    command = [
+        bpy.app.binary_path, "--factory-startup", "-b", source_path,
+        "--python", os.path.abspath(__file__),
+        "--", "--case", name, "--output-dir", output_dir,
+    ]
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    for line in process.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    return {"error": process.stdout[-2000:]}
+
+
+def run_benchmarks(args):
+    params = dict(scenes.SCALES[args.scale.upper()])
+    work_dir = tempfile.mkdtemp(prefix="export_blend_benchmark_")
+    try:
+        source_path = os.path.join(work_dir, "source.blend")
+        scenes.generate_scene(params)
+        bpy.ops.wm.save_as_mainfile(filepath=source_path)
+
+        names = args.cases.split(",") if args.cases else list(CASES)
+        results = {}
+        for name in names:
+            runs = []
+            for repeat in range(args.repeat):
+                output_dir = os.path.join(work_dir, "output")
+                shutil.rmtree(output_dir, ignore_errors=True)
+                os.makedirs(output_dir)
+                runs.append(run_case_process(source_path, name, output_dir))
+            failed = [run for run in runs if "error" in run]
+            if failed:
+                results[name] = failed[0]
+                print("%-26s FAILED" % name)
+                continue
+            # The fastest run is the one least disturbed by everything else on the machine
+            results[name] = min(runs, key=lambda run: run["time"])
+            print("%-26s %8.3fs %s" % (name, results[name]["time"], format_size(results[name]["size"])))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    addon = import_addon()
+    return {
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "addon_version": ".".join(str(number) for number in addon.bl_info["version"]),
+        "blender_version": bpy.app.version_string,
+        "platform": sys.platform,
+        "scale": args.scale.upper(),
+        "params": params,
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+
+def compare(results, baseline, threshold):
+    # Anything more than threshold (a fraction) worse than the baseline is a regression
+    if results["scale"] != baseline.get("scale"):
+        print("Baseline is for scale %s, not %s, so it can't be compared" % (baseline.get("scale"), results["scale"]))
+        return []
+    regressions = []
+    for name, result in results["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None or "error" in previous:
+            continue
+        if "error" in result:
+            regressions.append((name, "error", previous.get("time"), None))
+            continue
+        for metric in METRICS:
+            old, new = previous.get(metric), result.get(metric)
+            if old and new is not None and new > old * (1 + threshold):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def main(argv=None):
+    if argv is None:
+        # Blender ignores everything after "--", so that's where our arguments go
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(
+        prog="blender -b --factory-startup --python benchmarks/run.py --",
+        description="Time every export mode on a generated scene",
+    )
+    parser.add_argument("--scale", default="small", choices=[scale.lower() for scale in scenes.SCALES])
+    parser.add_argument("--cases", help="Comma separated cases to run, all of them by default: " + ", ".join(CASES))
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case, the fastest one is kept")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="How much worse than the baseline counts as a regression, 0.2 is 20%%")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--output-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(RESULT_PREFIX + json.dumps(run_case(args.case, args.output_dir)), flush=True)
+        return
+
+    results = run_benchmarks(args)
+    if args.output:
+        with open(args.output, "w") as results_file:
+            json.dump(results, results_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for name, metric, old, new in regressions:
+            if metric == "error":
+                print("REGRESSION %s: failed" % name)
+            elif metric == "time":
+                print("REGRESSION %s: %s %.3fs -> %.3fs" % (name, metric, old, new))
+            else:
+                print("REGRESSION %s: %s %s -> %s" % (name, metric, format_size(old), format_size(new)))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against %s" % args.baseline)
+
+
+if __name__ == "__main__":
+    main()
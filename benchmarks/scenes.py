@@ -0,0 +1,163 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+Synthetic scenes for the benchmarks. Everything is generated from a handful of counts,
+so the same scale always gives the same scene.
+
+'''
+
+
+import bpy
+
+
+# Preset sizes for --scale. Objects share meshes and materials round-robin, so
+# there's always some data used by more than one object (and more than one file in a batch).
+SCALES = {
+    'SMALL': {
+        "objects": 50,
+        "meshes": 20,
+        "grid_size": 10,
+        "materials": 10,
+        "images": 5,
+        "image_size": 128,
+        "collections": 5,
+        "nodes": 20,
+    },
+    'MEDIUM': {
+        "objects": 500,
+        "meshes": 100,
+        "grid_size": 40,
+        "materials": 50,
+        "images": 20,
+        "image_size": 512,
+        "collections": 20,
+        "nodes": 100,
+    },
+    'LARGE': {
+        "objects": 5000,
+        "meshes": 500,
+        "grid_size": 100,
+        "materials": 200,
+        "images": 50,
+        "image_size": 1024,
+        "collections": 50,
+        "nodes": 400,
+    },
+}
+
+# The material whose node tree the node export cases work on
+NODE_MATERIAL_NAME = "bench_nodes"
+
+
+def clear_file():
+    for attr in ("objects", "meshes", "materials", "images", "collections", "node_groups"):
+        datablocks = getattr(bpy.data, attr)
+        for id_data in list(datablocks):
+            datablocks.remove(id_data)
+
+
+def new_grid_mesh(name, size):
+    # A flat grid of size x size quads
+    vertices = [(x, y, 0.0) for y in range(size + 1) for x in range(size + 1)]
+    faces = []
+    for y in range(size):
+        for x in range(size):
+            corner = y * (size + 1) + x
+            faces.append((corner, corner + 1, corner + size + 2, corner + size + 1))
+    mesh = bpy.data.meshes.new(name)
+    mesh.from_pydata(vertices, [], faces)
+    mesh.update()
+    return mesh
+
+
+def new_image(name, size, index):
+    image = bpy.data.images.new(name, size, size)
+    image.generated_type = 'COLOR_GRID' if index % 2 else 'UV_GRID'
+    # Packed, so the exports carry the pixels the way real textures would
+    image.pack()
+    return image
+
+
+def new_material(name, image):
+    material = bpy.data.materials.new(name)
+    material.use_nodes = True
+    nodes = material.node_tree.nodes
+    texture = nodes.new("ShaderNodeTexImage")
+    texture.image = image
+    material.node_tree.links.new(texture.outputs["Color"], nodes["Principled BSDF"].inputs["Base Color"])
+    return material
+
+
+def new_node_material(node_count):
+    # A long chain of math nodes feeding the shader, for the node export cases.
+    # The first half of the chain is selected.
+    material = bpy.data.materials.new(NODE_MATERIAL_NAME)
+    material.use_nodes = True
+    node_tree = material.node_tree
+    for node in node_tree.nodes:
+        node.select = False
+    chain = []
+    for index in range(node_count):
+        node = node_tree.nodes.new("ShaderNodeMath")
+        node.location = (index * 200, 400)
+        node.inputs[1].default_value = index
+        node.select = index < node_count // 2
+        if chain:
+            node_tree.links.new(chain[-1].outputs[0], node.inputs[0])
+        chain.append(node)
+    if chain:
+        node_tree.links.new(chain[-1].outputs[0], node_tree.nodes["Principled BSDF"].inputs["Roughness"])
+        node_tree.nodes.active = chain[0]
+    return material
+
+
+def generate_scene(params):
+    # Build the scene in the current file, replacing whatever was there
+    clear_file()
+    scene = bpy.context.scene
+
+    images = [new_image("bench_image_%d" % index, params["image_size"], index)
+              for index in range(params["images"])]
+    materials = [new_material("bench_material_%d" % index, images[index % len(images)] if images else None)
+                 for index in range(params["materials"])]
+    meshes = []
+    for index in range(params["meshes"]):
+        mesh = new_grid_mesh("bench_mesh_%d" % index, params["grid_size"])
+        if materials:
+            mesh.materials.append(materials[index % len(materials)])
+        meshes.append(mesh)
+
+    collections = []
+    for index in range(max(params["collections"], 1)):
+        collection = bpy.data.collections.new("bench_collection_%d" % index)
+        scene.collection.children.link(collection)
+        collections.append(collection)
+
+    for index in range(params["objects"]):
+        ob = bpy.data.objects.new("bench_object_%d" % index, meshes[index % len(meshes)])
+        ob.location = (index % 100 * 3.0, index // 100 * 3.0, 0.0)
+        collections[index % len(collections)].objects.link(ob)
+        # Select every tenth object for the export-selected cases
+        ob.select_set(index % 10 == 0)
+
+    new_node_material(params["nodes"])
+    return scene
@@ -0,0 +1,190 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+Headless exports driven by a manifest file. Run it from the file you want to export from:
+
+    blender -b source.blend --python-expr "from io_export_blend import cli; cli.main()" -- manifest.json
+
+See docs/03_command_line.md for the manifest format.
+
+'''
+
+
+import bpy
+import argparse
+import json
+import os
+import sys
+import time
+
+# Local imports
+from .functions import (
+    get_dependency_map,
+    collect_dependencies,
+    export_objects,
+    export_node_groups,
+    update_asset_index,
+    DEFAULT_PREVIEW_TIMEOUT,
+)
+from .hashing import hash_export, HashManifests
+
+
+# Options an entry can set, with the values used if neither the entry nor the manifest defaults do
+DEFAULT_OPTIONS = {
+    "mark_asset": False,
+    "export_as_collection": False,
+    "collection_name": "export_collection",
+    "preview_timeout": DEFAULT_PREVIEW_TIMEOUT,
+    "incremental": False,
+    "keep_links": False,
+    "texture_store": False,
+    "library_path": "",
+}
+
+
+def load_manifest(filepath):
+    if filepath.lower().endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            raise RuntimeError("TOML manifests need Blender with Python 3.11 or newer, use JSON instead")
+        with open(filepath, "rb") as manifest_file:
+            return tomllib.load(manifest_file)
+    with open(filepath) as manifest_file:
+        return json.load(manifest_file)
+
+
+def get_output_path(filepath, manifest_dir):
+    # "//" paths are relative to the source .blend, anything else relative to the manifest
+    if filepath.startswith("//"):
+        return bpy.path.abspath(filepath)
+    return os.path.normpath(os.path.join(manifest_dir, filepath))
+
+
+def get_entry_settings(entry, defaults, manifest_dir):
+    export_settings = dict(DEFAULT_OPTIONS)
+    export_settings.update(defaults)
+    export_settings.update({key: entry[key] for key in DEFAULT_OPTIONS if key in entry})
+    export_settings.update({
+        "is_collection": "collection" in entry,
+        "export_selected": True,
+        "backlink": False, # Backlinks only change the open file, which isn't saved here
+        "filepath": get_output_path(entry["filepath"], manifest_dir),
+    })
+    if "collection" in entry:
+        export_settings["export_as_collection"] = True
+        export_settings["collection_name"] = entry["collection"]
+    return export_settings
+
+
+def run_entry(entry, export_settings, dependency_map, manifests):
+    if "node_groups" in entry:
+        roots = [bpy.data.node_groups[name] for name in entry["node_groups"]]
+    elif "collection" in entry:
+        collection = bpy.data.collections[entry["collection"]]
+        roots = list(collection.objects) + [collection]
+    else:
+        roots = [bpy.data.objects[name] for name in entry["objects"]]
+
+    digest = None
+    if export_settings["incremental"]:
+        digest = hash_export(collect_dependencies(roots, dependency_map, export_settings["keep_links"]), export_settings)
+        if manifests.is_unchanged(export_settings["filepath"], digest):
+            return 'SKIPPED'
+
+    os.makedirs(os.path.dirname(export_settings["filepath"]), exist_ok=True)
+    if "node_groups" in entry:
+        assets = export_node_groups(roots, export_settings, dependency_map)
+    elif "collection" in entry:
+        assets = export_objects(roots[:-1], export_settings, dependency_map)
+    else:
+        assets = export_objects(roots, export_settings, dependency_map)
+    update_asset_index(export_settings, {export_settings["filepath"]: assets})
+
+    if digest is not None:
+        manifests.set(export_settings["filepath"], digest)
+    return 'FINISHED'
+
+
+def run_manifest(manifest, manifest_dir):
+    defaults = manifest.get("defaults", {})
+    start = time.perf_counter()
+
+    # Every entry comes from the same file, so the dependency data is built once for all of them
+    dependency_map = get_dependency_map()
+    manifests = HashManifests()
+
+    results = []
+    for entry in manifest.get("exports", []):
+        result = {"filepath": entry.get("filepath")}
+        entry_start = time.perf_counter()
+        try:
+            export_settings = get_entry_settings(entry, defaults, manifest_dir)
+            result["filepath"] = export_settings["filepath"]
+            result["status"] = run_entry(entry, export_settings, dependency_map, manifests)
+            result["size"] = os.path.getsize(export_settings["filepath"])
+        except Exception as error:
+            result["status"] = 'FAILED'
+            result["error"] = "%s: %s" % (type(error).__name__, error)
+        result["time"] = time.perf_counter() - entry_start
+        results.append(result)
+        print("%s %s (%.2fs)" % (result["status"], result["filepath"], result["time"]))
+    manifests.save()
+
+    return {
+        "source": bpy.data.filepath,
+        "blender_version": bpy.app.version_string,
+        "time": time.perf_counter() - start,
+        "exported": sum(1 for result in results if result["status"] == 'FINISHED'),
+        "skipped": sum(1 for result in results if result["status"] == 'SKIPPED'),
+        "failed": sum(1 for result in results if result["status"] == 'FAILED'),
+        "total_size": sum(result.get("size", 0) for result in results),
+        "results": results,
+    }
+
+
+def main(argv=None):
+    if argv is None:
+        # Blender ignores everything after "--", so that's where our arguments go
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(
+        prog="blender -b source.blend --python-expr \"from io_export_blend import cli; cli.main()\" --",
+        description="Export objects, collections and node groups listed in a manifest",
+    )
+    parser.add_argument("manifest", help="JSON or TOML file listing what to export")
+    parser.add_argument("--summary", help="Write the JSON summary to this file as well as stdout")
+    args = parser.parse_args(argv)
+
+    manifest_path = os.path.abspath(args.manifest)
+    manifest_dir = os.path.dirname(manifest_path)
+    manifest = load_manifest(manifest_path)
+    summary = run_manifest(manifest, manifest_dir)
+
+    summary_json = json.dumps(summary, indent=2)
+    print(summary_json)
+    summary_path = args.summary or manifest.get("summary")
+    if summary_path:
+        with open(get_output_path(summary_path, manifest_dir), "w") as summary_file:
+            summary_file.write(summary_json)
+
+    if summary["failed"]:
+        sys.exit(1)
@@ -0,0 +1,64 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+
+import os
+from bpy.app.handlers import persistent
+
+
+# Exports waiting to be written, keyed by the file they'll write. Datablocks are kept by
+# name, since references to them don't survive undo.
+_queued_exports = {}
+
+
+def get_queue_key(filepath):
+    return os.path.normcase(os.path.abspath(filepath))
+
+
+def queue_export(kind, export_settings, **names):
+    # Queuing the same file again replaces what was queued for it before, and moves it to the end
+    key = get_queue_key(export_settings["filepath"])
+    _queued_exports.pop(key, None)
+    job = {
+        "kind": kind,
+        # Collections in the settings are only needed to find the batch, which is already split up here
+        "settings": {key: value for key, value in export_settings.items() if key != "collections"},
+    }
+    job.update(names)
+    _queued_exports[key] = job
+
+
+def queue_objects(items):
+    for item_settings, objects in items:
+        queue_export('OBJECTS', item_settings, objects=[ob.name for ob in objects])
+
+
+def get_queued_exports():
+    return list(_queued_exports.values())
+
+
+@persistent
+def clear_queue(*args):
+    # Queued names only mean something in the file they were queued in
+    _queued_exports.clear()
@@ -24,13 +24,153 @@ Created by Jason van Gumster
 
 
 import bpy
+import os
 from bpy_extras.io_utils import ExportHelper
-from bpy.props import StringProperty, BoolProperty
+from bpy.props import StringProperty, BoolProperty, IntProperty, FloatProperty, EnumProperty
 from bpy.types import Operator
 
 # Local imports
-from .functions import export_blend_objects, export_blend_nodes
-from .utilities import mode_toggle
+from .functions import (
+    export_stages,
+    export_blend_objects,
+    export_blend_batch,
+    export_blend_shards,
+    export_blend_nodes,
+    export_blend_node_groups,
+    export_queued,
+    get_queue_settings,
+    get_node_tree_owner,
+    export_changed,
+    dry_run_blend_objects,
+    dry_run_blend_nodes,
+    get_export_objects,
+    get_batch_items,
+    get_shard_items,
+    invalidate_dependency_cache,
+)
+from .workers import export_blend_batch_parallel, parallel_export_stages, finish_exports, export_and_finish_stages
+from .proxies import is_proxy_path, get_swap_libraries, swap_library
+from .extract import extract_stages
+from .transfers import transfer_queue
+from .tracking import get_changed_exports
+from .export_queue import queue_export, queue_objects, get_queued_exports, clear_queue
+from .slim import get_profile_items, get_profile_strip, ensure_default_profiles
+from .utilities import mode_toggle, format_size
+
+
+def report_counts(operator, counts):
+    message = "%d written, %d skipped as unchanged" % (counts["written"], counts["skipped"])
+    if counts.get("saved"):
+        message += ", %s saved by the export profile" % format_size(counts["saved"])
+    if counts.get("phases"):
+        message += " (%s)" % counts["phases"]
+    if counts["failed"]:
+        operator.report({'WARNING'}, "Exported: %s, %d failed (see console)" % (message, counts["failed"]))
+    else:
+        operator.report({'INFO'}, "Exported: " + message)
+
+
+def report_batch_results(operator, results):
+    counts = {"written": 0, "skipped": 0, "failed": 0}
+    for result in results:
+        if result["status"] == 'FINISHED':
+            counts["written"] += 1
+        elif result["status"] == 'SKIPPED':
+            counts["skipped"] += 1
+        else:
+            counts["failed"] += 1
+            print("Failed to export %s: %s" % (result["filepath"], result.get("error", "cancelled")))
+    counts["saved"] = sum(result.get("saved", 0) for result in results)
+    report_counts(operator, counts)
+
+
+def report_queued(operator, count):
+    operator.report({'INFO'}, "Queued %d files for export, %d in the queue" % (count, len(get_queued_exports())))
+
+
+def report_extract_results(operator, results):
+    extracted = 0
+    failed = 0
+    for result in results:
+        if result["status"] == 'FINISHED':
+            extracted += len(result["files"])
+        else:
+            failed += 1
+            print("Failed to extract from %s: %s" % (result["filepath"], result.get("error", "cancelled")))
+    message = "%d files written from %d source files" % (extracted, len(results) - failed)
+    if failed:
+        operator.report({'WARNING'}, "Extracted: %s, %d source files failed (see console)" % (message, failed))
+    else:
+        operator.report({'INFO'}, "Extracted: " + message)
+
+
+# Staged exports for the Background Export option. The operator keeps running as a modal
+# operator, doing one step of the export on each timer tick until it's done or Esc is pressed.
+
+# Events let through while an export runs, so the view can still be moved around. Everything
+# else (editing, saving, undo...) is held off, since the file is partway through being changed
+# and the stages hold references into it.
+NAVIGATION_EVENTS = {
+    'MOUSEMOVE',
+    'INBETWEEN_MOUSEMOVE',
+    'MIDDLEMOUSE',
+    'WHEELUPMOUSE',
+    'WHEELDOWNMOUSE',
+    'WHEELINMOUSE',
+    'WHEELOUTMOUSE',
+    'TRACKPADPAN',
+    'TRACKPADZOOM',
+    'MOUSEROTATE',
+    'MOUSESMARTZOOM',
+    'WINDOW_DEACTIVATE',
+}
+
+def start_staged_export(operator, context, stages, report):
+    operator._stages = stages
+    operator._report = report
+    operator._prev_mode = mode_toggle(context, 'OBJECT')
+    window_manager = context.window_manager
+    operator._timer = window_manager.event_timer_add(0.01, window=context.window)
+    window_manager.modal_handler_add(operator)
+    window_manager.progress_begin(0, 100)
+    return {'RUNNING_MODAL'}
+
+
+def finish_staged_export(operator, context):
+    window_manager = context.window_manager
+    window_manager.event_timer_remove(operator._timer)
+    window_manager.progress_end()
+    context.workspace.status_text_set(None)
+    mode_toggle(context, operator._prev_mode)
+
+
+def step_staged_export(operator, context, event):
+    if event.type == 'ESC':
+        # Closing the stages runs their cleanup, putting the open file back the way it was
+        operator._stages.close()
+        finish_staged_export(operator, context)
+        operator.report({'WARNING'}, "Export cancelled")
+        return {'CANCELLED'}
+    if event.type != 'TIMER':
+        # Other timers and moving the view around carry on as usual
+        if event.type in NAVIGATION_EVENTS or event.type.startswith(('NDOF_', 'TIMER')):
+            return {'PASS_THROUGH'}
+        return {'RUNNING_MODAL'}
+
+    try:
+        progress, message = next(operator._stages)
+    except StopIteration as done:
+        finish_staged_export(operator, context)
+        operator._report(operator, done.value)
+        return {'FINISHED'}
+    except Exception as error:
+        finish_staged_export(operator, context)
+        operator.report({'ERROR'}, "Export failed: %s" % error)
+        return {'CANCELLED'}
+
+    context.window_manager.progress_update(int(progress * 100))
+    context.workspace.status_text_set("Export to .blend: %s (%d%%). Press Esc to cancel" % (message, progress * 100))
+    return {'RUNNING_MODAL'}
 
 
 class ExportBlenderObjects(Operator, ExportHelper):
@@ -85,9 +225,131 @@ class ExportBlenderObjects(Operator, ExportHelper):
         default=False
     )
 
+    batch_export: BoolProperty(
+        name="One File per Object",
+        description="Write each selected object to its own .blend file",
+        default=False
+    )
+
+    filename_template: StringProperty(
+        name="File Names",
+        description="Output path for each file, relative to the export directory. Use {name} and {collection} as placeholders",
+        default="{collection}/{name}.blend"
+    )
+
+    share_dependencies: BoolProperty(
+        name="Shared Library",
+        description="Write materials, images, node groups and other data used by more than one file to a _shared.blend, and link to it from each file",
+        default=False
+    )
+
+    use_workers: BoolProperty(
+        name="Parallel Export",
+        description="Split the batch across background Blender processes",
+        default=False
+    )
+
+    worker_count: IntProperty(
+        name="Workers",
+        description="Number of background Blender processes to use. 0 uses one per CPU core",
+        default=0,
+        min=0
+    )
+
+    shard: BoolProperty(
+        name="Split into Shards",
+        description="Write the scene to several files, keeping each top level collection together where it fits, plus an index file listing which file each object is in",
+        default=False
+    )
+
+    shard_size: FloatProperty(
+        name="Shard Size (MB)",
+        description="Rough size limit for each file, going by estimated sizes. 0 means no limit",
+        default=512.0,
+        min=0.0
+    )
+
+    shard_objects: IntProperty(
+        name="Objects per Shard",
+        description="Most objects to put in each file. 0 means no limit",
+        default=0,
+        min=0
+    )
+
+    write_proxy: BoolProperty(
+        name="Write Proxy",
+        description="Also write a lightweight _proxy.blend next to each file, with decimated meshes, no modifiers and smaller textures, for faster linking",
+        default=False
+    )
+
+    proxy_ratio: FloatProperty(
+        name="Proxy Detail",
+        description="How much of the geometry to keep in the proxy",
+        default=0.25,
+        min=0.01,
+        max=1.0,
+        subtype='FACTOR'
+    )
+
+    proxy_texture_size: IntProperty(
+        name="Proxy Texture Size",
+        description="Largest width or height of the textures in the proxy. Bigger ones are scaled down and packed",
+        default=256,
+        min=1
+    )
+
+    backlink_proxy: BoolProperty(
+        name="Link Proxy",
+        description="Backlink the proxy instead of the full version. Use Swap Proxies to switch later",
+        default=False
+    )
+
+    texture_store: BoolProperty(
+        name="Store Files in Library",
+        description="Copy the images, fonts and sounds the export uses into the asset library, named by their contents so each is only stored once, and point the exported file at those copies",
+        default=False
+    )
+
+    keep_links: BoolProperty(
+        name="Keep Links",
+        description="Write data that's linked from other .blend files as links to those files, without collecting everything it uses",
+        default=False
+    )
+
+    dry_run: BoolProperty(
+        name="Dry Run",
+        description="Only report what would be exported and roughly how big it would be, without writing anything",
+        default=False
+    )
+
+    incremental: BoolProperty(
+        name="Skip Unchanged",
+        description="Don't rewrite files whose contents haven't changed since they were last exported",
+        default=False
+    )
+
+    profile: EnumProperty(
+        name="Profile",
+        description="Which data to leave out of the exported files. Profiles are set up in the add-on preferences",
+        items=get_profile_items
+    )
+
+    queue_export: BoolProperty(
+        name="Queue for Later",
+        description="Don't write anything yet, just add this export to the queue. Export the queue from File > Export, or on save",
+        default=False
+    )
+
+    background: BoolProperty(
+        name="Background Export",
+        description="Keep Blender responsive while exporting, with progress in the status bar. Press Esc to cancel",
+        default=False
+    )
+
     def invoke(self, context, event):
         preferences = context.preferences.addons[__package__].preferences
         self.directory = preferences.filepath
+        ensure_default_profiles(preferences)
         self.filename = context.active_object.name
         self.export_as_collection = preferences.export_as_collection
         self.backlink = preferences.backlink
@@ -100,6 +362,7 @@ class ExportBlenderObjects(Operator, ExportHelper):
     def invoke(self, context, event):
         preferences = context.preferences.addons[__package__].preferences
         self.directory = preferences.filepath
+        ensure_default_profiles(preferences)
         self.filename = context.active_object.name
         self.export_as_collection = preferences.export_as_collection
         self.backlink = preferences.backlink
@@ -116,12 +379,40 @@ class ExportBlenderObjects(Operator, ExportHelper):
         col.prop(self, "export_selected")
         if self.export_selected:
             box = col.box()
+            box.prop(self, "batch_export")
+            if self.batch_export:
+                box.prop(self, "filename_template")
+                box.prop(self, "share_dependencies")
+                row = box.row()
+                row.prop(self, "use_workers")
+                if self.use_workers:
+                    row.prop(self, "worker_count")
             box.prop(self, "export_as_collection")
             if self.export_as_collection:
                 box.prop(self, "collection_name", icon="COLLECTION_NEW", icon_only=True)
             if bpy.app.version > (2, 93, 0):
                 box.prop(self, "mark_asset")
             box.prop(self, "backlink")
+        else:
+            box = col.box()
+            box.prop(self, "shard")
+            if self.shard:
+                box.prop(self, "shard_size")
+                box.prop(self, "shard_objects")
+        box = col.box()
+        box.prop(self, "write_proxy")
+        if self.write_proxy:
+            box.prop(self, "proxy_ratio")
+            box.prop(self, "proxy_texture_size")
+            if self.export_selected and self.backlink:
+                box.prop(self, "backlink_proxy")
+        col.prop(self, "profile")
+        col.prop(self, "texture_store")
+        col.prop(self, "keep_links")
+        col.prop(self, "incremental")
+        col.prop(self, "background")
+        col.prop(self, "queue_export")
+        col.prop(self, "dry_run")
 
     def execute(self, context):
         export_settings = {
@@ -130,7 +421,27 @@ class ExportBlenderObjects(Operator, ExportHelper):
             "export_selected": self.export_selected,
             "export_as_collection": self.export_as_collection,
             "collection_name": self.collection_name,
-            "backlink": self.backlink
+            "backlink": self.backlink,
+            "directory": os.path.dirname(self.filepath),
+            "filename_template": self.filename_template,
+            "preview_timeout": context.preferences.addons[__package__].preferences.preview_timeout,
+            "preview_cache_size": context.preferences.addons[__package__].preferences.preview_cache_size * 1024 * 1024,
+            "incremental": self.incremental,
+            "share_dependencies": self.share_dependencies,
+            "log_filepath": context.preferences.addons[__package__].preferences.log_filepath,
+            "library_path": context.preferences.addons[__package__].preferences.filepath,
+            "track_changes": context.preferences.addons[__package__].preferences.track_changes,
+            "stage_directory": context.preferences.addons[__package__].preferences.stage_directory,
+            "shard": self.shard,
+            "shard_size": self.shard_size * 1024 * 1024,
+            "shard_objects": self.shard_objects,
+            "keep_links": self.keep_links,
+            "texture_store": self.texture_store,
+            "proxy_ratio": self.proxy_ratio,
+            "proxy_texture_size": self.proxy_texture_size,
+            "write_proxy": self.write_proxy,
+            "backlink_proxy": self.backlink_proxy,
+            "strip": get_profile_strip(context.preferences.addons[__package__].preferences, self.profile)
         }
 
         if bpy.app.version > (2, 93, 0):
@@ -138,15 +449,75 @@ class ExportBlenderObjects(Operator, ExportHelper):
         else:
             export_settings["mark_asset"] = False
 
+        if self.dry_run:
+            message = dry_run_blend_objects(context, export_settings, self.export_selected and self.batch_export)
+            self.report({'INFO'}, "Dry run: " + message)
+            return {'FINISHED'}
+
+        if self.queue_export:
+            if not self.export_selected and self.shard:
+                self.report({'ERROR'}, "Shards can't be queued, export them straight away instead")
+                return {'CANCELLED'}
+            if self.write_proxy or export_settings["strip"]:
+                self.report({'ERROR'}, "Proxies and slimmed exports can't be queued, export them straight away instead")
+                return {'CANCELLED'}
+            if self.export_selected and self.batch_export:
+                items = get_batch_items(context, export_settings)
+            else:
+                items = [(export_settings, get_export_objects(context, export_settings))]
+            queue_objects(items)
+            report_queued(self, len(items))
+            return {'FINISHED'}
+
+        # Slimming and proxies work on the written files, so the export itself doesn't backlink
+        # and finish_exports does it afterwards with the items worked out up front
+        finish_items = None
+        finish_settings = export_settings
+        if self.write_proxy or export_settings["strip"]:
+            if self.export_selected and self.batch_export:
+                finish_items = get_batch_items(context, export_settings)
+            elif not self.export_selected and self.shard:
+                finish_items = get_shard_items(context, export_settings)
+            else:
+                finish_items = [(export_settings, get_export_objects(context, export_settings))]
+            export_settings = dict(export_settings, backlink=False)
+
+        if self.background:
+            if self.export_selected and self.batch_export and self.use_workers:
+                stages = parallel_export_stages(context, export_settings, self.worker_count)
+                report = report_batch_results
+            else:
+                stages = export_stages(context, export_settings, self.export_selected and self.batch_export)
+                report = report_counts
+            if finish_items is not None:
+                stages = export_and_finish_stages(stages, finish_items, finish_settings, self.worker_count)
+            return start_staged_export(self, context, stages, report)
+
         # switching to object mode prevents unexpected behavior
         prev_mode = mode_toggle(context, 'OBJECT')
 
-        export_blend_objects(context, export_settings)
+        report = report_counts
+        if self.export_selected and self.batch_export and self.use_workers:
+            result = export_blend_batch_parallel(context, export_settings, self.worker_count)
+            report = report_batch_results
+        elif self.export_selected and self.batch_export:
+            result = export_blend_batch(context, export_settings)
+        elif not self.export_selected and self.shard:
+            result = export_blend_shards(context, export_settings)
+        else:
+            result = export_blend_objects(context, export_settings)
+
+        if finish_items is not None:
+            finish_exports(result, finish_items, finish_settings, self.worker_count)
+        report(self, result)
 
         mode_toggle(context, prev_mode)
 
         return {'FINISHED'}
 
+    def modal(self, context, event):
+        return step_staged_export(self, context, event)
+
 class ExportBlenderCollection(Operator, ExportHelper):
     """Export a selected collection to a separate .blend file"""
     bl_idname = "export_collection.blend"
@@ -181,9 +552,71 @@ class ExportBlenderCollection(Operator, ExportHelper):
         default=False
     )
 
+    batch_export: BoolProperty(
+        name="One File per Collection",
+        description="Write each selected collection to its own .blend file",
+        default=False
+    )
+
+    filename_template: StringProperty(
+        name="File Names",
+        description="Output path for each file, relative to the export directory. Use {name} and {collection} as placeholders",
+        default="{collection}/{name}.blend"
+    )
+
+    share_dependencies: BoolProperty(
+        name="Shared Library",
+        description="Write materials, images, node groups and other data used by more than one file to a _shared.blend, and link to it from each file",
+        default=False
+    )
+
+    use_workers: BoolProperty(
+        name="Parallel Export",
+        description="Split the batch across background Blender processes",
+        default=False
+    )
+
+    worker_count: IntProperty(
+        name="Workers",
+        description="Number of background Blender processes to use. 0 uses one per CPU core",
+        default=0,
+        min=0
+    )
+
+    dry_run: BoolProperty(
+        name="Dry Run",
+        description="Only report what would be exported and roughly how big it would be, without writing anything",
+        default=False
+    )
+
+    incremental: BoolProperty(
+        name="Skip Unchanged",
+        description="Don't rewrite files whose contents haven't changed since they were last exported",
+        default=False
+    )
+
+    profile: EnumProperty(
+        name="Profile",
+        description="Which data to leave out of the exported files. Profiles are set up in the add-on preferences",
+        items=get_profile_items
+    )
+
+    queue_export: BoolProperty(
+        name="Queue for Later",
+        description="Don't write anything yet, just add this export to the queue. Export the queue from File > Export, or on save",
+        default=False
+    )
+
+    background: BoolProperty(
+        name="Background Export",
+        description="Keep Blender responsive while exporting, with progress in the status bar. Press Esc to cancel",
+        default=False
+    )
+
     def invoke(self, context, event):
         preferences = context.preferences.addons[__package__].preferences
         self.directory = preferences.filepath
+        ensure_default_profiles(preferences)
         self.filename = context.collection.name
         self.backlink = preferences.backlink
         if bpy.app.version > (2, 93, 0):
@@ -194,6 +627,7 @@ class ExportBlenderCollection(Operator, ExportHelper):
     def invoke(self, context, event):
         preferences = context.preferences.addons[__package__].preferences
         self.directory = preferences.filepath
+        ensure_default_profiles(preferences)
         self.filename = context.collection.name
         self.backlink = preferences.backlink
         if bpy.app.version > (2, 93, 0):
@@ -207,23 +641,87 @@ class ExportBlenderCollection(Operator, ExportHelper):
             "filepath": self.filepath,
             "export_selected": True,
             "export_as_collection": True,
-            "collection_name": context.selected_ids[0].name, #XXX Assumes only one collection is selected
-            "backlink": self.backlink
+            "collection_name": context.selected_ids[0].name, # Only used when not exporting a batch
+            "collections": [id for id in context.selected_ids if isinstance(id, bpy.types.Collection)],
+            "backlink": self.backlink,
+            "directory": os.path.dirname(self.filepath),
+            "filename_template": self.filename_template,
+            "preview_timeout": context.preferences.addons[__package__].preferences.preview_timeout,
+            "preview_cache_size": context.preferences.addons[__package__].preferences.preview_cache_size * 1024 * 1024,
+            "incremental": self.incremental,
+            "share_dependencies": self.share_dependencies,
+            "log_filepath": context.preferences.addons[__package__].preferences.log_filepath,
+            "library_path": context.preferences.addons[__package__].preferences.filepath,
+            "track_changes": context.preferences.addons[__package__].preferences.track_changes,
+            "stage_directory": context.preferences.addons[__package__].preferences.stage_directory,
+            "strip": get_profile_strip(context.preferences.addons[__package__].preferences, self.profile)
         }
         if bpy.app.version > (2, 93, 0):
             export_settings["mark_asset"] = self.mark_asset
         else:
             export_settings["mark_asset"] = False
 
+        if self.dry_run:
+            message = dry_run_blend_objects(context, export_settings, self.batch_export)
+            self.report({'INFO'}, "Dry run: " + message)
+            return {'FINISHED'}
+
+        if self.queue_export:
+            if export_settings["strip"]:
+                self.report({'ERROR'}, "Slimmed exports can't be queued, export them straight away instead")
+                return {'CANCELLED'}
+            if self.batch_export:
+                items = get_batch_items(context, export_settings)
+            else:
+                items = [(export_settings, get_export_objects(context, export_settings))]
+            queue_objects(items)
+            report_queued(self, len(items))
+            return {'FINISHED'}
+
+        # Slimming works on the written files, so backlinking waits for finish_exports
+        finish_items = None
+        finish_settings = export_settings
+        if export_settings["strip"]:
+            if self.batch_export:
+                finish_items = get_batch_items(context, export_settings)
+            else:
+                finish_items = [(export_settings, get_export_objects(context, export_settings))]
+            export_settings = dict(export_settings, backlink=False)
+
+        if self.background:
+            if self.batch_export and self.use_workers:
+                stages = parallel_export_stages(context, export_settings, self.worker_count)
+                report = report_batch_results
+            else:
+                stages = export_stages(context, export_settings, self.batch_export)
+                report = report_counts
+            if finish_items is not None:
+                stages = export_and_finish_stages(stages, finish_items, finish_settings, self.worker_count)
+            return start_staged_export(self, context, stages, report)
+
         # switching to object mode prevents unexpected behavior
         prev_mode = mode_toggle(context, 'OBJECT')
 
-        export_blend_objects(context, export_settings)
+        report = report_counts
+        if self.batch_export and self.use_workers:
+            result = export_blend_batch_parallel(context, export_settings, self.worker_count)
+            report = report_batch_results
+        elif self.batch_export:
+            result = export_blend_batch(context, export_settings)
+        else:
+            result = export_blend_objects(context, export_settings)
+
+        if finish_items is not None:
+            finish_exports(result, finish_items, finish_settings, self.worker_count)
+        report(self, result)
 
         mode_toggle(context, prev_mode)
 
         return {'FINISHED'}
 
+    def modal(self, context, event):
+        return step_staged_export(self, context, event)
+
 
 class ExportBlenderNodes(Operator, ExportHelper):
     """Export selected nodes to a separate .blend file"""
@@ -277,6 +775,18 @@ class ExportBlenderNodes(Operator, ExportHelper):
         default=False
     )
 
+    queue_export: BoolProperty(
+        name="Queue for Later",
+        description="Don't write anything yet, just add this export to the queue. Export the queue from File > Export, or on save",
+        default=False
+    )
+
+    dry_run: BoolProperty(
+        name="Dry Run",
+        description="Only report what would be exported and roughly how big it would be, without writing anything",
+        default=False
+    )
+
     def invoke(self, context, event):
         preferences = context.preferences.addons[__package__].preferences
         self.directory = preferences.filepath
@@ -316,6 +826,8 @@ class ExportBlenderNodes(Operator, ExportHelper):
             col = layout.column()
             col.prop(self, "group_name", icon="NODETREE", icon_only=True)
             col.prop(self, "backlink")
+        layout.prop(self, "queue_export")
+        layout.prop(self, "dry_run")
 
     def execute(self, context):
         export_settings = {
@@ -323,14 +835,357 @@ class ExportBlenderNodes(Operator, ExportHelper):
             "export_selected": self.export_selected,
             "export_as_group": self.export_as_group,
             "group_name": self.group_name,
-            "backlink": self.backlink
+            "backlink": self.backlink,
+            "log_filepath": context.preferences.addons[__package__].preferences.log_filepath,
+            "library_path": context.preferences.addons[__package__].preferences.filepath
         }
 
+        if self.dry_run:
+            self.report({'INFO'}, "Dry run: " + dry_run_blend_nodes(context, export_settings))
+            return {'FINISHED'}
+
+        if self.queue_export:
+            node_tree = context.active_node.id_data
+            owner = get_node_tree_owner(node_tree)
+            nodes = [node for node in node_tree.nodes if node.select or not self.export_selected]
+            queue_export('NODES', export_settings, owner=(owner.id_type, owner.name), nodes=[node.name for node in nodes])
+            report_queued(self, 1)
+            return {'FINISHED'}
+
         # switching to object mode prevents unexpected behavior
         prev_mode = mode_toggle(context, 'OBJECT')
 
-        export_blend_nodes(context, export_settings)
+        self.report({'INFO'}, "Exported nodes (%s)" % export_blend_nodes(context, export_settings))
 
         mode_toggle(context, prev_mode)
 
         return {'FINISHED'}
+
+
+class ExportBlenderNodeGroups(Operator, ExportHelper):
+    """Export many node groups at once, each to its own .blend file or all to one library file"""
+    bl_idname = "export_node_groups.blend"
+    bl_label = "Export Node Groups"
+
+    filename_ext = ".blend"
+
+    filter_glob: StringProperty(
+        default="*.blend",
+        options={'HIDDEN'},
+        maxlen=255,  # Max internal buffer length, longer would be clamped.
+    )
+
+    directory: StringProperty(
+        default="//"
+    )
+
+    filename: StringProperty(
+        default=""
+    )
+
+    # Operator properties
+    node_group_selection: EnumProperty(
+        name="Node Groups",
+        items=(
+            ('ALL', "All", "Every node group in this file"),
+            ('FAKE_USER', "Fake User", "Node groups with a fake user"),
+            ('ASSETS', "Assets", "Node groups marked as assets"),
+        ),
+        default='FAKE_USER'
+    )
+
+    node_group_tag: StringProperty(
+        name="Tag",
+        description="Only export node groups with this asset tag. Leave empty to ignore tags",
+        default=""
+    )
+
+    name_filter: StringProperty(
+        name="Names",
+        description="Only export node groups with names matching this pattern, e.g. NG_*. Leave empty for all",
+        default=""
+    )
+
+    batch_export: BoolProperty(
+        name="One File per Group",
+        description="Write each node group to its own .blend file. Otherwise they all go in the chosen file",
+        default=True
+    )
+
+    filename_template: StringProperty(
+        name="File Names",
+        description="Output path for each file, relative to the export directory. Use {name} and {type} (shader, geometry...) as placeholders",
+        default="{type}/{name}.blend"
+    )
+
+    mark_asset: BoolProperty(
+        name="Mark as Asset",
+        description="Mark the node groups as assets for visibility in the Asset Browser",
+        default=False
+    )
+
+    incremental: BoolProperty(
+        name="Skip Unchanged",
+        description="Don't rewrite files whose contents haven't changed since they were last exported",
+        default=False
+    )
+
+    def invoke(self, context, event):
+        preferences = context.preferences.addons[__package__].preferences
+        self.directory = preferences.filepath
+        self.filename = "node_groups"
+        if bpy.app.version > (2, 93, 0):
+            self.mark_asset = preferences.mark_asset
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def draw(self, context):
+        layout = self.layout
+        col = layout.column()
+        col.prop(self, "node_group_selection")
+        col.prop(self, "node_group_tag")
+        col.prop(self, "name_filter")
+        box = col.box()
+        box.prop(self, "batch_export")
+        if self.batch_export:
+            box.prop(self, "filename_template")
+        if bpy.app.version > (2, 93, 0):
+            col.prop(self, "mark_asset")
+        col.prop(self, "incremental")
+
+    def execute(self, context):
+        export_settings = {
+            "filepath": self.filepath,
+            "directory": os.path.dirname(self.filepath),
+            "node_group_selection": self.node_group_selection,
+            "node_group_tag": self.node_group_tag,
+            "name_filter": self.name_filter,
+            "batch_export": self.batch_export,
+            "filename_template": self.filename_template,
+            "mark_asset": self.mark_asset and bpy.app.version > (2, 93, 0),
+            "incremental": self.incremental,
+            "preview_timeout": context.preferences.addons[__package__].preferences.preview_timeout,
+            "preview_cache_size": context.preferences.addons[__package__].preferences.preview_cache_size * 1024 * 1024,
+            "log_filepath": context.preferences.addons[__package__].preferences.log_filepath,
+            "library_path": context.preferences.addons[__package__].preferences.filepath
+        }
+        report_counts(self, export_blend_node_groups(export_settings))
+        return {'FINISHED'}
+
+
+class ExportQueuedBlends(Operator):
+    """Write every export in the queue, all in one go"""
+    bl_idname = "export_scene.blend_queued"
+    bl_label = "Export Queued .blend Files"
+
+    discard: BoolProperty(
+        name="Discard",
+        description="Empty the queue without exporting anything",
+        default=False,
+        options={'SKIP_SAVE'}
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return bool(get_queued_exports())
+
+    def execute(self, context):
+        if self.discard:
+            clear_queue()
+            self.report({'INFO'}, "Export queue emptied")
+            return {'FINISHED'}
+        # switching to object mode prevents unexpected behavior
+        prev_mode = mode_toggle(context, 'OBJECT')
+        report_counts(self, export_queued(get_queue_settings(context.preferences.addons[__package__].preferences)))
+        mode_toggle(context, prev_mode)
+        return {'FINISHED'}
+
+
+class ExportChangedBlends(Operator):
+    """Re-export the .blend files whose objects, materials or other data changed since they were exported"""
+    bl_idname = "export_scene.blend_changed"
+    bl_label = "Re-export Changed .blend Files"
+
+    @classmethod
+    def poll(cls, context):
+        return bool(get_changed_exports())
+
+    def execute(self, context):
+        # switching to object mode prevents unexpected behavior
+        prev_mode = mode_toggle(context, 'OBJECT')
+        report_counts(self, export_changed())
+        mode_toggle(context, prev_mode)
+        return {'FINISHED'}
+
+
+class SwapBlendProxies(Operator):
+    """Switch objects linked from exported .blend files between the proxy and the full version"""
+    bl_idname = "object.blend_swap_proxies"
+    bl_label = "Swap Proxies"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    mode: EnumProperty(
+        name="Use",
+        items=(
+            ('TOGGLE', "Toggle", "Switch each library to the other version"),
+            ('PROXY', "Proxy", "Link the proxies"),
+            ('FULL', "Full", "Link the full versions"),
+        ),
+        default='TOGGLE'
+    )
+
+    def execute(self, context):
+        # Only the selected objects' libraries, or every library if nothing's selected
+        if context.selected_objects:
+            libraries = get_swap_libraries(context.selected_objects)
+        else:
+            libraries = set(bpy.data.libraries)
+        swapped = 0
+        for library in libraries:
+            if self.mode == 'TOGGLE':
+                use_proxy = not is_proxy_path(library.filepath)
+            else:
+                use_proxy = self.mode == 'PROXY'
+            if swap_library(library, use_proxy):
+                swapped += 1
+        invalidate_dependency_cache()
+        self.report({'INFO'}, "Swapped %d of %d libraries" % (swapped, len(libraries)))
+        return {'FINISHED'}
+
+
+class ExtractBlendAssets(Operator):
+    """Write the collections or objects in every .blend file in a folder to their own files, without opening them"""
+    bl_idname = "export_scene.blend_extract"
+    bl_label = "Extract from .blend Files"
+
+    directory: StringProperty(
+        subtype='DIR_PATH'
+    )
+
+    filter_folder: BoolProperty(
+        default=True,
+        options={'HIDDEN'}
+    )
+
+    output_directory: StringProperty(
+        name="Output",
+        description="Folder to write to, usually an asset library",
+        subtype='DIR_PATH',
+        default=""
+    )
+
+    extract: EnumProperty(
+        name="Extract",
+        items=(
+            ('COLLECTIONS', "Collections", "One file per collection. Collections inside another one go along with it"),
+            ('OBJECTS', "Objects", "One file per object"),
+        ),
+        default='COLLECTIONS'
+    )
+
+    name_filter: StringProperty(
+        name="Names",
+        description="Only extract names matching this pattern, e.g. SM_*. Leave empty for everything",
+        default=""
+    )
+
+    filename_template: StringProperty(
+        name="File Names",
+        description="Output path for each file, relative to the output folder. Use {name} and {source} (the source file's path in the folder) as placeholders",
+        default="{source}/{name}.blend"
+    )
+
+    mark_asset: BoolProperty(
+        name="Mark as Asset",
+        description="Mark everything extracted as an asset for visibility in the Asset Browser",
+        default=False
+    )
+
+    worker_count: IntProperty(
+        name="Workers",
+        description="Number of background Blender processes to use. 0 uses one per CPU core",
+        default=0,
+        min=0
+    )
+
+    def invoke(self, context, event):
+        preferences = context.preferences.addons[__package__].preferences
+        self.output_directory = preferences.filepath
+        if bpy.app.version > (2, 93, 0):
+            self.mark_asset = preferences.mark_asset
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def draw(self, context):
+        layout = self.layout
+        col = layout.column()
+        col.prop(self, "output_directory")
+        col.prop(self, "extract")
+        col.prop(self, "name_filter")
+        col.prop(self, "filename_template")
+        if bpy.app.version > (2, 93, 0):
+            col.prop(self, "mark_asset")
+        col.prop(self, "worker_count")
+
+    def execute(self, context):
+        if not self.output_directory:
+            self.report({'ERROR'}, "Choose an output folder to extract to")
+            return {'CANCELLED'}
+        export_settings = {
+            "is_collection": self.extract == 'COLLECTIONS',
+            "source_directory": bpy.path.abspath(self.directory),
+            "directory": bpy.path.abspath(self.output_directory),
+            "filename_template": self.filename_template,
+            "name_filter": self.name_filter,
+            "mark_asset": self.mark_asset and bpy.app.version > (2, 93, 0),
+            "preview_timeout": context.preferences.addons[__package__].preferences.preview_timeout,
+            "preview_cache_size": context.preferences.addons[__package__].preferences.preview_cache_size * 1024 * 1024,
+            "library_path": context.preferences.addons[__package__].preferences.filepath,
+        }
+        # The work happens in the background Blenders, so keep this one responsive meanwhile
+        stages = extract_stages(export_settings, self.worker_count)
+        return start_staged_export(self, context, stages, report_extract_results)
+
+    def modal(self, context, event):
+        return step_staged_export(self, context, event)
+
+
+class ShowBlendTransfers(Operator):
+    """Show exported files that are still being moved from the local staging folder to the library"""
+    bl_idname = "export_scene.blend_transfers"
+    bl_label = "Library Transfers"
+
+    retry_failed: BoolProperty(
+        name="Retry Failed",
+        description="Try moving the files that failed again",
+        default=True
+    )
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self, width=500)
+
+    def draw(self, context):
+        layout = self.layout
+        transfers = transfer_queue.get_transfers()
+        if not transfers:
+            layout.label(text="Nothing to transfer")
+            return
+        icons = {'QUEUED': 'TIME', 'MOVING': 'SORTTIME', 'RETRYING': 'FILE_REFRESH', 'FINISHED': 'CHECKMARK', 'FAILED': 'ERROR'}
+        col = layout.column(align=True)
+        for transfer in transfers:
+            row = col.row()
+            row.label(text=os.path.basename(transfer.target), icon=icons[transfer.status])
+            status = transfer.status.title()
+            if transfer.error:
+                status += ": " + transfer.error
+            row.label(text=status)
+        if any(transfer.status == 'FAILED' for transfer in transfers):
+            layout.prop(self, "retry_failed")
+
+    def execute(self, context):
+        transfer_queue.clear_finished()
+        if self.retry_failed:
+            retried = transfer_queue.retry_failed()
+            if retried:
+                self.report({'INFO'}, "Retrying %d transfers" % retried)
+        return {'FINISHED'}
@@ -0,0 +1,160 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+Pull collections or objects out of every .blend file in a directory tree, one output file
+each, without opening the source files. Run it from the command line with:
+
+    blender -b --python-expr "from io_export_blend import extract; extract.main()" -- source_dir output_dir
+
+'''
+
+
+import bpy
+import argparse
+import json
+import os
+import sys
+import threading
+
+# Local imports
+from .functions import run_stages, update_asset_index, DEFAULT_PREVIEW_TIMEOUT
+from .proxies import is_proxy_path
+from .workers import WorkerPool, get_job_settings
+
+
+def find_blend_files(directory, skip_directory=None):
+    # Every .blend under directory, leaving out our own output in case it's in there too
+    directory = os.path.abspath(directory)
+    skip_directory = os.path.abspath(skip_directory) if skip_directory else None
+    sources = []
+    for root, dirnames, filenames in os.walk(directory):
+        if skip_directory and os.path.commonpath([root, skip_directory]) == skip_directory:
+            dirnames[:] = []
+            continue
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(".blend") and not is_proxy_path(filename):
+                sources.append(os.path.join(root, filename))
+    return sources
+
+
+def get_extract_jobs(sources, export_settings):
+    source_dir = os.path.abspath(export_settings["source_directory"])
+    settings = get_job_settings(dict(
+        export_settings,
+        export_selected=True,
+        export_as_collection=export_settings["is_collection"],
+        backlink=False,
+    ))
+    jobs = []
+    for source in sources:
+        jobs.append({
+            "kind": 'EXTRACT_FILE',
+            "source": source,
+            "source_name": os.path.splitext(os.path.relpath(source, source_dir))[0].replace(os.sep, "/"),
+            "directory": os.path.abspath(bpy.path.abspath(export_settings["directory"])),
+            "filename_template": export_settings["filename_template"],
+            "name_filter": export_settings["name_filter"],
+            "settings": settings,
+        })
+    return jobs
+
+
+def extract_stages(export_settings, worker_count=0):
+    # Extraction split into steps, like workers.parallel_export_stages. Each source file is one
+    # job for the worker pool. Closing it early stops the workers.
+    sources = find_blend_files(export_settings["source_directory"], export_settings["directory"])
+    yield 0.0, "Found %d files" % len(sources)
+    if not sources:
+        return []
+
+    jobs = get_extract_jobs(sources, export_settings)
+    pool = WorkerPool(None, worker_count)
+    outcome = []
+    thread = threading.Thread(target=lambda: outcome.append(pool.run(jobs)), daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            yield 0.95 * pool.finished / len(jobs), "Extracted %d of %d files" % (pool.finished, len(jobs))
+    finally:
+        if thread.is_alive():
+            pool.cancel()
+            thread.join()
+    results = outcome[0]
+
+    for job, result in zip(jobs, results):
+        result.setdefault("filepath", job["source"])
+    # Workers only write the files, the index is kept up to date from here
+    update_asset_index(export_settings, {file["filepath"]: file["assets"]
+                                         for result in results if result["status"] == 'FINISHED'
+                                         for file in result["files"]})
+    return results
+
+
+def extract_assets(export_settings, worker_count=0):
+    print("Extracting assets to .blend files...")
+    return run_stages(extract_stages(export_settings, worker_count), interval=0.05)
+
+
+def main(argv=None):
+    if argv is None:
+        # Blender ignores everything after "--", so that's where our arguments go
+        argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(
+        prog="blender -b --python-expr \"from io_export_blend import extract; extract.main()\" --",
+        description="Write the collections or objects in every .blend file under a directory to their own files",
+    )
+    parser.add_argument("source", help="Directory to look for .blend files in, including subdirectories")
+    parser.add_argument("output", help="Directory to write to, usually an asset library")
+    parser.add_argument("--objects", action="store_true", help="Extract objects instead of collections")
+    parser.add_argument("--filter", default="", help="Only extract names matching this pattern, e.g. \"SM_*\"")
+    parser.add_argument("--template", default="{source}/{name}.blend", help="Output path for each file, relative to the output directory")
+    parser.add_argument("--mark-asset", action="store_true", help="Mark everything extracted as an asset")
+    parser.add_argument("--workers", type=int, default=0, help="Number of background Blender processes, 0 for one per CPU core")
+    parser.add_argument("--summary", help="Write the JSON results to this file as well as stdout")
+    args = parser.parse_args(argv)
+
+    export_settings = {
+        "is_collection": not args.objects,
+        "source_directory": args.source,
+        "directory": args.output,
+        "filename_template": args.template,
+        "name_filter": args.filter,
+        "mark_asset": args.mark_asset,
+        "preview_timeout": DEFAULT_PREVIEW_TIMEOUT,
+        "library_path": args.output,
+    }
+    results = extract_assets(export_settings, args.workers)
+
+    summary = {
+        "extracted": sum(len(result["files"]) for result in results if result["status"] == 'FINISHED'),
+        "failed": sum(1 for result in results if result["status"] != 'FINISHED'),
+        "results": results,
+    }
+    summary_json = json.dumps(summary, indent=2)
+    print(summary_json)
+    if args.summary:
+        with open(args.summary, "w") as summary_file:
+            summary_file.write(summary_json)
+
+    if summary["failed"]:
+        sys.exit(1)
@@ -24,169 +24,1617 @@ Created by Jason van Gumster
 
 
 import bpy
+import array
+import base64
+import fnmatch
+import json
+import os
+import sys
 import time
 
-def actually_export(export_scene, filepath):
-    # Set the export scene as the active scene
-    bpy.context.window.scene = export_scene
-    # Remove all other scenes
-    for scn in bpy.data.scenes:
-        if scn != export_scene:
-            bpy.data.scenes.remove(scn)
+from bpy.app.handlers import persistent
+from contextlib import contextmanager, nullcontext
 
-    # Go through and remove all the orphans that've been created
-    bpy.data.orphans_purge(do_recursive = True)
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
 
-    # Save data to desired path
-    bpy.ops.wm.save_as_mainfile(filepath=filepath, copy=True)
+# Local imports
+from .asset_index import update_index, refresh_index
+from .hashing import hash_export, get_id_key, HashManifests, write_manifest_changes
+from .nodes import build_node_group, replace_with_group
+from .export_queue import get_queued_exports, clear_queue
+from .tracking import track_export, get_tracked_export, get_changed_exports, mark_unchanged
+from .texture_store import store_external_files, restore_external_files
+from .transfers import transfer_queue, get_stage_path, relocate_paths, restore_paths
+from .preview_cache import get_preview_key, get_export_preview_key, load_preview, save_preview, trim_cache, DEFAULT_CACHE_SIZE
+from .utilities import remove_id, format_size, write_json, ID_TYPE_COLLECTIONS
 
-    # Undo the scene deletion stuff
-    #XXX Yes, this *is* a kind of kludgey way to put everything back... but it works!
-    bpy.ops.ed.undo_push()
-    bpy.ops.ed.undo()
 
+# Dependency data is expensive to build on big files, so it's cached until the depsgraph
+# reports a change (see invalidate_dependency_cache)
+_dependency_cache = {
+    "map": None,
+    "sizes": {},
+}
 
-def export_blend_objects(context, export_settings):
-    print("Exporting objects to .blend...")
-    objects = []
-    object_names = []
+
+def get_dependency_map():
+    if _dependency_cache["map"] is None:
+        # bpy.data.user_map() gives the users of every ID; invert it so each ID
+        # maps to the IDs it depends on
+        dependency_map = {}
+        for id_data, users in bpy.data.user_map().items():
+            for user in users:
+                dependency_map.setdefault(user, set()).add(id_data)
+        _dependency_cache["map"] = dependency_map
+    return _dependency_cache["map"]
+
+
+def get_peak_memory():
+    # Peak resident memory of this Blender process in bytes, or None where it can't be measured.
+    # It's the peak over the whole session, so it only goes up when a phase sets a new high.
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux kilobytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def count_ids():
+    return sum(len(getattr(bpy.data, attr, ())) for attr in ID_TYPE_COLLECTIONS.values())
+
+
+class ExportLog:
+    # Times each phase of an export, along with peak memory and the number of datablocks
+    # in the file after it, so slow exports can be narrowed down and compared across versions
+    def __init__(self, operation, filepath):
+        self.operation = operation
+        self.filepath = filepath
+        self.phases = []
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append({
+                "name": name,
+                "time": time.perf_counter() - start,
+                "peak_memory": get_peak_memory(),
+                "ids": count_ids(),
+            })
+
+    def summary(self):
+        return ", ".join("%s %.2fs" % (phase["name"], phase["time"]) for phase in self.phases)
+
+    def write(self, log_filepath, **extra):
+        # Append one JSON object per line, so runs can be compared over time
+        from . import bl_info
+        record = {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "operation": self.operation,
+            "filepath": self.filepath,
+            "source": bpy.data.filepath,
+            "addon_version": ".".join(str(number) for number in bl_info["version"]),
+            "blender_version": bpy.app.version_string,
+            "time": time.perf_counter() - self.start,
+            "peak_memory": get_peak_memory(),
+            "phases": self.phases,
+        }
+        record.update(extra)
+        log_filepath = bpy.path.abspath(log_filepath)
+        try:
+            if os.path.dirname(log_filepath):
+                os.makedirs(os.path.dirname(log_filepath), exist_ok=True)
+            with open(log_filepath, "a") as log_file:
+                log_file.write(json.dumps(record) + "\n")
+        except OSError as error:
+            # A broken log shouldn't break the export
+            print("Couldn't write export log %s: %s" % (log_filepath, error))
+
+
+def log_phase(log, name):
+    # Lets the lower level functions time their phases only when someone's listening
+    if log is None:
+        return nullcontext()
+    return log.phase(name)
+
+
+def finish_log(log, export_settings, counts=None):
+    if export_settings.get("log_filepath"):
+        log.write(export_settings["log_filepath"], counts=counts)
+    print("Export phases: " + log.summary())
+
+
+def count_written(counts, filepath):
+    # Which files were written goes along with the counts, for whatever works on them afterwards
+    counts["written"] += 1
+    counts.setdefault("files", []).append(filepath)
+
+
+@persistent
+def invalidate_dependency_cache(*args):
+    # Registered on depsgraph updates, undo/redo and file loads. Only drops the cache;
+    # it gets rebuilt the next time something asks for it.
+    _dependency_cache["map"] = None
+    _dependency_cache["sizes"].clear()
+
+
+def collect_dependencies(ids, dependency_map=None, keep_links=False):
+    # Walk the dependency map to get the full closure of the given IDs.
+    # With keep_links, stop at linked IDs: they're written as references to their library,
+    # which already has everything they use.
+    if dependency_map is None:
+        dependency_map = get_dependency_map()
+    closure = set()
+    pending = list(ids)
+    while pending:
+        id_data = pending.pop()
+        if id_data in closure:
+            continue
+        closure.add(id_data)
+        if keep_links and id_data.library:
+            continue
+        pending.extend(dependency_map.get(id_data, ()))
+    return closure
+
+
+# Rough bytes per element for mesh attribute data types
+ATTRIBUTE_SIZES = {
+    'FLOAT': 4,
+    'INT': 4,
+    'FLOAT_VECTOR': 12,
+    'FLOAT_COLOR': 16,
+    'BYTE_COLOR': 4,
+    'STRING': 8,
+    'BOOLEAN': 1,
+    'FLOAT2': 8,
+    'INT8': 1,
+    'INT32_2D': 8,
+    'QUATERNION': 16,
+    'FLOAT4X4': 64,
+}
+
+# Rough overhead of a datablock in a .blend, regardless of its contents
+ID_OVERHEAD = 1024
+
+
+def estimate_id_size(id_data):
+    # A ballpark figure for how much an ID adds to a .blend. Only meant for dry runs.
+    size = _dependency_cache["sizes"].get(id_data)
+    if size is not None:
+        return size
+
+    size = ID_OVERHEAD
+    if isinstance(id_data, bpy.types.Mesh):
+        domains = {
+            'POINT': len(id_data.vertices),
+            'EDGE': len(id_data.edges),
+            'FACE': len(id_data.polygons),
+            'CORNER': len(id_data.loops),
+        }
+        size += domains['POINT'] * 12 + domains['EDGE'] * 8 + domains['FACE'] * 12 + domains['CORNER'] * 8
+        for attribute in id_data.attributes:
+            size += domains.get(attribute.domain, 0) * ATTRIBUTE_SIZES.get(attribute.data_type, 4)
+    elif isinstance(id_data, bpy.types.Curve):
+        for spline in id_data.splines:
+            size += len(spline.points) * 32 + len(spline.bezier_points) * 64
+    elif isinstance(id_data, bpy.types.Action):
+        for fcurve in id_data.fcurves:
+            size += 256 + len(fcurve.keyframe_points) * 48
+    elif isinstance(id_data, bpy.types.NodeTree):
+        size += len(id_data.nodes) * 1024 + len(id_data.links) * 64
+
+    # Materials, worlds, etc. carry their node tree along inside them
+    node_tree = getattr(id_data, "node_tree", None)
+    if node_tree is not None and node_tree.is_embedded_data:
+        size += len(node_tree.nodes) * 1024 + len(node_tree.links) * 64
+
+    # Images, fonts and sounds only take up space in the .blend when they're packed
+    packed_file = getattr(id_data, "packed_file", None)
+    if packed_file is not None:
+        size += packed_file.size
+
+    _dependency_cache["sizes"][id_data] = size
+    return size
+
+
+def summarize_dependencies(datablocks):
+    # Group the datablocks by type with an estimated size for each group
+    summary = {}
+    for id_data in datablocks:
+        type_summary = summary.setdefault(id_data.id_type, {"count": 0, "size": 0, "names": []})
+        type_summary["count"] += 1
+        type_summary["size"] += estimate_id_size(id_data)
+        if id_data.library:
+            type_summary["names"].append("%s [%s]" % (id_data.name, id_data.library.filepath))
+        else:
+            type_summary["names"].append(id_data.name)
+    return summary
+
+
+def report_dry_run(summary, filepath):
+    # Print the full contents to the console and return a one-line version for the operator
+    total_count = sum(type_summary["count"] for type_summary in summary.values())
+    total_size = sum(type_summary["size"] for type_summary in summary.values())
+    print("Dry run for %s: %d datablocks, about %s" % (filepath, total_count, format_size(total_size)))
+    for id_type, type_summary in sorted(summary.items()):
+        print("  %s (%d, about %s)" % (id_type, type_summary["count"], format_size(type_summary["size"])))
+        for name in sorted(type_summary["names"]):
+            print("    " + name)
+    counts = ", ".join("%d %s" % (type_summary["count"], id_type.lower())
+                       for id_type, type_summary in sorted(summary.items()))
+    return "%d datablocks, about %s (%s)" % (total_count, format_size(total_size), counts)
+
+
+def actually_export(datablocks, filepath, fake_user=False, path_remap='RELATIVE'):
+    # Write only the given datablocks (and what they depend on) to the target file.
+    # Unlike save_as_mainfile, this never touches the rest of the open file, so
+    # there's nothing to purge beforehand or undo afterwards.
+    bpy.data.libraries.write(filepath, set(datablocks), path_remap=path_remap, fake_user=fake_user)
+
+
+# Seconds to wait for asset previews when the settings don't say otherwise
+DEFAULT_PREVIEW_TIMEOUT = 10.0
+
+# Object types Blender renders previews for. Empties, lights, cameras, armatures and the like never get one.
+PREVIEW_OBJECT_TYPES = {'MESH', 'CURVE', 'SURFACE', 'FONT', 'META', 'CURVES', 'POINTCLOUD', 'VOLUME'}
+
+def can_render_preview(id_data):
+    # Previews aren't rendered at all in background mode, so there's nothing to wait for there
+    if bpy.app.background:
+        return False
+    if isinstance(id_data, bpy.types.Object):
+        return id_data.type in PREVIEW_OBJECT_TYPES
+    if isinstance(id_data, bpy.types.Collection):
+        return any(ob.type in PREVIEW_OBJECT_TYPES for ob in id_data.all_objects)
+    return isinstance(id_data, (bpy.types.Material, bpy.types.World, bpy.types.Light, bpy.types.Texture, bpy.types.Image))
+
+
+def is_preview_ready(id_data):
+    # The preview buffer is allocated (blank) before rendering starts, so check for actual pixels too
+    preview = id_data.preview
+    if preview is None or preview.image_size[0] == 0:
+        return False
+    pixels = array.array('i', [0]) * len(preview.image_pixels)
+    preview.image_pixels.foreach_get(pixels)
+    return any(pixels)
+
+
+def wait_for_previews(ids, timeout):
+    # Previews render in the background, so poll until every one of them is done or we run out of time
+    pending = [id_data for id_data in ids if can_render_preview(id_data)]
+    deadline = time.monotonic() + timeout
+    while pending and time.monotonic() < deadline:
+        time.sleep(0.02)
+        pending = [id_data for id_data in pending if not is_preview_ready(id_data)]
+    for id_data in pending:
+        print("Preview for %s wasn't ready after %.1fs" % (id_data.name, timeout))
+    return pending
+
+
+def get_asset_preview_key(id_data, dependency_map=None, export_digest=None):
+    if export_digest is not None:
+        return get_export_preview_key(id_data, export_digest)
+    # Collections made just for the export aren't in the dependency data yet, so go by their objects
+    roots = [id_data]
+    if isinstance(id_data, bpy.types.Collection):
+        for collection in [id_data] + get_child_collections(id_data):
+            roots += collection.objects
+    return get_preview_key(collect_dependencies(roots, dependency_map))
+
+
+def get_export_digests(exports):
+    # The content hash of the file each asset's written to, where Skip Unchanged worked one out
+    return {id_data: export_data["settings"]["content_hash"] for export_data in exports
+            if "content_hash" in export_data["settings"] for id_data in export_data["asset_ids"]}
+
+
+def mark_assets(ids, export_settings, dependency_map=None, wait=True, export_digests=None):
+    # Mark IDs as assets for the export, remembering their state so it can be put back afterwards.
+    # Previews come from the cache when nothing in the asset has changed, and are only rendered otherwise.
+    cache_size = export_settings.get("preview_cache_size", DEFAULT_CACHE_SIZE)
+    export_digests = export_digests or {}
+    asset_states = []
+    rendering = []
+    for id_data in ids:
+        was_asset = id_data.asset_data is not None
+        had_fake_user = id_data.use_fake_user
+        renderable = can_render_preview(id_data)
+        # Worked out before marking, so the asset data and fake user don't end up in the key
+        preview_key = None
+        if renderable and cache_size:
+            preview_key = get_asset_preview_key(id_data, dependency_map, export_digests.get(id_data))
+        id_data.asset_mark()
+        if renderable:
+            if preview_key is not None and load_preview(id_data, preview_key):
+                preview_key = None
+            else:
+                id_data.asset_generate_preview()
+                rendering.append(id_data)
+        asset_states.append((id_data, was_asset, had_fake_user, preview_key))
+
+    # Request every preview first so they render together, then wait for all of them at once
+    if wait:
+        wait_for_previews(rendering, export_settings.get("preview_timeout", DEFAULT_PREVIEW_TIMEOUT))
+        cache_previews(asset_states, export_settings)
+
+    return asset_states
+
+
+def cache_previews(asset_states, export_settings):
+    # Keep the freshly rendered previews for next time
+    cached = False
+    for id_data, was_asset, had_fake_user, preview_key in asset_states:
+        if preview_key is not None and is_preview_ready(id_data):
+            save_preview(id_data, preview_key)
+            cached = True
+    if cached:
+        trim_cache(export_settings.get("preview_cache_size", DEFAULT_CACHE_SIZE))
+
+
+def restore_assets(asset_states):
+    for id_data, was_asset, had_fake_user, preview_key in asset_states:
+        if not was_asset:
+            id_data.asset_clear()
+        id_data.use_fake_user = had_fake_user
+
+
+# Width and height of the preview thumbnails stored in the asset index
+INDEX_PREVIEW_SIZE = 32
+
+def get_preview_thumbnail(id_data):
+    # A small copy of the asset preview, picked nearest-neighbour, as base64 RGBA bytes
+    if not is_preview_ready(id_data):
+        return None
+    width, height = id_data.preview.image_size
+    pixels = array.array('i', [0]) * (width * height)
+    id_data.preview.image_pixels.foreach_get(pixels)
+    size = min(INDEX_PREVIEW_SIZE, width, height)
+    thumbnail = array.array('i', (pixels[(y * height // size) * width + x * width // size]
+                                  for y in range(size) for x in range(size)))
+    return {"size": [size, size], "pixels": base64.b64encode(thumbnail.tobytes()).decode("ascii")}
+
+
+def get_asset_entry(id_data, datablocks, dependency_map=None):
+    # What the asset index records about an asset that's just been written.
+    # The dependencies are the asset's own, unless it only exists for the export (like a new collection).
+    if dependency_map is None:
+        dependency_map = get_dependency_map()
+    if id_data in dependency_map:
+        datablocks = collect_dependencies([id_data], dependency_map)
+    dependencies = {}
+    libraries = set()
+    for dependency in datablocks:
+        if dependency == id_data:
+            continue
+        dependencies[dependency.id_type] = dependencies.get(dependency.id_type, 0) + 1
+        if dependency.library:
+            libraries.add(dependency.library.filepath)
+
+    asset_data = id_data.asset_data
+    return {
+        "name": id_data.name,
+        "type": id_data.id_type,
+        "catalog_id": getattr(asset_data, "catalog_id", ""),
+        "catalog": getattr(asset_data, "catalog_simple_name", ""),
+        "description": asset_data.description,
+        "author": getattr(asset_data, "author", ""),
+        "tags": [tag.name for tag in asset_data.tags],
+        "dependencies": dependencies,
+        "libraries": sorted(libraries),
+        "preview": get_preview_thumbnail(id_data),
+    }
+
+
+def update_asset_index(export_settings, assets_by_filepath):
+    # Keep the library's asset index in step with what was just written. Files still
+    # on their way to the library are indexed once they're there.
+    library_path = bpy.path.abspath(export_settings.get("library_path") or "")
+
+    def write_index():
+        try:
+            update_index(assets_by_filepath, library_path)
+        except OSError as error:
+            # The files are written either way, so a broken index shouldn't fail the export
+            print("Couldn't update the asset index: %s" % error)
+
+    transfer_queue.call_after(write_index)
+
+
+def save_manifests(manifests):
+    # Hashes are only recorded once their files are in the library. A staged file that couldn't be
+    # moved there keeps its old hash, so the next export writes it again instead of skipping it.
+    changes = manifests.take_changes()
+
+    def write_manifests():
+        for directory, hashes in changes.items():
+            for filename in list(hashes):
+                if transfer_queue.get_status(os.path.join(directory, filename)) == 'FAILED':
+                    del hashes[filename]
+        try:
+            write_manifest_changes(changes)
+        except OSError as error:
+            print("Couldn't update the export hashes: %s" % error)
+
+    transfer_queue.call_after(write_manifests)
+
+
+def refresh_asset_index(export_settings, filepaths):
+    # Files changed after they were indexed (e.g. slimmed) keep their entries, with their new size
+    library_path = bpy.path.abspath(export_settings.get("library_path") or "")
+
+    def write_index():
+        try:
+            refresh_index(filepaths, library_path)
+        except OSError as error:
+            print("Couldn't update the asset index: %s" % error)
+
+    transfer_queue.call_after(write_index)
+
+
+def get_export_objects(context, export_settings):
     if export_settings["export_selected"] and not export_settings["is_collection"]:
-        for ob in context.selected_objects:
-            objects.append(ob)
-            object_names.append(ob.name)
+        return list(context.selected_objects)
     elif export_settings["is_collection"]:
-        for ob in bpy.data.collections[export_settings["collection_name"]].objects:
-            objects.append(ob)
-            object_names.append(ob.name)
+        return list(bpy.data.collections[export_settings["collection_name"]].objects)
+    else:
+        return list(bpy.data.objects)
+
+
+def get_export_roots(objects, export_settings):
+    roots = list(objects)
+    if export_settings["is_collection"]:
+        roots.append(bpy.data.collections[export_settings["collection_name"]])
+    return roots
+
+
+def collect_export_dependencies(objects, export_settings, dependency_map=None):
+    return collect_dependencies(get_export_roots(objects, export_settings), dependency_map,
+                                export_settings.get("keep_links", False))
+
+
+def dry_run_blend_objects(context, export_settings, batch=False):
+    if batch:
+        items = get_batch_items(context, export_settings)
+    elif not export_settings["export_selected"] and export_settings.get("shard"):
+        items = get_shard_items(context, export_settings)
+        batch = True
     else:
-        for ob in bpy.data.objects:
-            objects.append(ob)
-            object_names.append(ob.name)
+        items = [(export_settings, get_export_objects(context, export_settings))]
+
+    total_size = 0
+    for item_settings, objects in items:
+        closure = collect_export_dependencies(objects, item_settings)
+        summary = summarize_dependencies(closure)
+        total_size += sum(type_summary["size"] for type_summary in summary.values())
+        message = report_dry_run(summary, item_settings["filepath"])
+
+    if batch:
+        return "%d files, about %s in total (see console)" % (len(items), format_size(total_size))
+    return message
+
 
+def prepare_export(objects, export_settings):
     # Create a new empty scene to hold export objects
+    # Anything created here only exists for the write and is removed afterwards
     export_scene = bpy.data.scenes.new("blend_export")
+    temporary_ids = [export_scene]
+    export_roots = list(objects)
 
     # Create a collection if we're exporting the selection as one
     if export_settings["export_selected"] and export_settings["export_as_collection"]:
         if export_settings["is_collection"] == False:
             export_collection = bpy.data.collections.new(export_settings["collection_name"])
+            temporary_ids.append(export_collection)
         else:
             export_collection = bpy.data.collections[export_settings["collection_name"]]
+            export_roots.append(export_collection)
         export_scene.collection.children.link(export_collection)
 
     # Add objects from list to scene
+    asset_ids = []
     for ob in objects:
         export_scene.collection.objects.link(ob)
         if export_settings["export_selected"]:
             if export_settings["export_as_collection"] and export_settings["is_collection"] == False:
                 export_collection.objects.link(ob)
             elif export_settings["export_as_collection"] == False and export_settings["mark_asset"]:
-                ob.asset_mark()
-                ob.asset_generate_preview()
+                asset_ids.append(ob)
 
     # If exporting as a collection and marking as an asset, only mark the collection as an asset
     if export_settings["export_selected"] and export_settings["export_as_collection"] and export_settings["mark_asset"]:
-        export_collection.asset_mark()
-        export_collection.asset_generate_preview()
-    
-    # Temporary hack to give the preview time to generate.
-    # Ideally, we would wait until preview.image_size[0] != 0
-    time.sleep(0.5)
+        asset_ids.append(export_collection)
+
+    return {
+        "settings": export_settings,
+        "roots": export_roots,
+        "temporary_ids": temporary_ids,
+        "asset_ids": asset_ids,
+    }
+
+
+def write_export(export_data, dependency_map=None, replacements=None, filepath=None):
+    keep_links = export_data["settings"].get("keep_links", False)
+    datablocks = collect_dependencies(export_data["roots"], dependency_map, keep_links) | set(export_data["temporary_ids"])
+    if replacements:
+        # Swap in the linked versions of anything that lives in the shared library
+        datablocks = {replacements.get(id_data, id_data) for id_data in datablocks}
+    # Images, fonts and sounds are written pointing at their copies in the library's file store
+    stored_files = []
+    if export_data["settings"].get("texture_store"):
+        stored_files = store_external_files(datablocks, export_data["settings"])
+    try:
+        stage_directory = export_data["settings"].get("stage_directory")
+        if stage_directory:
+            # Write to a local folder and leave moving it to the library to the transfer queue,
+            # so a slow network share doesn't hold Blender up
+            target = export_data["settings"]["filepath"]
+            relocated = relocate_paths(datablocks, target)
+            try:
+                local_filepath = get_stage_path(bpy.path.abspath(stage_directory), target)
+                actually_export(datablocks, local_filepath, path_remap='NONE')
+            finally:
+                restore_paths(relocated)
+            transfer_queue.add(local_filepath, target)
+        else:
+            actually_export(datablocks, filepath or export_data["settings"]["filepath"])
+    finally:
+        restore_external_files(stored_files)
+    # Assets are still marked at this point, so this is the time to note them down for the index
+    export_data["assets"] = [get_asset_entry(id_data, datablocks, dependency_map) for id_data in export_data["asset_ids"]]
+
+
+def cleanup_export(export_data):
+    for id_data in reversed(export_data["temporary_ids"]):
+        remove_id(id_data)
+
+
+def export_objects(objects, export_settings, dependency_map=None, log=None):
+    with log_phase(log, "prepare"):
+        export_data = prepare_export(objects, export_settings)
+    try:
+        with log_phase(log, "previews"):
+            asset_states = mark_assets(export_data["asset_ids"], export_settings, dependency_map,
+                                       export_digests=get_export_digests([export_data]))
+        try:
+            with log_phase(log, "write"):
+                write_export(export_data, dependency_map)
+        finally:
+            # Put the source file back the way it was
+            restore_assets(asset_states)
+    finally:
+        with log_phase(log, "cleanup"):
+            cleanup_export(export_data)
+    return export_data["assets"]
 
-    actually_export(export_scene, export_settings["filepath"])
+
+def get_library_path(filepath):
+    # Link relative to this file where we can, the same as File > Link does by default
+    if bpy.data.filepath:
+        try:
+            return bpy.path.relpath(filepath)
+        except ValueError:
+            pass
+    return filepath
+
+
+def find_library(filepath):
+    for library in bpy.data.libraries:
+        if os.path.normpath(bpy.path.abspath(library.filepath)) == os.path.normpath(filepath):
+            return library
+    return None
+
+
+def load_linked(filepath, names_by_type):
+    # Link everything we need from a file in a single library read.
+    # names_by_type maps bpy.data collection names (e.g. "objects") to lists of ID names.
+    # If the file's already linked its data is stale now, so reload it first.
+    library = find_library(filepath)
+    if library is not None:
+        library.reload()
+    with bpy.data.libraries.load(get_library_path(filepath), link=True) as (data_from, data_to):
+        for attr, names in names_by_type.items():
+            setattr(data_to, attr, list(names))
+    return {attr: getattr(data_to, attr) for attr in names_by_type}
+
+
+def is_removed(id_data):
+    try:
+        id_data.name
+    except ReferenceError:
+        return True
+    return False
+
+
+def get_child_collections(collection):
+    children = []
+    for child in collection.children:
+        children.append(child)
+        children += get_child_collections(child)
+    return children
+
+
+def backlink_objects(objects, export_settings):
+    # Replace the exported data with linked versions of it. Every user (collections in any scene,
+    # parents, instancers, constraints, drivers...) is remapped at once, so nothing is lost.
+    objects = [ob for ob in objects if not is_removed(ob)]
+    # Linking needs the file, so wait for it if it's still on its way to the library
+    transfer_queue.wait([export_settings["filepath"]])
+    if transfer_queue.get_status(export_settings["filepath"]) == 'FAILED':
+        # Whatever's there is an older export, or nothing at all
+        print("Not linking %s, it couldn't be moved to the library" % export_settings["filepath"])
+        return
+    if export_settings["is_collection"]:
+        collection = bpy.data.collections[export_settings["collection_name"]]
+        linked_collection = load_linked(export_settings["filepath"], {"collections": [collection.name]})["collections"][0]
+        remaps = [(collection, linked_collection)]
+        if linked_collection is not None:
+            linked_objects = {ob.name: ob for ob in linked_collection.all_objects}
+            remaps += [(ob, linked_objects.get(ob.name)) for ob in collection.all_objects]
+            linked_children = {child.name: child for child in get_child_collections(linked_collection)}
+            remaps += [(child, linked_children.get(child.name)) for child in get_child_collections(collection)]
+    else:
+        # Objects are swapped in place, so they keep their parenting and collection placement
+        # even when they were exported bundled in a collection
+        linked_objects = load_linked(export_settings["filepath"], {"objects": [ob.name for ob in objects]})["objects"]
+        remaps = list(zip(objects, linked_objects))
+
+    remaps = [(local, linked) for local, linked in remaps if linked is not None]
+    for local, linked in remaps:
+        local.user_remap(linked)
+    bpy.data.batch_remove([local for local, linked in remaps])
+
+    invalidate_dependency_cache()
+
+
+def get_export_hash(objects, export_settings, dependency_map=None):
+    return hash_export(collect_export_dependencies(objects, export_settings, dependency_map), export_settings)
+
+
+def track_exported(items, dependency_map=None):
+    # Remember what went into each file, so it can be re-exported once any of it changes.
+    # Backlinked objects are replaced by the exported ones, files linking to a shared library
+    # can't be redone without rewriting it for the whole batch, and slimming and proxies need
+    # background workers once the file is written, so those aren't tracked.
+    for item_settings, objects in items:
+        if not item_settings.get("track_changes"):
+            continue
+        if (item_settings["export_selected"] and item_settings["backlink"]) or item_settings.get("shared_ids"):
+            continue
+        if item_settings.get("strip") or item_settings.get("write_proxy"):
+            continue
+        datablocks = collect_export_dependencies(objects, item_settings, dependency_map)
+        track_export(item_settings, objects, datablocks, item_settings.get("content_hash"))
+
+
+def export_blend_objects(context, export_settings):
+    print("Exporting objects to .blend...")
+    log = ExportLog("objects", export_settings["filepath"])
+    with log.phase("collect"):
+        objects = get_export_objects(context, export_settings)
+    counts = {"written": 0, "skipped": 0, "failed": 0}
+
+    # Skip the write if nothing in the export has changed since it was last written
+    manifests = HashManifests()
+    digest = None
+    if export_settings.get("incremental"):
+        with log.phase("hash"):
+            digest = get_export_hash(objects, export_settings)
+    if digest is not None and manifests.is_unchanged(export_settings["filepath"], digest):
+        print("%s is up to date, skipping" % export_settings["filepath"])
+        counts["skipped"] += 1
+    else:
+        assets = export_objects(objects, export_settings, log=log)
+        update_asset_index(export_settings, {export_settings["filepath"]: assets})
+        count_written(counts, export_settings["filepath"])
+        if digest is not None:
+            manifests.set(export_settings["filepath"], digest)
+            save_manifests(manifests)
+    track_exported([(export_settings, objects)])
 
     # If backlinks are activated, replace each object with a link to the exported one
     if export_settings["export_selected"] and export_settings["backlink"]:
-        if export_settings["export_as_collection"]:
-            linkpath = export_settings["filepath"] + "\\Collection\\" + export_settings["collection_name"]
-            linkdir = export_settings["filepath"] + "\\Collection\\"
-            linkcol = export_settings["collection_name"]
-
-            # Remove objects from scene so they can be replaced
-            for obname in object_names:
-                bpy.data.objects.remove(bpy.data.objects[obname], do_unlink=True)
-
-            # Do the actual replacing thing
-            bpy.ops.wm.link(
-                filepath=linkpath,
-                directory=linkdir,
-                filename = linkcol
-            )
-        else:
-            for obname in object_names:
-                linkpath = export_settings["filepath"] + "\\Object\\" + obname
-                linkdir = export_settings["filepath"] + "\\Object\\"
-                linkob = obname
-                bpy.data.objects.remove(bpy.data.objects[obname], do_unlink=True)
-                bpy.ops.wm.link(
-                    filepath=linkpath,
-                    directory=linkdir,
-                    filename = linkob
-                )
+        with log.phase("backlink"):
+            backlink_objects(objects, export_settings)
 
+    finish_log(log, export_settings, counts)
+    counts["phases"] = log.summary()
+    return counts
+
+
+def get_batch_filepath(export_settings, name, collection_name):
+    # Build an output path from the filename template, e.g. "{collection}/{name}.blend"
+    filename = export_settings["filename_template"].format(
+        name=bpy.path.clean_name(name),
+        collection=bpy.path.clean_name(collection_name)
+    )
+    if not filename.lower().endswith(".blend"):
+        filename += ".blend"
+    return os.path.join(bpy.path.abspath(export_settings["directory"]), filename)
+
+
+def get_unique_filepath(filepath, used):
+    # Names that clean up to the same file name still get a file each
+    base, extension = os.path.splitext(filepath)
+    index = 1
+    while os.path.normcase(filepath) in used:
+        filepath = "%s_%d%s" % (base, index, extension)
+        index += 1
+    used.add(os.path.normcase(filepath))
+    return filepath
+
+
+def get_batch_items(context, export_settings):
+    # One item per selected object or collection, each with its own copy of the settings.
+    # They're gone through by name, so the same ones get the numbered file names every time.
+    items = []
+    used = set()
+    if export_settings["is_collection"]:
+        parents = {child: context.scene.collection for child in context.scene.collection.children}
+        for parent in bpy.data.collections:
+            for child in parent.children:
+                parents[child] = parent
+        for collection in sorted(export_settings["collections"], key=lambda collection: collection.name):
+            item_settings = dict(export_settings)
+            item_settings["collection_name"] = collection.name
+            parent = parents.get(collection, context.scene.collection)
+            item_settings["filepath"] = get_unique_filepath(get_batch_filepath(export_settings, collection.name, parent.name), used)
+            items.append((item_settings, list(collection.objects)))
+    else:
+        for ob in sorted(context.selected_objects, key=lambda ob: ob.name):
+            item_settings = dict(export_settings)
+            item_settings["collection_name"] = ob.name
+            if ob.users_collection:
+                collection_name = ob.users_collection[0].name
+            else:
+                collection_name = context.scene.collection.name
+            item_settings["filepath"] = get_unique_filepath(get_batch_filepath(export_settings, ob.name, collection_name), used)
+            items.append((item_settings, [ob]))
+    return items
+
+
+# Datablocks that make up the exported items themselves, so they're never moved to the shared library
+UNSHARED_TYPES = {'OBJECT', 'COLLECTION', 'SCENE', 'LIBRARY', 'WORKSPACE', 'SCREEN', 'WINDOWMANAGER'}
+
+SHARED_LIBRARY_NAME = "_shared.blend"
+
+
+def get_shared_dependencies(closures):
+    # Anything local that more than one item needs. Types without a known bpy.data collection
+    # can't be linked back in, so those stay in each item's own file.
+    seen = set()
+    shared = set()
+    for closure in closures:
+        for id_data in closure:
+            if id_data.id_type in UNSHARED_TYPES or id_data.id_type not in ID_TYPE_COLLECTIONS or id_data.library:
+                continue
+            if id_data in seen:
+                shared.add(id_data)
+            seen.add(id_data)
+    return shared
+
+
+def link_shared_dependencies(shared, filepath):
+    # Write the shared datablocks to their own library, then temporarily point every user in
+    # this file at linked copies of them, so the per-item files link to them instead of embedding them
+    actually_export(shared, filepath, fake_user=True)
+
+    # If the shared library's already linked (e.g. from an earlier backlink), leave it in place afterwards
+    existing_library = find_library(filepath)
+
+    ids_by_type = {}
+    for id_data in shared:
+        ids_by_type.setdefault(ID_TYPE_COLLECTIONS[id_data.id_type], []).append(id_data)
+    linked_by_type = load_linked(filepath, {attr: [id_data.name for id_data in ids] for attr, ids in ids_by_type.items()})
+
+    mapping = {}
+    library = existing_library
+    for attr, ids in ids_by_type.items():
+        for local, linked in zip(ids, linked_by_type[attr]):
+            if linked is None:
+                continue
+            local.user_remap(linked)
+            mapping[local] = linked
+            library = linked.library
+
+    return {
+        "filepath": filepath,
+        "library": library,
+        "remove_library": existing_library is None,
+        "mapping": mapping,
+    }
+
+
+def unlink_shared_dependencies(shared_state):
+    # Point everything back at the local datablocks
+    for local, linked in shared_state["mapping"].items():
+        linked.user_remap(local)
+    if shared_state["remove_library"] and shared_state["library"] is not None:
+        bpy.data.libraries.remove(shared_state["library"])
+    invalidate_dependency_cache()
+
+
+def plan_batch(items, export_settings, dependency_map, manifests):
+    # Work out which items actually need writing, and which of their dependencies go to the shared library
+    closures = [collect_export_dependencies(objects, item_settings, dependency_map)
+                for item_settings, objects in items]
+
+    # Shared datablocks come from every item, including ones that end up skipped, since those link to them too
+    shared = set()
+    if export_settings.get("share_dependencies"):
+        shared = get_shared_dependencies(closures)
+
+    pending = []
+    skipped = []
+    for (item_settings, objects), closure in zip(items, closures):
+        if shared:
+            item_settings["shared_ids"] = sorted(get_id_key(id_data) for id_data in closure & shared)
+        if item_settings.get("incremental"):
+            item_settings["content_hash"] = hash_export(closure, item_settings)
+            if manifests.is_unchanged(item_settings["filepath"], item_settings["content_hash"]):
+                skipped.append((item_settings, objects))
+                continue
+        pending.append((item_settings, objects))
+    return pending, skipped, shared
+
+
+def get_shared_library_path(export_settings):
+    return os.path.join(bpy.path.abspath(export_settings["directory"]), SHARED_LIBRARY_NAME)
+
+
+def export_blend_batch(context, export_settings):
+    print("Exporting batch to .blend files...")
+    log = ExportLog("batch", export_settings["directory"])
+    with log.phase("collect"):
+        items = get_batch_items(context, export_settings)
+    return export_items(items, export_settings, log)
+
+
+def export_items(items, export_settings, log, counts=None):
+    # Write several (settings, objects) items in one go. Each item's own settings decide
+    # whether it's skipped when unchanged and whether it's backlinked afterwards.
+    if counts is None:
+        counts = {"written": 0, "skipped": 0, "failed": 0}
+
+    # The dependency data is the same for every item, so only build it once,
+    # and leave out anything that hasn't changed since it was last written
+    with log.phase("plan"):
+        dependency_map = get_dependency_map()
+        manifests = HashManifests()
+        pending, skipped, shared = plan_batch(items, export_settings, dependency_map, manifests)
+    counts["skipped"] += len(skipped)
+
+    shared_state = None
+    if shared and pending:
+        with log.phase("shared"):
+            shared_state = link_shared_dependencies(shared, get_shared_library_path(export_settings))
+    replacements = shared_state["mapping"] if shared_state else None
+
+    exports = []
+    failed = set()
+    try:
+        with log.phase("prepare"):
+            for item_settings, objects in pending:
+                exports.append(prepare_export(objects, item_settings))
+
+        # Mark every asset in the batch up front so all the previews render at the same time
+        with log.phase("previews"):
+            asset_ids = [id_data for export_data in exports for id_data in export_data["asset_ids"]]
+            asset_states = mark_assets(asset_ids, export_settings, dependency_map,
+                                       export_digests=get_export_digests(exports))
+        try:
+            with log.phase("write"):
+                for export_data in exports:
+                    filepath = export_data["settings"]["filepath"]
+                    try:
+                        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                        write_export(export_data, dependency_map, replacements)
+                    except (RuntimeError, OSError) as error:
+                        print("Failed to export %s: %s" % (filepath, error))
+                        failed.add(filepath)
+                        counts["failed"] += 1
+                        continue
+                    count_written(counts, filepath)
+                    if "content_hash" in export_data["settings"]:
+                        manifests.set(filepath, export_data["settings"]["content_hash"])
+        finally:
+            restore_assets(asset_states)
+        update_asset_index(export_settings, {export_data["settings"]["filepath"]: export_data["assets"]
+                                             for export_data in exports if "assets" in export_data})
+    finally:
+        with log.phase("cleanup"):
+            for export_data in exports:
+                cleanup_export(export_data)
+            if shared_state:
+                unlink_shared_dependencies(shared_state)
+            save_manifests(manifests)
+    track_exported([item for item in items if item[0]["filepath"] not in failed], dependency_map)
+
+    # Backlink only once everything's written, so the dependency data stays valid for the whole batch
+    backlinks = [(item_settings, objects) for item_settings, objects in items
+                 if item_settings["backlink"] and item_settings["filepath"] not in failed]
+    if backlinks:
+        with log.phase("backlink"):
+            for item_settings, objects in backlinks:
+                backlink_objects(objects, item_settings)
+
+    finish_log(log, export_settings, counts)
+    counts["phases"] = log.summary()
+    return counts
+
+
+def get_shard_size(datablocks):
+    # Linked data is only a reference in the shard, so it barely adds to the size
+    return sum(ID_OVERHEAD if id_data.library else estimate_id_size(id_data) for id_data in datablocks)
+
+
+def fits_shard(export_settings, size, object_count):
+    # A budget of 0 means no limit
+    max_size = export_settings.get("shard_size", 0)
+    max_objects = export_settings.get("shard_objects", 0)
+    return (not max_size or size <= max_size) and (not max_objects or object_count <= max_objects)
+
+
+def get_object_units(objects, export_settings, dependency_map):
+    # Keep the objects together if they fit in a shard, otherwise each one is a unit of its own.
+    # With Keep Links, linked data is only a reference, so what it uses isn't counted.
+    keep_links = export_settings.get("keep_links", False)
+    closure = collect_dependencies(objects, dependency_map, keep_links)
+    if fits_shard(export_settings, get_shard_size(closure), len(objects)):
+        return [(objects, closure)]
+    return [([ob], collect_dependencies([ob], dependency_map, keep_links)) for ob in objects]
+
+
+def get_shard_units(collection, export_settings, dependency_map, seen):
+    # Split a collection into groups of objects that should stay together: the whole collection
+    # if it fits in a shard, otherwise its own objects and then each child collection the same way
+    objects = []
+    for member in [collection] + get_child_collections(collection):
+        for ob in member.objects:
+            if ob not in seen:
+                seen.add(ob)
+                objects.append(ob)
+    if not objects:
+        return []
+    keep_links = export_settings.get("keep_links", False)
+
+    closure = collect_dependencies(objects, dependency_map, keep_links)
+    if fits_shard(export_settings, get_shard_size(closure), len(objects)):
+        return [(objects, closure)]
+    if not collection.children:
+        return [([ob], collect_dependencies([ob], dependency_map, keep_links)) for ob in objects]
+
+    # Too big, so give the objects back and split it up by child collection instead
+    seen.difference_update(objects)
+    units = []
+    own_objects = [ob for ob in collection.objects if ob not in seen]
+    if own_objects:
+        seen.update(own_objects)
+        units += get_object_units(own_objects, export_settings, dependency_map)
+    for child in collection.children:
+        units += get_shard_units(child, export_settings, dependency_map, seen)
+    return units
+
+
+def pack_shards(units, export_settings):
+    # Greedy packing, biggest units first. Each unit goes into the shard that already holds
+    # the most of what it depends on and still has room, so shared data is duplicated as little as possible.
+    shards = []
+    for objects, closure in sorted(units, key=lambda unit: get_shard_size(unit[1]), reverse=True):
+        best_shard = None
+        best_overlap = -1
+        for shard in shards:
+            size = shard["size"] + get_shard_size(closure - shard["closure"])
+            if not fits_shard(export_settings, size, len(shard["objects"]) + len(objects)):
+                continue
+            overlap = get_shard_size(closure & shard["closure"])
+            if overlap > best_overlap:
+                best_shard = shard
+                best_overlap = overlap
+        if best_shard is None:
+            best_shard = {"objects": [], "closure": set(), "size": 0}
+            shards.append(best_shard)
+        best_shard["objects"] += objects
+        best_shard["closure"] |= closure
+        best_shard["size"] = get_shard_size(best_shard["closure"])
+    return shards
+
+
+def get_shard_filepath(export_settings, index):
+    return "%s_%03d.blend" % (os.path.splitext(export_settings["filepath"])[0], index)
+
+
+def get_shard_index_path(export_settings):
+    return os.path.splitext(export_settings["filepath"])[0] + "_index.json"
+
+
+def get_shard_items(context, export_settings, dependency_map=None):
+    # Split everything into shards within the size and object budgets. The scene's collection
+    # hierarchy decides what belongs together; objects outside it are packed by what they depend on.
+    if dependency_map is None:
+        dependency_map = get_dependency_map()
+    keep_links = export_settings.get("keep_links", False)
+    seen = set()
+    units = []
+    scene_collection = context.scene.collection
+    own_objects = list(scene_collection.objects)
+    seen.update(own_objects)
+    units += [([ob], collect_dependencies([ob], dependency_map, keep_links)) for ob in own_objects]
+    for collection in scene_collection.children:
+        units += get_shard_units(collection, export_settings, dependency_map, seen)
+    units += [([ob], collect_dependencies([ob], dependency_map, keep_links)) for ob in bpy.data.objects if ob not in seen]
+
+    items = []
+    for index, shard in enumerate(pack_shards(units, export_settings)):
+        item_settings = dict(export_settings)
+        item_settings["filepath"] = get_shard_filepath(export_settings, index)
+        item_settings["estimated_size"] = shard["size"]
+        items.append((item_settings, shard["objects"]))
+    return items
+
+
+def write_shard_index(export_settings, items, failed=()):
+    # Map every object to the shard it's in, so the shards can be found again without opening them all
+    index_path = get_shard_index_path(export_settings)
+    directory = os.path.dirname(index_path)
+    shards = []
+    objects = {}
+    for item_settings, shard_objects in items:
+        filename = os.path.basename(item_settings["filepath"])
+        shards.append({
+            "filepath": filename,
+            "objects": sorted(ob.name for ob in shard_objects),
+            "estimated_size": item_settings["estimated_size"],
+            "written": item_settings["filepath"] not in failed,
+        })
+        for ob in shard_objects:
+            objects[ob.name] = filename
+
+    # Shards left over from an earlier export with more of them would be stale, so remove them
+    try:
+        with open(index_path) as index_file:
+            previous = json.load(index_file)
+    except (OSError, ValueError):
+        previous = {}
+    current = {shard["filepath"] for shard in shards}
+    for shard in previous.get("shards", []):
+        if shard["filepath"] not in current and os.path.exists(os.path.join(directory, shard["filepath"])):
+            os.remove(os.path.join(directory, shard["filepath"]))
+
+    write_json(index_path, {
+        "source": bpy.data.filepath,
+        "shards": shards,
+        "objects": objects,
+    })
+
+
+def export_blend_shards(context, export_settings):
+    print("Exporting scene to .blend shards...")
+    log = ExportLog("shards", export_settings["filepath"])
+    counts = {"written": 0, "skipped": 0, "failed": 0}
+
+    with log.phase("plan"):
+        dependency_map = get_dependency_map()
+        items = get_shard_items(context, export_settings, dependency_map)
+        manifests = HashManifests()
+        pending, skipped, shared = plan_batch(items, dict(export_settings, share_dependencies=False), dependency_map, manifests)
+    counts["skipped"] = len(skipped)
+
+    failed = set()
+    assets_by_filepath = {}
+    with log.phase("write"):
+        for item_settings, objects in pending:
+            filepath = item_settings["filepath"]
+            try:
+                os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                assets_by_filepath[filepath] = export_objects(objects, item_settings, dependency_map)
+            except (RuntimeError, OSError) as error:
+                print("Failed to export %s: %s" % (filepath, error))
+                failed.add(filepath)
+                counts["failed"] += 1
+                continue
+            count_written(counts, filepath)
+            if "content_hash" in item_settings:
+                manifests.set(filepath, item_settings["content_hash"])
+        save_manifests(manifests)
+
+    with log.phase("index"):
+        write_shard_index(export_settings, items, failed)
+        update_asset_index(export_settings, assets_by_filepath)
+    track_exported([item for item in items if item[0]["filepath"] not in failed], dependency_map)
+
+    finish_log(log, export_settings, counts)
+    counts["phases"] = log.summary()
+    return counts
+
+
+def export_changed(filepaths=None):
+    # Re-export the tracked files that something changed in since they were written.
+    # Changes are only noticed from depsgraph updates, so the hash decides what really needs writing.
+    print("Re-exporting changed .blend files...")
+    counts = {"written": 0, "skipped": 0, "failed": 0}
+    dependency_map = get_dependency_map()
+    manifests = HashManifests()
+    for filepath in filepaths or get_changed_exports():
+        tracked = get_tracked_export(filepath)
+        if tracked is None:
+            continue
+        export_settings = dict(tracked["settings"])
+        try:
+            objects = [bpy.data.objects[name] for name in tracked["objects"]]
+            datablocks = collect_export_dependencies(objects, export_settings, dependency_map)
+        except KeyError as error:
+            print("Can't re-export %s, %s was renamed or removed" % (filepath, error))
+            counts["failed"] += 1
+            continue
+
+        digest = hash_export(datablocks, export_settings)
+        if digest == tracked["hash"]:
+            mark_unchanged(filepath)
+            counts["skipped"] += 1
+            continue
+
+        try:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            assets = export_objects(objects, export_settings, dependency_map)
+        except (RuntimeError, OSError) as error:
+            print("Failed to export %s: %s" % (filepath, error))
+            counts["failed"] += 1
+            continue
+        update_asset_index(export_settings, {filepath: assets})
+        if export_settings.get("incremental"):
+            manifests.set(filepath, digest)
+        track_export(export_settings, objects, datablocks, digest)
+        count_written(counts, filepath)
+    save_manifests(manifests)
+    return counts
 
-def export_blend_nodes(context, export_settings):
-    print("Exporting nodes to .blend...")
 
+@persistent
+def export_changed_on_save(*args):
+    preferences = bpy.context.preferences.addons[__package__].preferences
+    if preferences.track_changes and preferences.export_changed_on_save and get_changed_exports():
+        export_changed()
+
+
+def get_queue_settings(preferences):
+    # Options for flushing the queue as a whole. Everything else comes from each queued export.
+    return {
+        "preview_timeout": preferences.preview_timeout,
+        "preview_cache_size": preferences.preview_cache_size * 1024 * 1024,
+        "log_filepath": preferences.log_filepath,
+        "library_path": preferences.filepath,
+        "share_dependencies": False,
+    }
+
+
+def get_queued_nodes(job):
+    # Find the queued nodes again, going by the local datablock that owns their tree
+    id_type, name = job["owner"]
+    owner = getattr(bpy.data, ID_TYPE_COLLECTIONS[id_type])[(name, None)]
+    node_tree = owner if isinstance(owner, bpy.types.NodeTree) else owner.node_tree
+    return node_tree, [node_tree.nodes[node_name] for node_name in job["nodes"]]
+
+
+def export_queued(export_settings):
+    # Write everything that was queued as one batch, so the dependency data is only built
+    # once and all the asset previews render at the same time
+    print("Exporting queued .blend files...")
+    jobs = get_queued_exports()
+    clear_queue()
+    log = ExportLog("queue", bpy.data.filepath)
+
+    items = []
+    node_items = []
+    failed = 0
+    with log.phase("collect"):
+        for job in jobs:
+            try:
+                if job["kind"] == 'NODES':
+                    node_items.append((dict(job["settings"]),) + get_queued_nodes(job))
+                else:
+                    items.append((dict(job["settings"]), [bpy.data.objects[name] for name in job["objects"]]))
+            except KeyError as error:
+                print("Can't export %s, %s was renamed or removed" % (job["settings"]["filepath"], error))
+                failed += 1
+
+    # Nodes go first, since backlinking them changes the dependency data the objects are planned with
+    written = 0
+    for item_settings, node_tree, nodes in node_items:
+        try:
+            boundary, group_name = export_node_selection(node_tree, nodes, item_settings, log)
+        except (RuntimeError, OSError) as error:
+            print("Failed to export %s: %s" % (item_settings["filepath"], error))
+            failed += 1
+            continue
+        written += 1
+        if item_settings["export_selected"] and item_settings["export_as_group"] and item_settings["backlink"]:
+            with log.phase("backlink"):
+                linked_nodegroup = load_linked(item_settings["filepath"], {"node_groups": [group_name]})["node_groups"][0]
+                replace_with_group(node_tree, nodes, linked_nodegroup, boundary)
+                invalidate_dependency_cache()
+
+    return export_items(items, export_settings, log, {"written": written, "skipped": 0, "failed": failed})
+
+
+@persistent
+def export_queued_on_save(*args):
+    preferences = bpy.context.preferences.addons[__package__].preferences
+    if preferences.export_queue_on_save and get_queued_exports():
+        export_queued(get_queue_settings(preferences))
+
+
+def export_stages(context, export_settings, batch=False):
+    # The same export as export_blend_objects or export_blend_batch, split into small steps so
+    # the modal operator can run it between UI updates. Yields (progress, message) after each
+    # step and returns the counts. Closing it early cleans up the same way a failed export does,
+    # so cancelling never leaves the open file half changed.
+    sharded = not export_settings["export_selected"] and export_settings.get("shard")
+    if batch:
+        items = get_batch_items(context, export_settings)
+    elif sharded:
+        items = get_shard_items(context, export_settings)
+    else:
+        items = [(export_settings, get_export_objects(context, export_settings))]
+    counts = {"written": 0, "skipped": 0, "failed": 0}
+    yield 0.0, "Collecting dependencies"
+
+    dependency_map = get_dependency_map()
+    manifests = HashManifests()
+    plan_settings = dict(export_settings, share_dependencies=batch and export_settings.get("share_dependencies"))
+    pending, skipped, shared = plan_batch(items, plan_settings, dependency_map, manifests)
+    counts["skipped"] = len(skipped)
+
+    shared_state = None
+    exports = []
+    asset_states = []
+    failed = set()
+    temp_filepath = None
+    try:
+        if shared and pending:
+            yield 0.05, "Writing shared library"
+            shared_state = link_shared_dependencies(shared, get_shared_library_path(export_settings))
+        replacements = shared_state["mapping"] if shared_state else None
+
+        for item_settings, objects in pending:
+            exports.append(prepare_export(objects, item_settings))
+
+        # Let the previews render between steps rather than sleeping until they're done
+        asset_ids = [id_data for export_data in exports for id_data in export_data["asset_ids"]]
+        asset_states = mark_assets(asset_ids, export_settings, dependency_map, wait=False,
+                                   export_digests=get_export_digests(exports))
+        deadline = time.monotonic() + export_settings.get("preview_timeout", DEFAULT_PREVIEW_TIMEOUT)
+        waiting = [id_data for id_data in asset_ids if can_render_preview(id_data)]
+        while waiting and time.monotonic() < deadline:
+            yield 0.1, "Rendering previews (%d left)" % len(waiting)
+            waiting = [id_data for id_data in waiting if not is_preview_ready(id_data)]
+        for id_data in waiting:
+            print("Preview for %s wasn't ready in time" % id_data.name)
+        cache_previews(asset_states, export_settings)
+
+        for index, export_data in enumerate(exports):
+            filepath = export_data["settings"]["filepath"]
+            yield 0.1 + 0.85 * index / len(exports), "Writing %s" % os.path.basename(filepath)
+            try:
+                os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                # Write next to the target (so relative paths stay right) and move it into place,
+                # the same way Blender saves, so a cancelled export never leaves a half-written file
+                if export_data["settings"].get("stage_directory"):
+                    # The transfer queue moves it into place the same way
+                    write_export(export_data, dependency_map, replacements)
+                else:
+                    temp_filepath = filepath + "@"
+                    write_export(export_data, dependency_map, replacements, temp_filepath)
+                    os.replace(temp_filepath, filepath)
+                temp_filepath = None
+            except (RuntimeError, OSError) as error:
+                print("Failed to export %s: %s" % (filepath, error))
+                failed.add(filepath)
+                counts["failed"] += 1
+                continue
+            count_written(counts, filepath)
+            if "content_hash" in export_data["settings"]:
+                manifests.set(filepath, export_data["settings"]["content_hash"])
+        update_asset_index(export_settings, {export_data["settings"]["filepath"]: export_data["assets"]
+                                             for export_data in exports if "assets" in export_data})
+    finally:
+        if temp_filepath is not None and os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        restore_assets(asset_states)
+        for export_data in exports:
+            cleanup_export(export_data)
+        if shared_state:
+            unlink_shared_dependencies(shared_state)
+        save_manifests(manifests)
+
+    if sharded:
+        write_shard_index(export_settings, items, failed)
+    track_exported([item for item in items if item[0]["filepath"] not in failed], dependency_map)
+
+    # Backlinks are the last step, so they only happen once the whole export went through
+    if export_settings["export_selected"] and export_settings["backlink"]:
+        yield 0.95, "Linking exported objects"
+        for item_settings, objects in items:
+            if item_settings["filepath"] not in failed:
+                backlink_objects(objects, item_settings)
+
+    return counts
+
+
+def run_stages(stages, interval=0.0):
+    # Run a staged export straight through, for when nothing needs to happen in between steps
+    while True:
+        try:
+            next(stages)
+        except StopIteration as done:
+            return done.value
+        if interval:
+            time.sleep(interval)
+
+
+def write_node_groups(node_groups, export_settings, dependency_map=None):
+    # Write node groups and everything they use (nested groups, images...). Marking them
+    # as assets is up to the caller, so a batch can mark everything at once.
+    datablocks = collect_dependencies(node_groups, dependency_map)
+    actually_export(datablocks, export_settings["filepath"], fake_user=True)
+    if not export_settings["mark_asset"]:
+        return []
+    return [get_asset_entry(node_group, datablocks, dependency_map) for node_group in node_groups]
+
+
+def export_node_groups(node_groups, export_settings, dependency_map=None):
+    # Write existing node groups straight from the data API, no Node Editor needed
+    asset_states = []
+    if export_settings["mark_asset"]:
+        asset_states = mark_assets(node_groups, export_settings, dependency_map)
+    try:
+        return write_node_groups(node_groups, export_settings, dependency_map)
+    finally:
+        restore_assets(asset_states)
+
+
+# Folder names for the {type} placeholder in node group file names
+NODE_TREE_TYPES = {
+    'ShaderNodeTree': "shader",
+    'GeometryNodeTree': "geometry",
+    'CompositorNodeTree': "compositor",
+    'TextureNodeTree': "texture",
+}
+
+
+def is_node_group_selected(node_group, export_settings):
+    # Linked groups live in their own library, and can have the same name as a local one
+    if node_group.library:
+        return False
+    selection = export_settings["node_group_selection"]
+    if selection == 'FAKE_USER' and not node_group.use_fake_user:
+        return False
+    if selection == 'ASSETS' and node_group.asset_data is None:
+        return False
+    if export_settings["node_group_tag"]:
+        if node_group.asset_data is None or export_settings["node_group_tag"] not in node_group.asset_data.tags:
+            return False
+    if export_settings["name_filter"] and not fnmatch.fnmatchcase(node_group.name, export_settings["name_filter"]):
+        return False
+    return True
+
+
+def get_node_group_items(export_settings, node_groups=None):
+    # Either one item with every group, or one per group with its own file. Groups are
+    # passed around as IDs rather than looked up by name, so duplicate names can't mix them up.
+    if node_groups is None:
+        node_groups = [node_group for node_group in bpy.data.node_groups if is_node_group_selected(node_group, export_settings)]
+    if not node_groups:
+        return []
+    if not export_settings["batch_export"]:
+        return [(export_settings, list(node_groups))]
+
+    items = []
+    used = set()
+    for node_group in node_groups:
+        filename = export_settings["filename_template"].format(
+            name=bpy.path.clean_name(node_group.name),
+            type=NODE_TREE_TYPES.get(node_group.bl_idname, "other"),
+        )
+        if not filename.lower().endswith(".blend"):
+            filename += ".blend"
+        filepath = get_unique_filepath(os.path.join(bpy.path.abspath(export_settings["directory"]), filename), used)
+        items.append((dict(export_settings, filepath=filepath), [node_group]))
+    return items
+
+
+def export_blend_node_groups(export_settings, node_groups=None):
+    # Export node groups in bulk, with no Node Editor needed
+    print("Exporting node groups to .blend...")
+    log = ExportLog("node_groups", export_settings["filepath"])
+    with log.phase("collect"):
+        items = get_node_group_items(export_settings, node_groups)
+    counts = {"written": 0, "skipped": 0, "failed": 0}
+
+    # Nested groups and images are found through the same dependency data for every file
+    with log.phase("plan"):
+        dependency_map = get_dependency_map()
+        manifests = HashManifests()
+        pending = []
+        for item_settings, groups in items:
+            if export_settings.get("incremental"):
+                item_settings["content_hash"] = hash_export(collect_dependencies(groups, dependency_map), item_settings)
+                if manifests.is_unchanged(item_settings["filepath"], item_settings["content_hash"]):
+                    counts["skipped"] += 1
+                    continue
+            pending.append((item_settings, groups))
+
+    # Mark every group up front so all the previews render at the same time
+    with log.phase("previews"):
+        asset_states = []
+        if export_settings["mark_asset"]:
+            export_digests = {group: item_settings["content_hash"] for item_settings, groups in pending
+                              if "content_hash" in item_settings for group in groups}
+            asset_states = mark_assets([group for item_settings, groups in pending for group in groups],
+                                       export_settings, dependency_map, export_digests=export_digests)
+    assets_by_filepath = {}
+    try:
+        with log.phase("write"):
+            for item_settings, groups in pending:
+                filepath = item_settings["filepath"]
+                try:
+                    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                    assets_by_filepath[filepath] = write_node_groups(groups, item_settings, dependency_map)
+                except (RuntimeError, OSError) as error:
+                    print("Failed to export %s: %s" % (filepath, error))
+                    counts["failed"] += 1
+                    continue
+                count_written(counts, filepath)
+                if "content_hash" in item_settings:
+                    manifests.set(filepath, item_settings["content_hash"])
+    finally:
+        restore_assets(asset_states)
+        save_manifests(manifests)
+    update_asset_index(export_settings, assets_by_filepath)
+
+    finish_log(log, export_settings, counts)
+    counts["phases"] = log.summary()
+    return counts
+
+
+def get_node_references(nodes):
+    # IDs used directly by nodes: images, nested groups, objects in sockets and so on
+    references = set()
+    for node in nodes:
+        for prop in node.bl_rna.properties:
+            if prop.type == 'POINTER':
+                value = getattr(node, prop.identifier, None)
+                if isinstance(value, bpy.types.ID):
+                    references.add(value)
+        for socket in node.inputs:
+            value = getattr(socket, "default_value", None)
+            if isinstance(value, bpy.types.ID):
+                references.add(value)
+    return references
+
+
+def dry_run_blend_nodes(context, export_settings):
     current_nodetree = context.active_node.id_data
     if export_settings["export_selected"]:
-        # Remove any nodes that aren't selected
-        for node in current_nodetree.nodes:
-            if not node.select:
-                current_nodetree.nodes.remove(node)
+        nodes = [node for node in current_nodetree.nodes if node.select]
+        summary = summarize_dependencies(collect_dependencies(get_node_references(nodes)))
+        # The exported tree doesn't exist yet, so estimate it from the selected nodes
+        tree_summary = summary.setdefault('NODETREE', {"count": 0, "size": 0, "names": []})
+        tree_summary["count"] += 1
+        tree_summary["size"] += ID_OVERHEAD + len(nodes) * 1024
+        tree_summary["names"].append(export_settings["group_name"] if export_settings["export_as_group"] else current_nodetree.name)
+    else:
+        summary = summarize_dependencies(collect_dependencies([get_node_tree_owner(current_nodetree)]))
+    return report_dry_run(summary, export_settings["filepath"])
+
 
+def get_node_tree_owner(node_tree):
+    # Embedded node trees (materials, worlds, etc.) can't be written on their own
+    if not node_tree.is_embedded_data:
+        return node_tree
+    for datablocks in (bpy.data.materials, bpy.data.worlds, bpy.data.lights,
+                       bpy.data.textures, bpy.data.linestyles, bpy.data.scenes):
+        for owner in datablocks:
+            if getattr(owner, "node_tree", None) == node_tree:
+                return owner
+    return None
+
+
+def export_node_selection(node_tree, nodes, export_settings, log=None):
+    # Export some nodes of a tree without ever changing the tree, so this works headless too.
+    # Returns how the exported group connects to the rest of the tree and the name it was
+    # written with, for backlinking. Nothing in the source file is renamed, so when a local
+    # datablock already has the group's name the group gets a number on the end, as Blender
+    # does for any new datablock.
+    from .workers import rename_written_ids
     #XXX Right now forcing compositor nodes to export as group
-    if export_settings["export_as_group"] or current_nodetree.type == 'COMPOSITING':
-        # Create a node group with the selected nodes
-        #XXX Would be nice to do this without operators, but that seems non-trivial
-        bpy.ops.node.group_make()
-        bpy.ops.node.group_edit(exit=True)
-        context.active_node.name = export_settings["group_name"]
-        context.active_node.node_tree.name = export_settings["group_name"]
+    if export_settings["export_as_group"] or node_tree.type == 'COMPOSITING':
+        with log_phase(log, "group"):
+            export_group, boundary = build_node_group(node_tree, nodes, export_settings["group_name"])
+        temporary_ids = [export_group]
+        group_name = export_group.name
+        try:
+            # The group is brand new, so its dependencies come from the nodes it was copied from
+            datablocks = collect_dependencies(get_node_references(nodes)) | {export_group}
+            if node_tree.type == 'COMPOSITING':
+                # Create a new empty scene to hold the compositor group
+                export_scene = bpy.data.scenes.new("blend_export")
+                temporary_ids.append(export_scene)
+                export_scene.use_nodes = True
+                # Remove default Render Layers and Output node
+                for node in list(export_scene.node_tree.nodes):
+                    export_scene.node_tree.nodes.remove(node)
+                temp_group = export_scene.node_tree.nodes.new("CompositorNodeGroup")
+                temp_group.node_tree = export_group
+                datablocks.add(export_scene)
 
-    # Set the current node tree to have a fake user
-    current_nodetree.use_fake_user = True
+            with log_phase(log, "write"):
+                actually_export(datablocks, export_settings["filepath"], fake_user=True)
+        finally:
+            with log_phase(log, "cleanup"):
+                for id_data in reversed(temporary_ids):
+                    remove_id(id_data)
+        return boundary, group_name
 
-    # Create a new empty scene to hold export objects
-    export_scene = bpy.data.scenes.new("blend_export")
-    if current_nodetree.type == 'COMPOSITING':
-        export_scene.use_nodes = True
-        # Remove default Render Layers and Output node
-        for node in export_scene.node_tree.nodes:
-            export_scene.node_tree.nodes.remove(node)
-        #XXX Right now forcing compositor nodes to export as group
-        temp_group = export_scene.node_tree.nodes.new("CompositorNodeGroup")
-        temp_group.node_tree = bpy.data.node_groups[export_settings["group_name"]]
+    # The whole tree can be written as it is
+    source_owner = get_node_tree_owner(node_tree)
+    if set(nodes) == set(node_tree.nodes):
+        with log_phase(log, "write"):
+            actually_export(collect_dependencies([source_owner]), export_settings["filepath"], fake_user=True)
+        return None, None
 
-    actually_export(export_scene, export_settings["filepath"])
+    # Otherwise work on a copy of the tree (or the datablock that owns it) so the source stays
+    # untouched. The copy gets a numbered name (like Material.001) in the open file, so it's
+    # given the original name back in the written file afterwards.
+    with log_phase(log, "copy"):
+        export_owner = source_owner.copy()
+        export_nodetree = getattr(export_owner, "node_tree", export_owner)
+        node_names = {node.name for node in nodes}
+        for node in list(export_nodetree.nodes):
+            if node.name not in node_names:
+                export_nodetree.nodes.remove(node)
+        # The cached dependency data doesn't know about the copy yet
+        invalidate_dependency_cache()
+
+    export_name = export_owner.name
+    try:
+        with log_phase(log, "write"):
+            actually_export(collect_dependencies([export_owner]), export_settings["filepath"], fake_user=True)
+    finally:
+        with log_phase(log, "cleanup"):
+            remove_id(export_owner)
+            invalidate_dependency_cache()
+    if export_name != source_owner.name:
+        with log_phase(log, "rename"):
+            rename_written_ids(export_settings["filepath"], [(ID_TYPE_COLLECTIONS[source_owner.id_type], export_name, source_owner.name)])
+    return None, None
 
-    # If backlinks are activated, replace each object with a link to the exported one
-    if export_settings["export_selected"] and export_settings["export_as_group"] and export_settings["backlink"]:
-        linkpath = export_settings["filepath"] + "\\NodeTree\\" + export_settings["group_name"]
-        linkdir = export_settings["filepath"] + "\\NodeTree\\"
-        linkcol = export_settings["group_name"]
-
-        # Remove nodes from scene so they can be replaced
-        current_nodetree = context.active_node.id_data # Blender needs to be reminded where it is
-        for node in current_nodetree.nodes:
-            if node.select:
-                current_nodetree.nodes.remove(node)
-
-        # Do the actual replacing thing, first link the exported group
-        bpy.ops.wm.link(
-            filepath=linkpath,
-            directory=linkdir,
-            filename=linkcol
-        )
 
-        # Add the node group to the tree
-        #XXX Assumes unique group names
-        linked_nodegroup = bpy.data.node_groups[linkcol]
-        # Get node group type
-        #XXX Assuming here that the node group type for adding is it's self-reported type + "NodeGroup". May break for custom nodes
-        if linked_nodegroup.type == 'COMPOSITING':
-            nodetree_type = "CompositorNodeGroup"
+def export_blend_nodes(context, export_settings):
+    print("Exporting nodes to .blend...")
+    log = ExportLog("nodes", export_settings["filepath"])
+
+    with log.phase("collect"):
+        current_nodetree = context.active_node.id_data
+        if export_settings["export_selected"]:
+            nodes = [node for node in current_nodetree.nodes if node.select]
         else:
-            nodetree_type = linked_nodegroup.type.title() + "NodeGroup"
-        replacement_group = current_nodetree.nodes.new(nodetree_type)
-        replacement_group.node_tree = linked_nodegroup
+            nodes = list(current_nodetree.nodes)
+
+    boundary, group_name = export_node_selection(current_nodetree, nodes, export_settings, log)
+
+    # If backlinks are activated, replace the nodes with the exported group, linked from the new file
+    if export_settings["export_selected"] and export_settings["export_as_group"] and export_settings["backlink"]:
+        with log.phase("backlink"):
+            linked_nodegroup = load_linked(export_settings["filepath"], {"node_groups": [group_name]})["node_groups"][0]
+            replace_with_group(current_nodetree, nodes, linked_nodegroup, boundary)
+            invalidate_dependency_cache()
+
+    finish_log(log, export_settings)
+    return log.summary()
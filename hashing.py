@@ -0,0 +1,409 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+
+import bpy
+import array
+import hashlib
+import json
+import os
+
+from mathutils import Vector, Matrix, Euler, Quaternion, Color
+
+# Local imports
+from .utilities import write_json
+
+
+# Sidecar file kept next to exported .blend files, mapping each file name to the hash it was written with
+HASH_MANIFEST_NAME = ".export_blend_hashes.json"
+
+# Settings that change what ends up in the file, so they're part of the hash too
+HASHED_SETTINGS = (
+    "export_selected",
+    "is_collection",
+    "export_as_collection",
+    "collection_name",
+    "mark_asset",
+    "share_dependencies",
+    "shared_ids",
+    "texture_store",
+    "strip",
+)
+
+# Properties that change all the time without changing what gets exported
+SKIPPED_PROPERTIES = {
+    "rna_type",
+    "users",
+    "use_fake_user",
+    "use_extra_user",
+    "is_evaluated",
+    "original",
+    "session_uid",
+    "tag",
+    "is_runtime_data",
+    "is_missing",
+    "is_embedded_data",
+    "is_library_indirect",
+    "preview",
+    "select",
+    "select_head",
+    "select_tail",
+    "select_control_point",
+    "select_left_handle",
+    "select_right_handle",
+    "is_dirty",
+    "bindcode",
+}
+
+# Mesh data is hashed in bulk with foreach_get instead of walking it element by element
+MESH_COLLECTIONS = {
+    "vertices",
+    "edges",
+    "polygons",
+    "loops",
+    "loop_triangles",
+    "loop_triangle_polygons",
+    "attributes",
+    "uv_layers",
+    "vertex_colors",
+    "color_attributes",
+    "polygon_normals",
+    "vertex_normals",
+    "corner_normals",
+    "face_maps",
+    "skin_vertices",
+    "vertex_creases",
+    "edge_creases",
+}
+
+# Reading these makes Blender load the image (or movie) into memory. The file or packed data
+# is hashed instead.
+IMAGE_PROPERTIES = {
+    "pixels",
+    "has_data",
+    "size",
+    "depth",
+    "channels",
+    "is_float",
+    "frame_duration",
+}
+
+# Same for volume grids, which are read from their file
+VOLUME_PROPERTIES = {
+    "grids",
+}
+
+# Shape keys and curves are hashed in bulk too, these are what that covers
+KEY_PROPERTIES = {
+    "key_blocks",
+}
+CURVE_PROPERTIES = {
+    "splines",
+}
+CURVES_PROPERTIES = {
+    "attributes",
+    "points",
+    "curves",
+    "position_data",
+    "curve_offset_data",
+    "normals",
+    "color_attributes",
+}
+POINTCLOUD_PROPERTIES = {
+    "attributes",
+    "points",
+    "position_data",
+    "color_attributes",
+}
+
+# Per-point values read with foreach_get, for points of each kind. Values a kind of
+# point doesn't have are left out.
+KEY_POINT_VALUES = (
+    ("co", 'f', 3),
+    ("handle_left", 'f', 3),
+    ("handle_right", 'f', 3),
+    ("tilt", 'f', 1),
+    ("radius", 'f', 1),
+)
+SPLINE_POINT_VALUES = (
+    ("co", 'f', 4),
+    ("tilt", 'f', 1),
+    ("radius", 'f', 1),
+    ("weight_softbody", 'f', 1),
+)
+BEZIER_POINT_VALUES = (
+    ("co", 'f', 3),
+    ("handle_left", 'f', 3),
+    ("handle_right", 'f', 3),
+    ("tilt", 'f', 1),
+    ("radius", 'f', 1),
+    ("weight_softbody", 'f', 1),
+)
+
+# Which foreach_get property holds the values of each attribute data type
+ATTRIBUTE_VALUES = {
+    'FLOAT': ("value", 'f', 1),
+    'INT': ("value", 'i', 1),
+    'FLOAT_VECTOR': ("vector", 'f', 3),
+    'FLOAT_COLOR': ("color", 'f', 4),
+    'BYTE_COLOR': ("color", 'f', 4),
+    'BOOLEAN': ("value", 'b', 1),
+    'FLOAT2': ("vector", 'f', 2),
+    'INT8': ("value", 'i', 1),
+    'INT32_2D': ("value", 'i', 2),
+    'QUATERNION': ("value", 'f', 4),
+}
+
+# How deep to follow nested (non-ID) structs
+MAX_DEPTH = 8
+
+
+def get_id_key(id_data):
+    # Identifies an ID across sessions, unlike as_pointer()
+    library = id_data.library.filepath if id_data.library else ""
+    return "%s:%s:%s" % (id_data.id_type, id_data.name, library)
+
+
+def hash_value(hasher, value):
+    if isinstance(value, bpy.types.ID):
+        # Other IDs are part of the closure and hashed on their own, so a reference is enough
+        hasher.update(get_id_key(value).encode())
+    elif isinstance(value, float):
+        hasher.update(repr(round(value, 6)).encode())
+    elif isinstance(value, (Vector, Euler, Quaternion, Color)):
+        hasher.update(repr(tuple(round(v, 6) for v in value)).encode())
+    elif isinstance(value, Matrix):
+        hasher.update(repr(tuple(round(v, 6) for row in value for v in row)).encode())
+    elif isinstance(value, (set, frozenset)):
+        hasher.update(repr(sorted(value)).encode())
+    elif hasattr(value, "__len__") and not isinstance(value, (str, bytes)):
+        for item in value:
+            hash_value(hasher, item)
+    else:
+        hasher.update(repr(value).encode())
+
+
+def hash_foreach(hasher, collection, prop, typecode, width):
+    values = array.array(typecode, [0]) * (len(collection) * width)
+    collection.foreach_get(prop, values)
+    hasher.update(values.tobytes())
+
+
+def hash_points(hasher, points, values):
+    for prop, typecode, width in values:
+        try:
+            hash_foreach(hasher, points, prop, typecode, width)
+        except (AttributeError, TypeError, RuntimeError):
+            # Not something this kind of point has
+            continue
+        hasher.update(prop.encode())
+
+
+def hash_attributes(hasher, attributes):
+    for attribute in sorted(attributes, key=lambda attribute: attribute.name):
+        hasher.update(("%s:%s:%s" % (attribute.name, attribute.domain, attribute.data_type)).encode())
+        if attribute.data_type in ATTRIBUTE_VALUES:
+            prop, typecode, width = ATTRIBUTE_VALUES[attribute.data_type]
+            hash_foreach(hasher, attribute.data, prop, typecode, width)
+        else:
+            hash_value(hasher, [item.value for item in attribute.data])
+
+
+def hash_mesh(hasher, mesh):
+    hash_foreach(hasher, mesh.vertices, "co", 'f', 3)
+    hash_foreach(hasher, mesh.edges, "vertices", 'i', 2)
+    hash_foreach(hasher, mesh.loops, "vertex_index", 'i', 1)
+    hash_foreach(hasher, mesh.polygons, "loop_start", 'i', 1)
+    hash_foreach(hasher, mesh.polygons, "material_index", 'i', 1)
+    hash_attributes(hasher, mesh.attributes)
+
+
+def hash_key(hasher, key, visited):
+    # Everything about each shape key but its points goes through hash_struct, which also stops
+    # reference_key being walked again
+    for key_block in key.key_blocks:
+        hash_struct(hasher, key_block, visited, 1, skipped={"data"})
+        hash_points(hasher, key_block.data, KEY_POINT_VALUES)
+
+
+def hash_curve(hasher, curve, visited):
+    for spline in curve.splines:
+        hash_struct(hasher, spline, visited, 1, skipped={"points", "bezier_points"})
+        hash_points(hasher, spline.points, SPLINE_POINT_VALUES)
+        hash_points(hasher, spline.bezier_points, BEZIER_POINT_VALUES)
+        hash_value(hasher, [(point.handle_left_type, point.handle_right_type) for point in spline.bezier_points])
+
+
+def hash_curves(hasher, curves):
+    # Hair curves and point clouds keep everything in attributes, positions included
+    hash_attributes(hasher, curves.attributes)
+    if hasattr(curves, "curve_offset_data"):
+        hash_foreach(hasher, curves.curve_offset_data, "value", 'i', 1)
+
+
+def hash_struct(hasher, struct, visited, depth=0, skipped=()):
+    pointer = struct.as_pointer()
+    if pointer in visited or depth > MAX_DEPTH:
+        return
+    visited.add(pointer)
+
+    for prop in struct.bl_rna.properties:
+        identifier = prop.identifier
+        if identifier in SKIPPED_PROPERTIES or identifier in skipped:
+            continue
+        try:
+            value = getattr(struct, identifier)
+        except (AttributeError, RuntimeError):
+            continue
+        hasher.update(identifier.encode())
+        if prop.type == 'POINTER':
+            if value is None or isinstance(value, bpy.types.ID):
+                hash_value(hasher, value)
+            else:
+                hash_struct(hasher, value, visited, depth + 1)
+        elif prop.type == 'COLLECTION':
+            for item in value:
+                if isinstance(item, bpy.types.ID):
+                    hash_value(hasher, item)
+                else:
+                    hash_struct(hasher, item, visited, depth + 1)
+        else:
+            hash_value(hasher, value)
+
+
+def hash_external_file(hasher, filepath):
+    # External files are hashed by size and modification time rather than read in full
+    path = bpy.path.abspath(filepath)
+    try:
+        stat = os.stat(path)
+        hasher.update(("%s:%d:%d" % (path, stat.st_size, stat.st_mtime_ns)).encode())
+    except OSError:
+        hasher.update(path.encode())
+
+
+def hash_id(id_data):
+    hasher = hashlib.sha256()
+    hasher.update(get_id_key(id_data).encode())
+
+    # Linked data lives in its library, which the export only refers to
+    if id_data.library:
+        hash_external_file(hasher, id_data.library.filepath)
+        return hasher.hexdigest()
+
+    skipped = ()
+    visited = set()
+    if isinstance(id_data, bpy.types.Mesh):
+        hash_mesh(hasher, id_data)
+        skipped = MESH_COLLECTIONS
+    elif isinstance(id_data, bpy.types.Image):
+        skipped = IMAGE_PROPERTIES
+    elif isinstance(id_data, bpy.types.Volume):
+        skipped = VOLUME_PROPERTIES
+    elif isinstance(id_data, bpy.types.Key):
+        hash_key(hasher, id_data, visited)
+        skipped = KEY_PROPERTIES
+    elif isinstance(id_data, bpy.types.Curve):
+        hash_curve(hasher, id_data, visited)
+        skipped = CURVE_PROPERTIES
+    elif id_data.id_type == 'CURVES':
+        hash_curves(hasher, id_data)
+        skipped = CURVES_PROPERTIES
+    elif id_data.id_type == 'POINTCLOUD':
+        hash_curves(hasher, id_data)
+        skipped = POINTCLOUD_PROPERTIES
+
+    packed_file = getattr(id_data, "packed_file", None)
+    if packed_file is not None:
+        hasher.update(packed_file.data)
+    elif isinstance(id_data, (bpy.types.Image, bpy.types.VectorFont, bpy.types.Sound, bpy.types.Volume)):
+        hash_external_file(hasher, id_data.filepath)
+
+    hash_struct(hasher, id_data, visited, skipped=skipped)
+    # Node trees of materials, worlds, lights and so on belong to them rather than being
+    # datablocks of their own, so the reference hash_struct notes isn't enough
+    node_tree = getattr(id_data, "node_tree", None)
+    if node_tree is not None and node_tree.is_embedded_data:
+        hash_struct(hasher, node_tree, visited)
+    return hasher.hexdigest()
+
+
+def hash_export(datablocks, export_settings):
+    # A stable hash of everything an export would write, plus the settings it would be written with
+    hasher = hashlib.sha256()
+    for key in HASHED_SETTINGS:
+        hasher.update(("%s=%r;" % (key, export_settings.get(key))).encode())
+    for digest in sorted(hash_id(id_data) for id_data in datablocks):
+        hasher.update(digest.encode())
+    return hasher.hexdigest()
+
+
+def read_hash_manifest(directory):
+    try:
+        with open(os.path.join(directory, HASH_MANIFEST_NAME)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_hash_manifest(directory, hashes):
+    write_json(os.path.join(directory, HASH_MANIFEST_NAME), hashes)
+
+
+def write_manifest_changes(changes):
+    # Other exports may have written a manifest since it was read, so only the changed entries are written over it
+    for directory, hashes in changes.items():
+        manifest = read_hash_manifest(directory)
+        manifest.update(hashes)
+        write_hash_manifest(directory, manifest)
+
+
+class HashManifests:
+    # Reads and writes the sidecar manifests for a whole export, one per output directory
+    def __init__(self):
+        self.manifests = {}
+        self.changed = {}
+
+    def get(self, filepath):
+        directory, filename = os.path.split(filepath)
+        if directory not in self.manifests:
+            self.manifests[directory] = read_hash_manifest(directory)
+        return self.manifests[directory].get(filename)
+
+    def is_unchanged(self, filepath, digest):
+        return os.path.exists(filepath) and self.get(filepath) == digest
+
+    def set(self, filepath, digest):
+        directory, filename = os.path.split(filepath)
+        self.get(filepath)
+        self.manifests[directory][filename] = digest
+        self.changed.setdefault(directory, {})[filename] = digest
+
+    def take_changes(self):
+        # The entries set since the last save, by directory, for writing later on
+        changes = self.changed
+        self.changed = {}
+        return changes
+
+    def save(self):
+        write_manifest_changes(self.take_changes())
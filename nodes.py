@@ -0,0 +1,247 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+
+import bpy
+from mathutils import Vector
+
+
+# Group interface socket type for each socket type. Interface sockets (Blender 4.0+) don't take subtypes like NodeSocketFloatFactor.
+SOCKET_TYPES = {
+    'VALUE': "NodeSocketFloat",
+    'INT': "NodeSocketInt",
+    'BOOLEAN': "NodeSocketBool",
+    'VECTOR': "NodeSocketVector",
+    'ROTATION': "NodeSocketRotation",
+    'MATRIX': "NodeSocketMatrix",
+    'STRING': "NodeSocketString",
+    'RGBA': "NodeSocketColor",
+    'SHADER': "NodeSocketShader",
+    'GEOMETRY': "NodeSocketGeometry",
+    'OBJECT': "NodeSocketObject",
+    'COLLECTION': "NodeSocketCollection",
+    'IMAGE': "NodeSocketImage",
+    'MATERIAL': "NodeSocketMaterial",
+    'TEXTURE': "NodeSocketTexture",
+    'MENU': "NodeSocketMenu",
+}
+
+# Node properties that are either set separately or can't be copied
+SKIPPED_NODE_PROPERTIES = {
+    "rna_type",
+    "name",
+    "type",
+    "location",
+    "parent",
+    "select",
+    "inputs",
+    "outputs",
+    "internal_links",
+    "dimensions",
+    "is_active_output",
+    "bl_idname",
+    "bl_label",
+    "bl_description",
+    "bl_icon",
+    "bl_static_type",
+    "bl_width_default",
+    "bl_width_min",
+    "bl_width_max",
+    "bl_height_default",
+    "bl_height_min",
+    "bl_height_max",
+}
+
+
+def get_group_node_type(node_tree):
+    #XXX Assuming here that the node group type for adding is it's self-reported type + "NodeGroup". May break for custom nodes
+    if node_tree.type == 'COMPOSITING':
+        return "CompositorNodeGroup"
+    return node_tree.type.title() + "NodeGroup"
+
+
+def copy_properties(source, target, skipped=()):
+    # Copy every writable property that exists on both, quietly skipping anything Blender won't take
+    for prop in source.bl_rna.properties:
+        if prop.is_readonly or prop.identifier in skipped or prop.identifier == "rna_type":
+            continue
+        try:
+            setattr(target, prop.identifier, getattr(source, prop.identifier))
+        except (AttributeError, TypeError, ValueError, RuntimeError):
+            pass
+
+
+def copy_color_ramp(source, target):
+    copy_properties(source, target)
+    # New ramps start with two elements
+    while len(target.elements) < len(source.elements):
+        target.elements.new(0.0)
+    while len(target.elements) > len(source.elements):
+        target.elements.remove(target.elements[-1])
+    for source_element, target_element in zip(source.elements, target.elements):
+        target_element.position = source_element.position
+        target_element.color = source_element.color
+
+
+def copy_curve_mapping(source, target):
+    copy_properties(source, target)
+    for source_curve, target_curve in zip(source.curves, target.curves):
+        # New curves start with two points
+        while len(target_curve.points) < len(source_curve.points):
+            target_curve.points.new(0.0, 0.0)
+        for source_point, target_point in zip(source_curve.points, target_curve.points):
+            target_point.location = source_point.location
+            target_point.handle_type = source_point.handle_type
+    target.update()
+
+
+def copy_socket_values(source_sockets, target_sockets):
+    targets = {socket.identifier: socket for socket in target_sockets}
+    for source_socket in source_sockets:
+        target_socket = targets.get(source_socket.identifier)
+        if target_socket is None:
+            continue
+        target_socket.hide = source_socket.hide
+        if hasattr(source_socket, "default_value"):
+            try:
+                target_socket.default_value = source_socket.default_value
+            except (AttributeError, TypeError, ValueError):
+                pass
+
+
+def copy_node(source, node_tree):
+    node = node_tree.nodes.new(source.bl_idname)
+    node.name = source.name
+    # Properties first, since they can change which sockets are available
+    copy_properties(source, node, SKIPPED_NODE_PROPERTIES)
+    if getattr(source, "color_ramp", None) is not None:
+        copy_color_ramp(source.color_ramp, node.color_ramp)
+    if getattr(source, "mapping", None) is not None and isinstance(source.mapping, bpy.types.CurveMapping):
+        copy_curve_mapping(source.mapping, node.mapping)
+    copy_socket_values(source.inputs, node.inputs)
+    copy_socket_values(source.outputs, node.outputs)
+    return node
+
+
+def find_socket(sockets, identifier):
+    for socket in sockets:
+        if socket.identifier == identifier:
+            return socket
+    return None
+
+
+def new_group_socket(node_group, in_out, socket):
+    if bpy.app.version >= (4, 0, 0):
+        socket_type = SOCKET_TYPES.get(socket.type, "NodeSocketFloat")
+        group_socket = node_group.interface.new_socket(socket.name, in_out=in_out, socket_type=socket_type)
+    elif in_out == 'INPUT':
+        group_socket = node_group.inputs.new(socket.bl_idname, socket.name)
+    else:
+        group_socket = node_group.outputs.new(socket.bl_idname, socket.name)
+    if hasattr(socket, "default_value") and hasattr(group_socket, "default_value"):
+        try:
+            group_socket.default_value = socket.default_value
+        except (AttributeError, TypeError, ValueError):
+            pass
+    return group_socket
+
+
+def build_node_group(node_tree, nodes, name):
+    # Copy the nodes into a new node group, straight through the data API. The source tree is
+    # left alone. Links crossing the edge of the selection become group sockets.
+    # Returns the group and where its sockets connect in the source tree, so the group can
+    # be swapped in for the nodes later.
+    node_group = bpy.data.node_groups.new(name, node_tree.bl_idname)
+    selected = set(nodes)
+
+    copies = {}
+    for node in nodes:
+        copies[node] = copy_node(node, node_group)
+    # Parents and locations once every node exists, since locations are relative to the parent frame
+    for node, copy in copies.items():
+        if node.parent in copies:
+            copy.parent = copies[node.parent]
+        copy.location = node.location
+
+    locations = [node.location for node in nodes if node.parent not in selected] or [Vector((0.0, 0.0))]
+    min_x = min(location.x for location in locations)
+    max_x = max(location.x for location in locations)
+    center_y = sum(location.y for location in locations) / len(locations)
+
+    group_input = node_group.nodes.new("NodeGroupInput")
+    group_input.location = (min_x - 250, center_y)
+    group_output = node_group.nodes.new("NodeGroupOutput")
+    group_output.location = (max_x + 250, center_y)
+
+    # One group input per outside socket feeding the selection,
+    # and one group output per selected socket feeding the outside
+    inputs = {}
+    outputs = {}
+    boundary = {"inputs": [], "outputs": []}
+    for link in node_tree.links:
+        from_inside = link.from_node in selected
+        to_inside = link.to_node in selected
+        if from_inside and to_inside:
+            node_group.links.new(
+                find_socket(copies[link.from_node].outputs, link.from_socket.identifier),
+                find_socket(copies[link.to_node].inputs, link.to_socket.identifier)
+            )
+        elif to_inside:
+            if link.from_socket not in inputs:
+                new_group_socket(node_group, 'INPUT', link.to_socket)
+                inputs[link.from_socket] = len(inputs)
+                boundary["inputs"].append((link.from_socket, inputs[link.from_socket]))
+            node_group.links.new(
+                group_input.outputs[inputs[link.from_socket]],
+                find_socket(copies[link.to_node].inputs, link.to_socket.identifier)
+            )
+        elif from_inside:
+            if link.from_socket not in outputs:
+                new_group_socket(node_group, 'OUTPUT', link.from_socket)
+                outputs[link.from_socket] = len(outputs)
+                node_group.links.new(
+                    find_socket(copies[link.from_node].outputs, link.from_socket.identifier),
+                    group_output.inputs[outputs[link.from_socket]]
+                )
+            boundary["outputs"].append((outputs[link.from_socket], link.to_socket))
+
+    return node_group, boundary
+
+
+def replace_with_group(node_tree, nodes, node_group, boundary):
+    # Swap the nodes for a single group node, reconnected the way the nodes were
+    selected = set(nodes)
+    locations = [node.location for node in nodes if node.parent not in selected] or [Vector((0.0, 0.0))]
+    group_node = node_tree.nodes.new(get_group_node_type(node_tree))
+    group_node.node_tree = node_group
+    group_node.location = sum(locations, Vector((0.0, 0.0))) / len(locations)
+
+    for from_socket, index in boundary["inputs"]:
+        node_tree.links.new(from_socket, group_node.inputs[index])
+    for index, to_socket in boundary["outputs"]:
+        node_tree.links.new(group_node.outputs[index], to_socket)
+
+    for node in nodes:
+        node_tree.nodes.remove(node)
+    return group_node
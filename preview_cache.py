@@ -0,0 +1,184 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+
+import bpy
+import array
+import hashlib
+import os
+import struct
+
+# Local imports
+from .hashing import (
+    get_id_key,
+    hash_value,
+    hash_struct,
+    hash_mesh,
+    hash_key,
+    hash_curve,
+    hash_curves,
+    hash_external_file,
+)
+
+
+# Folder in Blender's user data folder where rendered asset previews are kept between exports
+CACHE_DIR_NAME = "export_blend_previews"
+
+# Default limit for the cache, in bytes
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+# Each cached preview is its width and height followed by the RGBA pixels
+HEADER = struct.Struct("<II")
+
+
+def get_cache_dir():
+    return bpy.utils.user_resource('DATAFILES', path=CACHE_DIR_NAME, create=True)
+
+
+# Datablocks whose settings (and node trees) change how things are shaded
+SHADING_TYPES = (bpy.types.Material, bpy.types.World, bpy.types.Light, bpy.types.Texture, bpy.types.NodeTree)
+
+
+def hash_object_appearance(hasher, ob):
+    # Where it is and what's on it, rather than every setting an object has
+    hash_value(hasher, (ob.type, ob.data, ob.matrix_world, ob.hide_render, ob.instance_type, ob.instance_collection))
+    hash_value(hasher, [(slot.link, slot.material) for slot in ob.material_slots])
+    visited = set()
+    for modifier in ob.modifiers:
+        hash_struct(hasher, modifier, visited)
+        # Geometry nodes inputs are kept as custom properties on the modifier
+        hash_value(hasher, [(key, modifier[key]) for key in modifier.keys()])
+
+
+def hash_appearance(id_data):
+    # Enough of an ID to tell whether its preview would look different: its geometry, its
+    # shading and the files its images come from. Much cheaper than hashing.hash_id.
+    hasher = hashlib.sha256()
+    hasher.update(get_id_key(id_data).encode())
+    if id_data.library:
+        hash_external_file(hasher, id_data.library.filepath)
+        return hasher.hexdigest()
+
+    if isinstance(id_data, bpy.types.Object):
+        hash_object_appearance(hasher, id_data)
+    elif isinstance(id_data, bpy.types.Mesh):
+        hash_mesh(hasher, id_data)
+    elif isinstance(id_data, bpy.types.Curve):
+        hash_curve(hasher, id_data, set())
+    elif id_data.id_type in {'CURVES', 'POINTCLOUD'}:
+        hash_curves(hasher, id_data)
+    elif isinstance(id_data, bpy.types.Key):
+        hash_key(hasher, id_data, set())
+    elif isinstance(id_data, SHADING_TYPES):
+        visited = set()
+        hash_struct(hasher, id_data, visited)
+        # Node trees of materials, worlds and lights are part of them rather than datablocks of their own
+        if getattr(id_data, "node_tree", None) is not None:
+            hash_struct(hasher, id_data.node_tree, visited)
+
+    packed_file = getattr(id_data, "packed_file", None)
+    if packed_file is not None:
+        hasher.update(packed_file.data)
+    elif isinstance(id_data, (bpy.types.Image, bpy.types.VectorFont)):
+        hash_external_file(hasher, id_data.filepath)
+    return hasher.hexdigest()
+
+
+def get_preview_key(datablocks):
+    # The preview only changes when something in it does, so hash what it's rendered from.
+    # Preview rendering changes between Blender versions, so that's part of the key too.
+    hasher = hashlib.sha256()
+    hasher.update(bpy.app.version_string.encode())
+    for digest in sorted(hash_appearance(id_data) for id_data in datablocks):
+        hasher.update(digest.encode())
+    return hasher.hexdigest()
+
+
+def get_export_preview_key(id_data, export_digest):
+    # An export's content hash already covers everything its assets are rendered from
+    hasher = hashlib.sha256()
+    hasher.update(bpy.app.version_string.encode())
+    hasher.update(get_id_key(id_data).encode())
+    hasher.update(export_digest.encode())
+    return hasher.hexdigest()
+
+
+def get_cache_path(key):
+    return os.path.join(get_cache_dir(), key + ".preview")
+
+
+def load_preview(id_data, key):
+    # Give the ID the cached preview, if there is one
+    cache_path = get_cache_path(key)
+    try:
+        with open(cache_path, "rb") as cache_file:
+            width, height = HEADER.unpack(cache_file.read(HEADER.size))
+            pixels = array.array('i')
+            pixels.frombytes(cache_file.read())
+    except (OSError, struct.error, ValueError):
+        return False
+    if len(pixels) != width * height:
+        return False
+
+    preview = id_data.preview_ensure()
+    preview.image_size = (width, height)
+    preview.image_pixels.foreach_set(pixels)
+    # Touch it, so the least recently used previews are the first to go
+    os.utime(cache_path)
+    return True
+
+
+def save_preview(id_data, key):
+    width, height = id_data.preview.image_size
+    pixels = array.array('i', [0]) * (width * height)
+    id_data.preview.image_pixels.foreach_get(pixels)
+
+    cache_path = get_cache_path(key)
+    temp_path = cache_path + ".tmp"
+    try:
+        with open(temp_path, "wb") as cache_file:
+            cache_file.write(HEADER.pack(width, height))
+            cache_file.write(pixels.tobytes())
+        os.replace(temp_path, cache_path)
+    except OSError as error:
+        print("Couldn't cache the preview for %s: %s" % (id_data.name, error))
+
+
+def trim_cache(max_size):
+    # Remove the least recently used previews until the cache fits in max_size bytes
+    cache_dir = get_cache_dir()
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if filename.endswith(".preview"):
+            stat = os.stat(os.path.join(cache_dir, filename))
+            entries.append((stat.st_mtime, stat.st_size, filename))
+    total_size = sum(size for mtime, size, filename in entries)
+    for mtime, size, filename in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, filename))
+        except OSError:
+            continue
+        total_size -= size
@@ -0,0 +1,131 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+
+import bpy
+import hashlib
+import os
+
+
+# Proxies are written next to the full export, with this added to the name
+PROXY_SUFFIX = "_proxy"
+
+
+def is_proxy_path(filepath):
+    return os.path.splitext(filepath)[0].endswith(PROXY_SUFFIX)
+
+
+def get_proxy_path(filepath):
+    if is_proxy_path(filepath):
+        return filepath
+    base, extension = os.path.splitext(filepath)
+    return base + PROXY_SUFFIX + extension
+
+
+def get_full_path(filepath):
+    if not is_proxy_path(filepath):
+        return filepath
+    base, extension = os.path.splitext(filepath)
+    return base[:-len(PROXY_SUFFIX)] + extension
+
+
+def get_proxy_digest(filepath, ratio, texture_size):
+    # What a proxy is made from and how: the full file's contents and the proxy settings.
+    # A full file written again gets a new digest even when nothing in it changed, which only
+    # means its proxy is made again.
+    hasher = hashlib.sha256(("%r:%r;" % (ratio, texture_size)).encode())
+    with open(filepath, "rb") as blend_file:
+        for chunk in iter(lambda: blend_file.read(1024 * 1024), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def make_proxy_meshes(ratio):
+    # Bake every mesh object down to a decimated copy of its evaluated mesh, without modifiers.
+    # Object and mesh names stay the same, so a proxy can stand in for the full version.
+    # Objects without modifiers of their own that share a mesh keep sharing its proxy.
+    objects = [ob for ob in bpy.data.objects if ob.type == 'MESH' and not ob.library]
+    unmodified = {ob for ob in objects if not ob.modifiers}
+    if ratio < 1.0:
+        for ob in objects:
+            modifier = ob.modifiers.new("proxy_decimate", 'DECIMATE')
+            modifier.ratio = ratio
+
+    depsgraph = bpy.context.evaluated_depsgraph_get()
+    shared = {}
+    renames = {}
+    for ob in objects:
+        original = ob.data
+        proxy_mesh = shared.get(original) if ob in unmodified else None
+        if proxy_mesh is None:
+            proxy_mesh = bpy.data.meshes.new_from_object(ob.evaluated_get(depsgraph))
+            if ob in unmodified:
+                shared[original] = proxy_mesh
+            renames.setdefault(original, (proxy_mesh, original.name))
+        ob.modifiers.clear()
+        ob.data = proxy_mesh
+
+    # The full meshes have to go before their names are free for the proxies
+    for original, (proxy_mesh, name) in renames.items():
+        if original.users == 0:
+            bpy.data.meshes.remove(original)
+            proxy_mesh.name = name
+
+
+def downsize_images(max_size):
+    # Scale down every image bigger than max_size and pack it, so the proxy doesn't need the full textures
+    for image in bpy.data.images:
+        if image.library or image.source not in {'FILE', 'GENERATED'}:
+            continue
+        width, height = image.size
+        if max(width, height) <= max_size:
+            continue
+        scale = max_size / max(width, height)
+        image.scale(max(int(width * scale), 1), max(int(height * scale), 1))
+        image.pack()
+
+
+def get_swap_libraries(objects):
+    # Libraries the objects were backlinked from, including collections they instance
+    libraries = set()
+    for ob in objects:
+        if ob.library:
+            libraries.add(ob.library)
+        if ob.instance_collection and ob.instance_collection.library:
+            libraries.add(ob.instance_collection.library)
+    return libraries
+
+
+def swap_library(library, use_proxy):
+    # Point the library at the proxy or the full version and reload it. Both have the same
+    # names in them, so everything linked from it carries on working.
+    if use_proxy:
+        filepath = get_proxy_path(library.filepath)
+    else:
+        filepath = get_full_path(library.filepath)
+    if filepath == library.filepath or not os.path.exists(bpy.path.abspath(filepath)):
+        return False
+    library.filepath = filepath
+    library.reload()
+    return True
@@ -0,0 +1,208 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+
+import bpy
+import array
+from bpy.types import PropertyGroup
+from bpy.props import StringProperty, BoolProperty
+
+# Local imports
+from .utilities import ID_TYPE_COLLECTIONS
+
+
+# Kinds of data an export profile can leave out, with the name shown for each
+STRIP_CATEGORIES = (
+    ("caches", "Simulations and Caches", "Cloth, soft body, fluid and dynamic paint simulations, with their caches"),
+    ("material_slots", "Unused Material Slots", "Material slots that no face uses"),
+    ("hidden_objects", "Hidden Helper Objects", "Objects disabled in renders that nothing else depends on"),
+    ("uv_maps", "Extra UV Maps", "Every UV map but the one used for rendering"),
+    ("color_attributes", "Extra Color Attributes", "Every color attribute but the one used for rendering"),
+    ("animation", "Animation", "Animation data, drivers and the actions only they used"),
+    ("custom_properties", "Large Custom Properties", "Custom properties that take up more than a few kilobytes"),
+)
+
+# Profiles available until the preferences say otherwise
+DEFAULT_PROFILES = (
+    ("full", ()),
+    ("library", ("caches", "material_slots", "animation")),
+    ("layout-slim", tuple(category for category, name, description in STRIP_CATEGORIES)),
+)
+
+SIMULATION_MODIFIERS = {'CLOTH', 'SOFT_BODY', 'FLUID', 'DYNAMIC_PAINT'}
+
+# Custom properties bigger than this (going by their text form) count as large
+LARGE_PROPERTY_SIZE = 4096
+
+
+class ExportProfile(PropertyGroup):
+    name: StringProperty(
+        name="Name",
+        default="profile"
+    )
+    caches: BoolProperty(name=STRIP_CATEGORIES[0][1], description=STRIP_CATEGORIES[0][2], default=False)
+    material_slots: BoolProperty(name=STRIP_CATEGORIES[1][1], description=STRIP_CATEGORIES[1][2], default=False)
+    hidden_objects: BoolProperty(name=STRIP_CATEGORIES[2][1], description=STRIP_CATEGORIES[2][2], default=False)
+    uv_maps: BoolProperty(name=STRIP_CATEGORIES[3][1], description=STRIP_CATEGORIES[3][2], default=False)
+    color_attributes: BoolProperty(name=STRIP_CATEGORIES[4][1], description=STRIP_CATEGORIES[4][2], default=False)
+    animation: BoolProperty(name=STRIP_CATEGORIES[5][1], description=STRIP_CATEGORIES[5][2], default=False)
+    custom_properties: BoolProperty(name=STRIP_CATEGORIES[6][1], description=STRIP_CATEGORIES[6][2], default=False)
+
+
+def ensure_default_profiles(preferences):
+    # Only ever done once, so removing every profile leaves the list empty
+    if preferences.default_profiles_added:
+        return
+    preferences.default_profiles_added = True
+    if len(preferences.profiles):
+        return
+    for name, categories in DEFAULT_PROFILES:
+        profile = preferences.profiles.add()
+        profile.name = name
+        for category in categories:
+            setattr(profile, category, True)
+
+
+def get_profile_strip(preferences, name):
+    # The categories a profile strips, as a sorted list so it can be sent to workers and hashed
+    for profile in preferences.profiles:
+        if profile.name == name:
+            return sorted(category for category, label, description in STRIP_CATEGORIES if getattr(profile, category))
+    for profile_name, categories in DEFAULT_PROFILES:
+        if profile_name == name:
+            return sorted(categories)
+    return []
+
+
+# Enum items have to stay referenced while Blender uses them
+_profile_items = []
+
+
+def get_profile_items(self, context):
+    preferences = context.preferences.addons[__package__].preferences
+    names = [profile.name for profile in preferences.profiles] or [name for name, categories in DEFAULT_PROFILES]
+    _profile_items[:] = [(name, name, "Export with the %s profile" % name) for name in names]
+    return _profile_items
+
+
+# Worker side: these change the open file, which is a copy of the export
+
+def strip_caches():
+    for ob in bpy.data.objects:
+        for modifier in [modifier for modifier in ob.modifiers if modifier.type in SIMULATION_MODIFIERS]:
+            ob.modifiers.remove(modifier)
+
+
+def strip_material_slots():
+    for mesh in bpy.data.meshes:
+        if mesh.library or not mesh.materials:
+            continue
+        indices = array.array('i', [0]) * len(mesh.polygons)
+        mesh.polygons.foreach_get("material_index", indices)
+        used = set(indices)
+        # Popping a slot moves the faces after it down one, so go from the end
+        for index in reversed(range(len(mesh.materials))):
+            if index not in used:
+                mesh.materials.pop(index=index)
+
+
+def strip_hidden_objects():
+    # Only objects nothing depends on, so no parent, constraint or modifier is left pointing nowhere
+    user_map = bpy.data.user_map(subset=[ob for ob in bpy.data.objects if ob.hide_render and not ob.library])
+    for ob, users in user_map.items():
+        if ob.children:
+            continue
+        if all(isinstance(user, (bpy.types.Collection, bpy.types.Scene)) for user in users):
+            bpy.data.objects.remove(ob)
+
+
+def strip_uv_maps():
+    for mesh in bpy.data.meshes:
+        if mesh.library:
+            continue
+        # Removing a layer moves the ones after it, so look each one up again by name
+        for name in [layer.name for layer in mesh.uv_layers if not layer.active_render]:
+            mesh.uv_layers.remove(mesh.uv_layers[name])
+
+
+def strip_color_attributes():
+    for mesh in bpy.data.meshes:
+        if mesh.library:
+            continue
+        if hasattr(mesh, "color_attributes"):
+            render_color = mesh.color_attributes.render_color_index
+            for index in reversed(range(len(mesh.color_attributes))):
+                if index != render_color:
+                    mesh.color_attributes.remove(mesh.color_attributes[index])
+        else:
+            for name in [layer.name for layer in mesh.vertex_colors if not layer.active_render]:
+                mesh.vertex_colors.remove(mesh.vertex_colors[name])
+
+
+def strip_animation():
+    for attr in ID_TYPE_COLLECTIONS.values():
+        for id_data in getattr(bpy.data, attr, ()):
+            if not id_data.library and getattr(id_data, "animation_data", None) is not None:
+                id_data.animation_data_clear()
+    # Actions with nothing using them now would otherwise be kept by their fake user
+    for action in bpy.data.actions:
+        if not action.library and action.users == int(action.use_fake_user):
+            action.use_fake_user = False
+
+
+def get_property_size(value):
+    if hasattr(value, "to_dict"):
+        value = value.to_dict()
+    elif hasattr(value, "to_list"):
+        value = value.to_list()
+    return len(repr(value))
+
+
+def strip_custom_properties():
+    for attr in ID_TYPE_COLLECTIONS.values():
+        for id_data in getattr(bpy.data, attr, ()):
+            if id_data.library:
+                continue
+            for key in list(id_data.keys()):
+                # Properties registered by add-ons are stored the same way, but they're not ours to remove
+                if key in id_data.bl_rna.properties:
+                    continue
+                if get_property_size(id_data[key]) > LARGE_PROPERTY_SIZE:
+                    del id_data[key]
+
+
+STRIP_FUNCTIONS = {
+    "caches": strip_caches,
+    "material_slots": strip_material_slots,
+    "hidden_objects": strip_hidden_objects,
+    "uv_maps": strip_uv_maps,
+    "color_attributes": strip_color_attributes,
+    "animation": strip_animation,
+    "custom_properties": strip_custom_properties,
+}
+
+
+def strip_data(categories):
+    for category in categories:
+        STRIP_FUNCTIONS[category]()
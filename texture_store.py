@@ -0,0 +1,129 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+
+import bpy
+import hashlib
+import os
+import shutil
+
+# Local imports
+from .asset_index import get_library_root
+
+
+# Folder at the library root where external files are kept, named by the hash of their contents
+STORE_DIR_NAME = ".export_blend_files"
+
+# Hashes of files already read this session, keyed by path, size and modification time
+_file_hashes = {}
+
+
+def get_store_dir(filepath, library_path=None):
+    return os.path.join(get_library_root(filepath, library_path), STORE_DIR_NAME)
+
+
+def hash_file(path):
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    digest = _file_hashes.get(key)
+    if digest is None:
+        hasher = hashlib.sha256()
+        with open(path, "rb") as source_file:
+            for block in iter(lambda: source_file.read(1024 * 1024), b""):
+                hasher.update(block)
+        digest = _file_hashes[key] = hasher.hexdigest()
+    return digest
+
+
+def store_file(path, store_dir):
+    # Put the file in the store, unless the same contents are already there, and return where it is.
+    # A hardlink costs nothing, so only copy when the store's on another drive or links aren't supported.
+    digest = hash_file(path)
+    stored_path = os.path.join(store_dir, digest[:2], digest + os.path.splitext(path)[1].lower())
+    if os.path.exists(stored_path):
+        return stored_path
+    os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+    try:
+        os.link(path, stored_path)
+    except FileExistsError:
+        pass
+    except OSError:
+        # Another export (or worker) may be storing the same file, so each copies to its own temporary name
+        temp_path = "%s.%d.tmp" % (stored_path, os.getpid())
+        shutil.copy2(path, temp_path)
+        os.replace(temp_path, stored_path)
+    return stored_path
+
+
+def get_external_path_property(id_data):
+    # Which property holds the file path, for datablocks that use a file that could be stored
+    if id_data.library or getattr(id_data, "packed_file", None) is not None:
+        return None
+    if isinstance(id_data, bpy.types.Image):
+        # UDIM tiles and image sequences are many files, so they're left where they are
+        if id_data.source not in {'FILE', 'MOVIE'}:
+            return None
+        # Setting filepath_raw doesn't reload the image
+        return "filepath_raw"
+    # Fonts and sounds have no way to change their path without reloading them, which in
+    # your own session would reload them twice for every export and show up as changes. In a
+    # background Blender (command line exports, workers) that doesn't matter.
+    if not bpy.app.background:
+        return None
+    if isinstance(id_data, bpy.types.VectorFont):
+        if id_data.filepath == "<builtin>":
+            return None
+        return "filepath"
+    if isinstance(id_data, bpy.types.Sound):
+        return "filepath"
+    return None
+
+
+def store_external_files(datablocks, export_settings):
+    # Point every image, font and sound in the export at its copy in the store for the write.
+    # Returns what was changed, for restore_external_files to put back afterwards.
+    store_dir = get_store_dir(export_settings["filepath"], bpy.path.abspath(export_settings.get("library_path") or ""))
+    changes = []
+    try:
+        for id_data in datablocks:
+            prop = get_external_path_property(id_data)
+            if prop is None:
+                continue
+            original_path = getattr(id_data, prop)
+            path = os.path.normpath(bpy.path.abspath(original_path, library=id_data.library))
+            if not os.path.isfile(path):
+                print("Couldn't store %s, %s is missing" % (id_data.name, path))
+                continue
+            stored_path = store_file(path, store_dir)
+            setattr(id_data, prop, stored_path)
+            changes.append((id_data, prop, original_path))
+    except Exception:
+        restore_external_files(changes)
+        raise
+    return changes
+
+
+def restore_external_files(changes):
+    for id_data, prop, original_path in reversed(changes):
+        setattr(id_data, prop, original_path)
@@ -0,0 +1,102 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+
+import bpy
+from bpy.app.handlers import persistent
+
+# Local imports
+from .hashing import hash_export, get_id_key
+
+
+# Everything exported this session while tracking was on, keyed by the file it was written to
+_tracked_exports = {}
+
+# Which of those files each datablock ended up in, by get_id_key
+_id_users = {}
+
+# Files with a datablock that changed since they were written. Changes are only noticed
+# here; whether the contents really differ is checked with the hash before re-exporting.
+_changed_exports = set()
+
+
+def track_export(export_settings, objects, datablocks, digest=None):
+    filepath = export_settings["filepath"]
+    untrack_export(filepath)
+    # Linked data can't be edited here, so it never makes an export out of date
+    keys = {get_id_key(id_data) for id_data in datablocks if not id_data.library}
+    _tracked_exports[filepath] = {
+        # Collections in the settings are only needed to find the batch, not to redo one item of it
+        "settings": {key: value for key, value in export_settings.items() if key != "collections"},
+        "objects": [ob.name for ob in objects],
+        "hash": digest or hash_export(datablocks, export_settings),
+        "keys": keys,
+    }
+    for key in keys:
+        _id_users.setdefault(key, set()).add(filepath)
+
+
+def untrack_export(filepath):
+    tracked = _tracked_exports.pop(filepath, None)
+    if tracked is None:
+        return
+    for key in tracked["keys"]:
+        filepaths = _id_users[key]
+        filepaths.discard(filepath)
+        if not filepaths:
+            del _id_users[key]
+    _changed_exports.discard(filepath)
+
+
+def get_tracked_export(filepath):
+    return _tracked_exports.get(filepath)
+
+
+def get_changed_exports():
+    return sorted(_changed_exports)
+
+
+def mark_unchanged(filepath):
+    _changed_exports.discard(filepath)
+
+
+@persistent
+def tag_changed_exports(scene, depsgraph=None):
+    # Runs on every depsgraph update, so it only looks at the IDs that were actually updated
+    if not _id_users:
+        return
+    if depsgraph is None:
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+    for update in depsgraph.updates:
+        filepaths = _id_users.get(get_id_key(update.id.original))
+        if filepaths:
+            _changed_exports.update(filepaths)
+
+
+@persistent
+def clear_tracking(*args):
+    # Tracking is per file, so start over when another one is opened
+    _tracked_exports.clear()
+    _id_users.clear()
+    _changed_exports.clear()
@@ -0,0 +1,263 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+
+import bpy
+import atexit
+import hashlib
+import itertools
+import os
+import queue
+import shutil
+import threading
+import time
+
+
+# Tries per transfer before it's left for the user to retry, with a growing pause in between
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 2.0
+
+# Datablocks with a path to an external file, and the property it's in.
+# Setting filepath_raw on images doesn't reload them.
+PATH_PROPERTIES = (
+    (bpy.types.Image, "filepath_raw"),
+)
+
+# The rest can only have their path changed by reloading them, which in your own session would
+# reload them twice for every export and show up as changes. In a background Blender that doesn't matter.
+BACKGROUND_PATH_PROPERTIES = (
+    (bpy.types.VectorFont, "filepath"),
+    (bpy.types.Sound, "filepath"),
+    (bpy.types.MovieClip, "filepath"),
+    (bpy.types.CacheFile, "filepath"),
+    (bpy.types.Volume, "filepath"),
+)
+
+_stage_counter = itertools.count()
+
+
+def get_stage_path(stage_directory, filepath):
+    # Every write gets its own local file, so a file still being moved is never overwritten
+    os.makedirs(stage_directory, exist_ok=True)
+    digest = hashlib.sha1(os.path.abspath(filepath).encode()).hexdigest()[:12]
+    return os.path.join(stage_directory, "%s_%d_%s" % (digest, next(_stage_counter), os.path.basename(filepath)))
+
+
+def relocate_paths(datablocks, filepath):
+    # Files written somewhere else first can't have their paths made relative by Blender, since
+    # they'd be relative to the wrong folder. Make them relative to where the file ends up instead,
+    # for the write only. Returns what was changed, for restore_paths to put back afterwards.
+    directory = os.path.dirname(os.path.abspath(filepath))
+    changes = []
+    path_properties = PATH_PROPERTIES
+    if bpy.app.background:
+        path_properties += BACKGROUND_PATH_PROPERTIES
+    users = [(id_data, prop) for id_data in datablocks if not id_data.library
+             for id_type, prop in path_properties if isinstance(id_data, id_type)]
+    # Linked data keeps its own paths, but the libraries it comes from move with the file
+    users += [(library, "filepath") for library in {id_data.library for id_data in datablocks if id_data.library}]
+    for id_data, prop in users:
+        if getattr(id_data, "packed_file", None) is not None:
+            continue
+        original_path = getattr(id_data, prop)
+        if not original_path or original_path.startswith("<"):
+            continue
+        try:
+            path = "//" + os.path.relpath(bpy.path.abspath(original_path), directory).replace(os.sep, "/")
+        except ValueError:
+            # On another drive, so it can only stay absolute
+            path = bpy.path.abspath(original_path)
+        setattr(id_data, prop, path)
+        changes.append((id_data, prop, original_path))
+    return changes
+
+
+def restore_paths(changes):
+    for id_data, prop, original_path in reversed(changes):
+        setattr(id_data, prop, original_path)
+
+
+class Transfer:
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.status = 'QUEUED'
+        self.attempts = 0
+        self.error = None
+
+
+class TransferQueue:
+    # Moves locally written files to the library on a background thread, one at a time and in
+    # the order they were written. Anything else queued with call_after runs in that order too.
+    def __init__(self):
+        self.transfers = []
+        self.pending = queue.Queue()
+        self.outstanding = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def add(self, source, target):
+        transfer = Transfer(source, target)
+        with self.condition:
+            self.transfers.append(transfer)
+            self.outstanding += 1
+        self.pending.put(transfer)
+        self.start()
+        return transfer
+
+    def call_after(self, callback):
+        # Run callback once every transfer queued so far is done, or straight away if there are none
+        with self.condition:
+            if self.outstanding:
+                self.outstanding += 1
+                self.pending.put(callback)
+                return
+        callback()
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            try:
+                if isinstance(item, Transfer):
+                    self.move(item)
+                else:
+                    item()
+            except Exception as error:
+                print("Library transfer error: %s" % error)
+            with self.condition:
+                self.outstanding -= 1
+                self.condition.notify_all()
+
+    def move(self, transfer):
+        while True:
+            transfer.attempts += 1
+            transfer.status = 'MOVING'
+            try:
+                move_file(transfer.source, transfer.target)
+            except OSError as error:
+                transfer.error = str(error)
+                if transfer.attempts >= MAX_ATTEMPTS:
+                    transfer.status = 'FAILED'
+                    print("Couldn't move %s to the library: %s" % (transfer.target, error))
+                    return
+                transfer.status = 'RETRYING'
+                time.sleep(RETRY_DELAY * transfer.attempts)
+                continue
+            transfer.status = 'FINISHED'
+            transfer.error = None
+            return
+
+    def is_pending(self, filepath):
+        with self.condition:
+            return self.is_pending_locked(filepath)
+
+    def wait(self, filepaths=None, timeout=None):
+        # Block until the given files (or everything) are in the library. Returns False on timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                if filepaths is None:
+                    if not self.outstanding:
+                        return True
+                elif not any(self.is_pending_locked(filepath) for filepath in filepaths):
+                    return True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+
+    def is_pending_locked(self, filepath):
+        filepath = os.path.abspath(filepath)
+        return any(os.path.abspath(transfer.target) == filepath and transfer.status not in {'FINISHED', 'FAILED'}
+                   for transfer in self.transfers)
+
+    def get_status(self, filepath):
+        # How the latest transfer to filepath went, or None if nothing was moved there
+        filepath = os.path.abspath(filepath)
+        with self.condition:
+            for transfer in reversed(self.transfers):
+                if os.path.abspath(transfer.target) == filepath:
+                    return transfer.status
+        return None
+
+    def retry_failed(self):
+        retried = 0
+        with self.condition:
+            failed = [transfer for transfer in self.transfers
+                      if transfer.status == 'FAILED' and os.path.exists(transfer.source)]
+            for transfer in failed:
+                transfer.status = 'QUEUED'
+                transfer.attempts = 0
+                self.outstanding += 1
+                retried += 1
+        for transfer in failed:
+            self.pending.put(transfer)
+        if failed:
+            self.start()
+        return retried
+
+    def clear_finished(self):
+        with self.condition:
+            self.transfers = [transfer for transfer in self.transfers if transfer.status != 'FINISHED']
+
+    def get_transfers(self):
+        with self.condition:
+            return list(self.transfers)
+
+
+def move_file(source, target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        # Free if the local folder is on the same drive
+        os.replace(source, target)
+        return
+    except OSError:
+        pass
+    # Otherwise copy under a temporary name next to the target and rename it, the same way
+    # Blender saves, so the library never has a half-copied file in it
+    temp_path = target + "@"
+    try:
+        with open(source, "rb") as source_file, open(temp_path, "wb") as temp_file:
+            shutil.copyfileobj(source_file, temp_file, 1024 * 1024)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, target)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    os.remove(source)
+
+
+transfer_queue = TransferQueue()
+
+# Don't lose files that are still on their way when Blender quits
+atexit.register(transfer_queue.wait)
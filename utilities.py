@@ -1,4 +1,6 @@
 import bpy
+import json
+import os
 
 def get_default_path():
     asset_libraries = bpy.context.preferences.filepaths.asset_libraries
@@ -7,6 +9,13 @@ def get_default_path():
     else:
         return "//assets/"
 
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return ("%d %s" if unit == "B" else "%.1f %s") % (size, unit)
+
 def mode_toggle(context, switch_to):
     prev_mode = context.mode
     switch = {
@@ -20,4 +29,58 @@ def mode_toggle(context, switch_to):
         switch[prev_mode]()
     elif switch_to != 'OBJECT':
         switch[switch_to]()
-    return prev_mode
\ No newline at end of file
+    return prev_mode
+
+# bpy.data collection for each ID type, keyed by ID.id_type
+ID_TYPE_COLLECTIONS = {
+    'ACTION': "actions",
+    'ARMATURE': "armatures",
+    'BRUSH': "brushes",
+    'CACHEFILE': "cache_files",
+    'CAMERA': "cameras",
+    'COLLECTION': "collections",
+    'CURVE': "curves",
+    'CURVES': "hair_curves",
+    'FONT': "fonts",
+    'GREASEPENCIL': "grease_pencils",
+    'GREASEPENCIL_V3': "grease_pencils_v3",
+    'IMAGE': "images",
+    'KEY': "shape_keys",
+    'LATTICE': "lattices",
+    'LIBRARY': "libraries",
+    'LIGHT': "lights",
+    'LIGHT_PROBE': "lightprobes",
+    'LINESTYLE': "linestyles",
+    'MASK': "masks",
+    'MATERIAL': "materials",
+    'MESH': "meshes",
+    'META': "metaballs",
+    'MOVIECLIP': "movieclips",
+    'NODETREE': "node_groups",
+    'OBJECT': "objects",
+    'PAINTCURVE': "paint_curves",
+    'PALETTE': "palettes",
+    'PARTICLE': "particles",
+    'POINTCLOUD': "pointclouds",
+    'SCENE': "scenes",
+    'SOUND': "sounds",
+    'SPEAKER': "speakers",
+    'TEXT': "texts",
+    'TEXTURE': "textures",
+    'VOLUME': "volumes",
+    'WORKSPACE': "workspaces",
+    'WORLD': "worlds",
+}
+
+def get_id_collection(id_data):
+    return getattr(bpy.data, ID_TYPE_COLLECTIONS[id_data.id_type])
+
+def remove_id(id_data):
+    get_id_collection(id_data).remove(id_data)
+
+def write_json(filepath, data):
+    # Write to a temporary file first so a failed write never leaves a broken file behind
+    temp_filepath = filepath + ".tmp"
+    with open(temp_filepath, "w") as json_file:
+        json.dump(data, json_file, indent=2, sort_keys=True)
+    os.replace(temp_filepath, filepath)
@@ -0,0 +1,517 @@
+'''
+Copyright (C) 2021-2022 Orange Turbine
+https://orangeturbine.com
+orangeturbine@cgcookie.com
+
+Created by Jason van Gumster
+
+    This file is part of Export to .blend.
+
+    Export to .blend is free software; you can redistribute it and/or
+    modify it under the terms of the GNU General Public License
+    as published by the Free Software Foundation; either version 3
+    of the License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program; if not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+
+import bpy
+import fnmatch
+import json
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Local imports
+from .hashing import HashManifests
+from .functions import (
+    collect_dependencies,
+    get_dependency_map,
+    invalidate_dependency_cache,
+    get_batch_items,
+    get_export_roots,
+    get_shared_library_path,
+    link_shared_dependencies,
+    unlink_shared_dependencies,
+    plan_batch,
+    export_objects,
+    prepare_export,
+    write_export,
+    cleanup_export,
+    mark_assets,
+    restore_assets,
+    backlink_objects,
+    actually_export,
+    run_stages,
+    update_asset_index,
+    save_manifests,
+    refresh_asset_index,
+    track_exported,
+    get_child_collections,
+    get_unique_filepath,
+)
+from .transfers import transfer_queue
+from .proxies import get_proxy_path, get_proxy_digest, make_proxy_meshes, downsize_images
+from .slim import strip_data
+
+
+# Workers print results on stdout with this prefix so they can be told apart from Blender's own output
+RESULT_PREFIX = "EXPORT_BLEND_RESULT "
+
+
+def get_blender_command(blend_path=None):
+    # Run this module's main() in a background Blender that has the add-on importable
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    expr = "import sys; sys.path.insert(0, %r); import %s.workers as w; w.main()" % (package_parent, __package__)
+    command = [bpy.app.binary_path, "--factory-startup", "-b"]
+    if blend_path:
+        command.append(blend_path)
+    command += ["--python-expr", expr]
+    return command
+
+
+def get_job_settings(export_settings):
+    # Only plain values can be sent to a worker
+    return {key: value for key, value in export_settings.items()
+            if isinstance(value, (str, int, float, bool, type(None)))}
+
+
+class WorkerPool:
+    # Runs jobs across background Blender processes. Each worker pulls the next job
+    # as soon as it's done with the last one, so a few heavy jobs don't hold up the rest.
+    def __init__(self, blend_path=None, worker_count=0):
+        self.blend_path = blend_path
+        self.worker_count = worker_count or os.cpu_count() or 1
+        self.cancelled = False
+        self.finished = 0
+        self.processes = set()
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        # Stop handing out jobs and stop the ones in progress
+        self.cancelled = True
+        with self.lock:
+            for process in self.processes:
+                process.kill()
+
+    def run(self, jobs, progress=None):
+        pending = queue.Queue()
+        for index, job in enumerate(jobs):
+            pending.put((index, job))
+        results = [None] * len(jobs)
+
+        def work():
+            process = None
+            try:
+                while not self.cancelled:
+                    try:
+                        index, job = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                    if process is None:
+                        process = subprocess.Popen(
+                            get_blender_command(self.blend_path),
+                            stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL,
+                            universal_newlines=True,
+                        )
+                        with self.lock:
+                            self.processes.add(process)
+                    result = self.run_job(process, job)
+                    if result is None:
+                        # The worker died (or was stopped), so start a fresh one for the next job
+                        process.kill()
+                        with self.lock:
+                            self.processes.discard(process)
+                        process = None
+                        if self.cancelled:
+                            continue
+                        result = {"status": 'FAILED', "error": "Worker process exited unexpectedly"}
+                    results[index] = result
+                    with self.lock:
+                        self.finished += 1
+                        if progress is not None:
+                            progress(self.finished, len(jobs))
+            finally:
+                if process is not None:
+                    try:
+                        process.stdin.close()
+                        process.wait(timeout=10)
+                    except (OSError, subprocess.TimeoutExpired):
+                        process.kill()
+                    with self.lock:
+                        self.processes.discard(process)
+
+        threads = [threading.Thread(target=work, daemon=True)
+                   for i in range(min(self.worker_count, len(jobs)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for index, result in enumerate(results):
+            if result is None:
+                results[index] = {"status": 'CANCELLED'}
+        return results
+
+    def run_job(self, process, job):
+        try:
+            process.stdin.write(json.dumps(job) + "\n")
+            process.stdin.flush()
+            while True:
+                line = process.stdout.readline()
+                if not line:
+                    break
+                if line.startswith(RESULT_PREFIX):
+                    return json.loads(line[len(RESULT_PREFIX):])
+        except (OSError, ValueError):
+            pass
+        return None
+
+
+def parallel_export_stages(context, export_settings, worker_count=0):
+    # The parallel batch export split into steps, like functions.export_stages. The workers run
+    # on their own thread, so while they're busy this only reports how far along they are.
+    # Closing it early stops the workers.
+    items = get_batch_items(context, export_settings)
+    yield 0.0, "Collecting dependencies"
+
+    # Unchanged items are skipped here, before they ever reach a worker
+    dependency_map = get_dependency_map()
+    manifests = HashManifests()
+    items, skipped, shared = plan_batch(items, export_settings, dependency_map, manifests)
+
+    results = []
+    if items:
+        yield 0.05, "Writing snapshot for workers"
+        # Shared datablocks are linked before the snapshot, so workers write links to them too
+        shared_state = None
+        if shared:
+            shared_state = link_shared_dependencies(shared, get_shared_library_path(export_settings))
+        replacements = shared_state["mapping"] if shared_state else {}
+
+        # Snapshot just the data the batch needs once, so every worker can open it quickly
+        roots = []
+        for item_settings, objects in items:
+            roots += get_export_roots(objects, item_settings)
+        snapshot_dir = tempfile.mkdtemp(prefix="export_blend_")
+        snapshot_path = os.path.join(snapshot_dir, "snapshot.blend")
+        try:
+            datablocks = collect_dependencies(roots, dependency_map, export_settings.get("keep_links", False))
+            actually_export({replacements.get(id_data, id_data) for id_data in datablocks}, snapshot_path)
+        finally:
+            if shared_state:
+                unlink_shared_dependencies(shared_state)
+
+        try:
+            jobs = []
+            for item_settings, objects in items:
+                jobs.append({
+                    "kind": 'EXPORT_OBJECTS',
+                    # Workers write straight to the library, they're not holding anything up
+                    "settings": get_job_settings(dict(item_settings, stage_directory="")),
+                    "objects": [ob.name for ob in objects],
+                })
+            results = yield from pool_stages(WorkerPool(snapshot_path, worker_count), jobs, "Exported", 0.1, 0.95)
+        finally:
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+    for (item_settings, objects), result in zip(items, results):
+        result.setdefault("filepath", item_settings["filepath"])
+        if result["status"] == 'FINISHED' and "content_hash" in item_settings:
+            manifests.set(item_settings["filepath"], item_settings["content_hash"])
+    save_manifests(manifests)
+    update_asset_index(export_settings, {result["filepath"]: result["assets"]
+                                         for result in results if result["status"] == 'FINISHED'})
+
+    items += skipped
+    results += [{"status": 'SKIPPED', "filepath": item_settings["filepath"]} for item_settings, objects in skipped]
+    track_exported([item for item, result in zip(items, results) if result["status"] in {'FINISHED', 'SKIPPED'}],
+                   dependency_map)
+
+    # Only backlink what's actually on disk
+    if export_settings["backlink"]:
+        yield 0.95, "Linking exported objects"
+        for (item_settings, objects), result in zip(items, results):
+            if result["status"] in {'FINISHED', 'SKIPPED'}:
+                backlink_objects(objects, item_settings)
+
+    return results
+
+
+def export_blend_batch_parallel(context, export_settings, worker_count=0):
+    print("Exporting batch to .blend files in parallel...")
+    return run_stages(parallel_export_stages(context, export_settings, worker_count), interval=0.05)
+
+
+def pool_stages(pool, jobs, message, start=0.0, end=1.0):
+    # Run jobs on a worker pool from a staged export. The workers run on their own thread, so
+    # this only reports how far along they are. Closing it early stops the workers.
+    if not jobs:
+        return []
+    outcome = []
+    thread = threading.Thread(target=lambda: outcome.append(pool.run(jobs)), daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            yield start + (end - start) * pool.finished / len(jobs), "%s %d of %d files" % (message, pool.finished, len(jobs))
+    finally:
+        if thread.is_alive():
+            pool.cancel()
+            thread.join()
+    return outcome[0]
+
+
+def get_written_files(result):
+    # Files an export wrote, from its counts or from its batch results
+    if isinstance(result, dict):
+        return set(result.get("files", ()))
+    return {file_result["filepath"] for file_result in result if file_result["status"] == 'FINISHED'}
+
+
+def add_saved(result, saved):
+    # Slimming goes in with the export's own results, for the report
+    if isinstance(result, dict):
+        result["saved"] = sum(saved.values())
+    else:
+        for file_result in result:
+            if file_result.get("filepath") in saved:
+                file_result["saved"] = saved[file_result["filepath"]]
+
+
+def get_proxy_jobs(filepaths, export_settings, manifests):
+    # Proxies are noted in the hash manifest with what they were made from, so Skip Unchanged
+    # only leaves out ones made from the same file with the same settings
+    jobs = []
+    for filepath in filepaths:
+        proxy_filepath = get_proxy_path(filepath)
+        digest = get_proxy_digest(filepath, export_settings["proxy_ratio"], export_settings["proxy_texture_size"])
+        if export_settings.get("incremental") and manifests.is_unchanged(proxy_filepath, digest):
+            continue
+        jobs.append({
+            "kind": 'MAKE_PROXY',
+            "filepath": filepath,
+            "proxy_filepath": proxy_filepath,
+            "ratio": export_settings["proxy_ratio"],
+            "texture_size": export_settings["proxy_texture_size"],
+            "digest": digest,
+        })
+    return jobs
+
+
+def finish_stages(items, export_settings, written, worker_count=0):
+    # Slim the written files and make their proxies, in background Blenders since both mean opening
+    # and changing the file. Backlinking waits until here, so it links the finished file, or its
+    # proxy. Returns how many bytes slimming saved, by file.
+    filepaths = [item_settings["filepath"] for item_settings, objects in items]
+    while not transfer_queue.wait(filepaths, timeout=0):
+        yield 0.95, "Waiting for files to reach the library"
+    filepaths = [filepath for filepath in filepaths if os.path.exists(filepath)]
+
+    saved = {}
+    if export_settings.get("strip"):
+        # Files skipped as unchanged were already slimmed when they were written
+        jobs = [{"kind": 'SLIM_FILE', "filepath": filepath, "strip": export_settings["strip"]}
+                for filepath in filepaths if filepath in written]
+        results = yield from pool_stages(WorkerPool(None, worker_count), jobs, "Slimmed", 0.95, 0.97)
+        for job, result in zip(jobs, results):
+            if result["status"] == 'FINISHED':
+                saved[job["filepath"]] = result["saved"]
+            elif result["status"] == 'FAILED':
+                print("Couldn't slim %s: %s" % (job["filepath"], result["error"]))
+        refresh_asset_index(export_settings, list(saved))
+
+    if export_settings.get("write_proxy"):
+        manifests = HashManifests()
+        jobs = get_proxy_jobs(filepaths, export_settings, manifests)
+        results = yield from pool_stages(WorkerPool(None, worker_count), jobs, "Made proxies of", 0.97, 0.99)
+        for job, result in zip(jobs, results):
+            if result["status"] == 'FINISHED':
+                manifests.set(job["proxy_filepath"], job["digest"])
+            elif result["status"] == 'FAILED':
+                print("Couldn't make a proxy of %s: %s" % (job["filepath"], result["error"]))
+        manifests.save()
+
+    if export_settings["backlink"]:
+        yield 0.99, "Linking exported objects"
+        for item_settings, objects in items:
+            filepath = item_settings["filepath"]
+            if filepath not in filepaths:
+                continue
+            proxy_filepath = get_proxy_path(filepath)
+            if export_settings.get("write_proxy") and export_settings.get("backlink_proxy") and os.path.exists(proxy_filepath):
+                filepath = proxy_filepath
+            backlink_objects(objects, dict(item_settings, filepath=filepath))
+    return saved
+
+
+def export_and_finish_stages(stages, items, export_settings, worker_count=0):
+    # Staged exports with finish_stages at the end. The stages get settings without
+    # backlinking, finish_stages does that once the files are done.
+    result = yield from stages
+    saved = yield from finish_stages(items, export_settings, get_written_files(result), worker_count)
+    add_saved(result, saved)
+    return result
+
+
+def finish_exports(result, items, export_settings, worker_count=0):
+    # finish_stages straight through, for exports that ran the same way
+    saved = run_stages(finish_stages(items, export_settings, get_written_files(result), worker_count), interval=0.05)
+    add_saved(result, saved)
+    return result
+
+
+def rename_written_ids(filepath, renames):
+    # Give datablocks in a written file names they couldn't have in the open file, as
+    # (collection, name, new name). Done in a background Blender, like slimming.
+    job = {"kind": 'RENAME_IDS', "filepath": filepath, "renames": renames}
+    result = WorkerPool(None, 1).run([job])[0]
+    if result["status"] == 'FAILED':
+        raise RuntimeError("Couldn't rename datablocks in %s: %s" % (filepath, result["error"]))
+
+
+# Worker side
+
+def run_export_objects_job(job):
+    settings = job["settings"]
+    objects = [bpy.data.objects[name] for name in job["objects"]]
+    os.makedirs(os.path.dirname(settings["filepath"]), exist_ok=True)
+    # Nothing invalidates the cache in a worker, so the map is only built once per process
+    assets = export_objects(objects, settings, get_dependency_map())
+    # The main process owns the asset index, so the entries go back with the result
+    return {"filepath": settings["filepath"], "size": os.path.getsize(settings["filepath"]), "assets": assets}
+
+
+def run_make_proxy_job(job):
+    # Workers start without a file for these, each job opens the full export it makes a proxy of
+    bpy.ops.wm.open_mainfile(filepath=job["filepath"], load_ui=False)
+    make_proxy_meshes(job["ratio"])
+    downsize_images(job["texture_size"])
+    bpy.ops.wm.save_as_mainfile(filepath=job["proxy_filepath"], copy=True)
+    return {"filepath": job["proxy_filepath"], "size": os.path.getsize(job["proxy_filepath"])}
+
+
+def run_slim_job(job):
+    # Workers start without a file for these, each job opens the export it slims and saves it in place
+    size = os.path.getsize(job["filepath"])
+    bpy.ops.wm.open_mainfile(filepath=job["filepath"], load_ui=False)
+    strip_data(job["strip"])
+    # Saving in place would otherwise leave a .blend1 backup of the full file next to it
+    bpy.context.preferences.filepaths.save_version = 0
+    bpy.ops.wm.save_as_mainfile(filepath=job["filepath"])
+    return {"filepath": job["filepath"], "saved": size - os.path.getsize(job["filepath"])}
+
+
+def run_rename_job(job):
+    bpy.ops.wm.open_mainfile(filepath=job["filepath"], load_ui=False)
+    for collection, name, new_name in job["renames"]:
+        getattr(bpy.data, collection)[(name, None)].name = new_name
+    bpy.context.preferences.filepaths.save_version = 0
+    bpy.ops.wm.save_as_mainfile(filepath=job["filepath"])
+    return {"filepath": job["filepath"]}
+
+
+def get_extract_filepath(job, name):
+    # Like batch file names, with {source} being the source file's path under the scanned directory
+    filename = job["filename_template"].format(source=job["source_name"], name=bpy.path.clean_name(name))
+    if not filename.lower().endswith(".blend"):
+        filename += ".blend"
+    return os.path.join(job["directory"], filename)
+
+
+def run_extract_job(job):
+    # Append just the matching collections or objects from the source, rather than opening it.
+    # Starting from an empty file each time keeps their names as they were and frees the last source.
+    bpy.ops.wm.read_homefile(use_empty=True)
+    settings = job["settings"]
+    pattern = job["name_filter"] or "*"
+    with bpy.data.libraries.load(job["source"], link=False) as (data_from, data_to):
+        if settings["is_collection"]:
+            data_to.collections = [name for name in data_from.collections if fnmatch.fnmatchcase(name, pattern)]
+        else:
+            data_to.objects = [name for name in data_from.objects if fnmatch.fnmatchcase(name, pattern)]
+    # Handlers don't run in workers, so the dependency cache has to be dropped by hand
+    invalidate_dependency_cache()
+    dependency_map = get_dependency_map()
+
+    if settings["is_collection"]:
+        collections = [collection for collection in data_to.collections if collection is not None]
+        # Collections inside other matching ones already go along with their parent
+        nested = set()
+        for collection in collections:
+            nested.update(get_child_collections(collection))
+        items = [(collection.name, list(collection.objects)) for collection in collections if collection not in nested]
+    else:
+        items = [(ob.name, [ob]) for ob in data_to.objects if ob is not None]
+    # Gone through by name, so names that clean up to the same file get the same numbered files every time
+    items.sort(key=lambda item: item[0])
+
+    files = []
+    exports = []
+    asset_states = []
+    used = set()
+    try:
+        for name, objects in items:
+            filepath = get_unique_filepath(get_extract_filepath(job, name), used)
+            item_settings = dict(settings, filepath=filepath, collection_name=name)
+            exports.append(prepare_export(objects, item_settings))
+        # Mark every item's assets up front, so previews are waited for once per source file
+        asset_ids = [id_data for export_data in exports for id_data in export_data["asset_ids"]]
+        asset_states = mark_assets(asset_ids, settings, dependency_map)
+        for export_data in exports:
+            filepath = export_data["settings"]["filepath"]
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            write_export(export_data, dependency_map)
+            files.append({
+                "filepath": filepath,
+                "size": os.path.getsize(filepath),
+                "assets": export_data["assets"],
+            })
+    finally:
+        restore_assets(asset_states)
+        for export_data in exports:
+            cleanup_export(export_data)
+    return {"filepath": job["source"], "files": files}
+
+
+JOB_HANDLERS = {
+    'EXPORT_OBJECTS': run_export_objects_job,
+    'MAKE_PROXY': run_make_proxy_job,
+    'SLIM_FILE': run_slim_job,
+    'RENAME_IDS': run_rename_job,
+    'EXTRACT_FILE': run_extract_job,
+}
+
+
+def main():
+    # Entry point for background workers: read one JSON job per line from stdin
+    # and answer each with a single result line
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        start = time.perf_counter()
+        try:
+            result = JOB_HANDLERS[job["kind"]](job)
+            result["status"] = 'FINISHED'
+        except Exception as error:
+            result = {"status": 'FAILED', "error": "%s: %s" % (type(error).__name__, error)}
+        result["time"] = time.perf_counter() - start
+        print(RESULT_PREFIX + json.dumps(result), flush=True)